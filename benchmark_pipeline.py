@@ -0,0 +1,301 @@
+import argparse
+import datetime
+import json
+import logging as log
+import pathlib as p
+import re
+import resource
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import add_ways_to_node
+import benchmark_spatial
+import create_geo_array_nodes
+import db_connection
+import get_power_areas
+import landuse as landuse_registry
+import load_to_db
+import metrics
+import process_nodes
+import region_data_generator
+import region_pipeline
+import way_buildable
+
+log.getLogger().setLevel(log.INFO)
+log.basicConfig(format="%(asctime)s - [%(levelname)s]: %(message)s", datefmt="%H:%M:%S")
+
+DEFAULT_REGION = "powiat starachowicki"
+RAW_NODES_LANDUSE = landuse_registry.overpass_filter()
+COPY_ID_OFFSET = 10 ** 11
+COPY_LON_OFFSET = 0.6 # degrees between copies of the region, keeps the copies apart like neighbouring powiats
+
+
+def create_overpass_payloads(region_name: str, multiplier: int):
+    """
+    Creates Overpass API responses for multiplier copies of a real region. Allowable ways come from the region
+    file, restricting nodes are synthesized as in benchmark_spatial and grouped into residential ways.
+    Every copy gets shifted ids and longitudes so copies behave like separate neighbouring regions
+    :return: dictionary copy name -> Overpass json response
+    """
+    fixture = benchmark_spatial.load_fixture(region_name)
+
+    base_elements = []
+    ways = {}
+    for node in fixture["allowable_nodes"]:
+        base_elements.append({"type": "node", "id": node["id"], "lon": node["coordinates"][0], "lat": node["coordinates"][1]})
+        ways.setdefault(node["way_id"], {"landuse": node["landuse"], "nodes": []})["nodes"].append(node["id"])
+    restricting_nodes = fixture["restricting_nodes"]
+    for count in range(0, len(restricting_nodes), 4):
+        way_nodes = restricting_nodes[count:count + 4]
+        for node in way_nodes:
+            base_elements.append({"type": "node", "id": node["id"], "lon": node["coordinates"][0], "lat": node["coordinates"][1]})
+        ways[2 * 10 ** 10 + count] = {"landuse": "residential", "nodes": [x["id"] for x in way_nodes]}
+    for way_id, way in ways.items():
+        base_elements.append({"type": "way", "id": way_id, "nodes": way["nodes"], "tags": {"landuse": way["landuse"]}})
+
+    payloads = {}
+    for copy in range(multiplier):
+        elements = []
+        for element in base_elements:
+            element = dict(element, id=element["id"] + copy * COPY_ID_OFFSET)
+            if element["type"] == "node":
+                element["lon"] = element["lon"] + copy * COPY_LON_OFFSET
+            else:
+                element["nodes"] = [x + copy * COPY_ID_OFFSET for x in element["nodes"]]
+            elements.append(element)
+        payloads[f"{region_name} #{copy + 1}"] = {"elements": elements}
+
+    return payloads
+
+
+def start_overpass_server(payloads: dict):
+    """
+    Starts a local HTTP server answering Overpass queries with canned payloads, the area name of the query selects
+    the payload
+    :return: server and its interpreter url
+    """
+    encoded = {name: json.dumps(payload).encode("utf-8") for name, payload in payloads.items()}
+
+    class OverpassHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            query = parse_qs(urlparse(self.path).query).get("data", [""])[0]
+            name = re.search(r'\[name = "(.*?)"\]', query)
+            body = encoded.get(name.group(1)) if name is not None else None
+            if body is None:
+                self.send_response(404)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), OverpassHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server, f"http://127.0.0.1:{server.server_address[1]}/api/interpreter"
+
+
+def get_database(mongo_uri: str = None):
+    """
+    Connects to the given mongod, or to an in-process stand-in (mongomock) when no uri is given
+    :return: database handle and True when the server supports $merge
+    """
+    if mongo_uri is not None:
+        from pymongo import MongoClient
+
+        client = MongoClient(mongo_uri)
+        client.drop_database("Poland_spatial_data_benchmark")
+        return client.Poland_spatial_data_benchmark, True
+
+    import mongomock
+
+    return mongomock.MongoClient().Poland_spatial_data_benchmark, False
+
+
+def reset_peak_rss():
+    """Resets the peak resident set size of the process, Linux only"""
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss_mb():
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    divisor = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / divisor
+
+
+def run_stage(report: list, name: str, function):
+    """
+    Runs one stage and appends its wall time, processed documents per second and peak RSS to the report
+    :param function: stage function returning the number of processed documents
+    """
+    reset_peak_rss()
+    start = time.perf_counter()
+    docs = function()
+    wall_time = time.perf_counter() - start
+    report.append({"stage": name, "wall_time": wall_time, "docs": docs,
+                   "docs_per_sec": docs / wall_time if wall_time > 0 else 0, "peak_rss_mb": peak_rss_mb()})
+    log.info(f"Stage {name}: {docs} docs in {wall_time:.2f} s")
+
+
+def prepare(region_name: str, multiplier: int, mongo_uri: str = None):
+    """
+    Starts the Overpass stand-in and creates the regions collection, every copy neighbouring the previous and the
+    next one
+    :return: server, its url, database, True when it supports $merge, dictionary region name -> id
+    """
+    payloads = create_overpass_payloads(region_name, multiplier)
+    server, url = start_overpass_server(payloads)
+    db, merge = get_database(mongo_uri)
+    db_connection.use_database(db)
+    region_ids = {name: count for count, name in enumerate(payloads, start=1)}
+    for name, region_id in region_ids.items():
+        neighbours = [x for x in (region_id - 1, region_id + 1) if 1 <= x <= len(region_ids)]
+        db["regions"].insert_one({"id": region_id, "name": name, "neighbours": neighbours})
+    return server, url, db, merge, region_ids
+
+
+def run_pipeline(region_name: str, multiplier: int, mongo_uri: str = None, min_allowable_power: int = 30):
+    server, url, db, merge, region_ids = prepare(region_name, multiplier, mongo_uri)
+    folder_path = p.Path(tempfile.mkdtemp(prefix="mgr_pipeline_"))
+
+    report = []
+    raw_data = {}
+
+    def fetch():
+        for name in region_ids:
+            raw_data[name] = region_data_generator.get_raw_region_data(url, name, RAW_NODES_LANDUSE, 1)
+        return sum(len(x["elements"]) for x in raw_data.values())
+
+    def region_files():
+        docs = 0
+        for name, region_id in region_ids.items():
+            region_data = region_data_generator.get_region_data(raw_data.pop(name), region_id)
+            region_data_generator.save_region_file(region_data, name, folder_path)
+            docs = docs + len(region_data["nodes"]) + len(region_data["ways"])
+        return docs
+
+    def load():
+        files = sorted(x.name for x in folder_path.iterdir())
+        nodes = load_to_db.get_file_data(folder_path, [x for x in files if "_nodes.json" in x])
+        db["nodes"].insert_many(nodes)
+        ways = load_to_db.get_file_data(folder_path, [x for x in files if "_ways.json" in x])
+        db["ways"].insert_many(ways)
+        return len(nodes) + len(ways)
+
+    def geo_array_nodes():
+        docs = 0
+        for region_id in region_ids.values():
+            for region_nodes in create_geo_array_nodes.iterate_over_region(region_id, db["nodes"]):
+                create_geo_array_nodes.send_to_db(region_nodes, db["testing_col"])
+                docs = docs + len(region_nodes)
+        return docs
+
+    def landuse():
+        attributes = {"nodes": 1, "landuse": 1, "id": 1, "_id": 0}
+        for region_id in region_ids.values():
+            add_ways_to_node.update_nodes_with_landuse(region_id, attributes, db)
+        return db["ways"].count_documents({})
+
+    def distances():
+        way_buildable.ensure_indexes(db)
+        docs = metrics.get_counter("nodes_evaluated")
+        for region_id in region_ids.values():
+            collection = db["testing_col"]
+            allowable_nodes = process_nodes.stream_nodes_from_way(way_buildable.ALLOWABLE_LANDUSE, collection, region_id)
+            restricting_nodes = process_nodes.get_restricting_nodes(region_id, landuse_registry.RESTRICTING_LANDUSE, collection)
+            region_neighbours = process_nodes.get_region_ids(region_id, db["regions"])
+            region_bbox = process_nodes.get_region_bbox(way_buildable.ALLOWABLE_LANDUSE, collection, region_id)
+            changed_ways = process_nodes.iterate_nodes_list(allowable_nodes, restricting_nodes, collection, region_neighbours,
+                                                            region_bbox)
+            way_buildable.refresh_way_buildable(db, region_id, changed_ways, merge=merge)
+        return metrics.get_counter("nodes_evaluated") - docs
+
+    def power():
+        results, way_results = {}, []
+        for region_id in region_ids.values():
+            results[region_id] = get_power_areas.get_buildable_nodes(region_id, min_allowable_power, db, way_results)
+        get_power_areas.results_cache.save_way_results(db, way_results)
+        get_power_areas.write_region_results(db, results)
+        return len(way_results)
+
+    try:
+        for name, function in [("fetch", fetch), ("region_files", region_files), ("load_to_db", load),
+                               ("create_geo_array_nodes", geo_array_nodes), ("landuse", landuse),
+                               ("process_nodes", distances), ("get_power_areas", power)]:
+            run_stage(report, name, function)
+    finally:
+        server.shutdown()
+
+    return report
+
+
+def run_pipelined(region_name: str, multiplier: int, mongo_uri: str = None, min_allowable_power: int = 30,
+                  io_workers: int = region_pipeline.IO_WORKERS, cpu_workers: int = region_pipeline.CPU_WORKERS):
+    """
+    Same stages run by region_pipeline, regions overlapping. With mongomock the cpu stages run in threads
+    :return: report of region_pipeline.Pipeline.run
+    """
+    server, url, db, merge, region_ids = prepare(region_name, multiplier, mongo_uri)
+    way_buildable.ensure_indexes(db)
+    settings = {"url": url, "folder": tempfile.mkdtemp(prefix="mgr_pipeline_"),
+                "min_allowable_power": min_allowable_power, "merge": merge}
+    try:
+        pipeline = region_pipeline.Pipeline(region_pipeline.load_regions(db), settings, io_workers, cpu_workers,
+                                            cpu_processes=mongo_uri is not None)
+        return pipeline.run()
+    finally:
+        server.shutdown()
+
+
+def save_report(report: list, region_name: str, multiplier: int, mongo_uri: str):
+    folder_path: p.Path = p.Path.cwd().joinpath(benchmark_spatial.RESULTS_FOLDER)
+    if not folder_path.exists():
+        folder_path.mkdir()
+    commit = benchmark_spatial.git_commit()
+    file_path: p.Path = folder_path.joinpath(f"pipeline_{commit}_x{multiplier}.json")
+    with file_path.open(mode="w", encoding="utf-8") as written_file:
+        json.dump({"commit": commit, "date": datetime.datetime.now().isoformat(timespec="seconds"),
+                   "region": region_name, "multiplier": multiplier,
+                   "database": "mongod" if mongo_uri else "mongomock", "stages": report,
+                   "counters": metrics.report("benchmark_pipeline")["counters"]}, written_file, indent=2)
+    log.info(f"Report saved to {file_path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="End to end benchmark of the whole pipeline")
+    parser.add_argument("--region", default=DEFAULT_REGION, help="region file used as the base of the synthetic data")
+    parser.add_argument("--multiplier", type=int, nargs="*", default=[1], help="number of copies of the region, e.g. 1 10 50")
+    parser.add_argument("--mongo-uri", help="local mongod uri, an in-process mongomock database is used when not given")
+    parser.add_argument("--pipelined", action="store_true", help="run the regions through region_pipeline instead")
+    args = parser.parse_args()
+
+    for multiplier in args.multiplier:
+        metrics.reset()
+        if args.pipelined:
+            region_pipeline.log_report(run_pipelined(args.region, multiplier, args.mongo_uri))
+            continue
+        report = run_pipeline(args.region, multiplier, args.mongo_uri)
+        for stage in report:
+            log.info(f"x{multiplier} {stage['stage']:>24}: {stage['wall_time']:8.2f} s "
+                     f"{stage['docs_per_sec']:10.0f} docs/s {stage['peak_rss_mb']:8.1f} MB")
+        save_report(report, args.region, multiplier, args.mongo_uri)
@@ -0,0 +1,313 @@
+import argparse
+import datetime
+import json
+import logging as log
+import math
+import pathlib as p
+import platform
+import random
+import statistics
+import subprocess
+import time
+from collections import defaultdict
+
+import numpy as np
+
+import get_power_areas as power
+import landuse
+import restriction_polygons
+import process_nodes as distance
+from node_store import NodeStore, DistanceBounds
+
+log.getLogger().setLevel(log.INFO)
+log.basicConfig(format="%(asctime)s - [%(levelname)s]: %(message)s", datefmt="%H:%M:%S")
+
+# region files used as fixtures, from a small powiat to the largest one in region_data_files
+SIZE_TIERS = {"small": "powiat starachowicki", "medium": "powiat kutnowski", "large": "powiat wąbrzeski"}
+RESULTS_FOLDER = "benchmark_results"
+SAMPLE_NODES = 200
+SEED = 1234
+
+
+def load_fixture(region_name: str, folder_name: str = "region_data_files"):
+    """
+    Builds benchmark input from a region file. The files only hold allowable nodes with their distance
+    to the closest restriction, so restricting nodes are synthesized: for a sample of nodes a restricting node is
+    placed exactly at the stored distance in a random direction, which keeps the distance distribution realistic
+    :param region_name: name of the region file without extension
+    :param folder_name: directory with the region files
+    :return: dictionary with allowable nodes, restricting nodes and ways as used by the pipeline
+    """
+    file_path: p.Path = p.Path.cwd().joinpath(folder_name, f"{region_name}.json")
+    with file_path.open(mode="r", encoding="utf-8") as read_file:
+        nodes = json.load(read_file)["nodes"]
+
+    rng = random.Random(SEED)
+    allowable_nodes = [{"id": node["id"], "coordinates": [node["lon"], node["lat"]], "way_id": node["way_id"],
+                        "landuse": node["landuse"]} for node in nodes]
+
+    restricting_nodes = []
+    for count, node in enumerate(rng.sample(nodes, max(1, len(nodes) // 2))):
+        bearing = rng.uniform(0, 2 * math.pi)
+        restriction_distance = min(node["closest_distance_restriction"], 4.)
+        dlat = restriction_distance / 111.195 * math.cos(bearing)
+        dlon = restriction_distance / (111.195 * math.cos(math.radians(node["lat"]))) * math.sin(bearing)
+        restricting_nodes.append({"id": 10 ** 12 + count, "coordinates": [node["lon"] + dlon, node["lat"] + dlat]})
+
+    ways = defaultdict(lambda: {"buildable_nodes": [], "node_coordinates": [], "node_distances": []})
+    for node in sorted(nodes, key=lambda x: x["closest_distance_restriction"]):
+        way = ways[node["way_id"]]
+        way["buildable_nodes"].append(node["id"])
+        way["node_coordinates"].append([node["lon"], node["lat"]])
+        way["node_distances"].append(node["closest_distance_restriction"])
+    ways = [{"way_id": way_id, "region_id": 0, **way} for way_id, way in ways.items()]
+
+    return {"allowable_nodes": allowable_nodes, "restricting_nodes": restricting_nodes, "ways": ways}
+
+
+def time_function(function, repeat: int = 5):
+    """
+    Runs the function repeat times
+    :return: list of wall times in seconds
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def spatial_cases(fixture: dict):
+    """
+    Benchmarked calls for one fixture
+    :return: dictionary name -> (number of calls per run, function running them)
+    """
+    rng = random.Random(SEED)
+    allowable_nodes = fixture["allowable_nodes"]
+    restricting_nodes = fixture["restricting_nodes"]
+    sample = rng.sample(allowable_nodes, min(SAMPLE_NODES, len(allowable_nodes)))
+    pairs = [(rng.choice(allowable_nodes)["coordinates"], rng.choice(restricting_nodes)["coordinates"])
+             for _ in range(10000)]
+    restricting_store = NodeStore.from_documents(restricting_nodes)
+    ways = fixture["ways"]
+    area_ways = [way for way in ways if len(way["buildable_nodes"]) > 2]
+    latitudes = [node["coordinates"][1] for node in allowable_nodes]
+    bounds = DistanceBounds.for_bbox([0, min(latitudes), 0, max(latitudes)], distance.LIMIT_COORDINATES)
+
+    return {
+        "calculate_distance": (len(pairs), lambda: [distance.calculate_distance(a, b) for a, b in pairs]),
+        "get_subset_restricting_nodes": (len(sample), lambda: [distance.get_subset_restricting_nodes(node, restricting_nodes)
+                                                              for node in sample]),
+        "find_closest_restriction": (len(sample), lambda: [distance.find_closest_restriction(dict(node), restricting_nodes,
+                                                                                             "curr_region")
+                                                          for node in sample]),
+        "find_closest_restriction_store": (len(sample), lambda: [distance.find_closest_restriction(dict(node), restricting_store,
+                                                                                                   "curr_region")
+                                                                for node in sample]),
+        "find_closest_restriction_two_tier": (len(sample), lambda: [distance.find_closest_restriction(dict(node), restricting_nodes,
+                                                                                                      "curr_region", bounds)
+                                                                   for node in sample]),
+        "find_closest_restriction_store_two_tier": (len(sample), lambda: [distance.find_closest_restriction(dict(node), restricting_store,
+                                                                                                            "curr_region", bounds)
+                                                                         for node in sample]),
+        "calculate_way_results": (len(area_ways), lambda: [power.calculate_way_results(way, power.results_cache.SETBACKS)
+                                                           for way in area_ways]),
+    }
+
+
+def simplification_cases(fixture: dict, tolerances: list, repeat: int):
+    """
+    Distance error and speedup of NodeStore.simplify. The region files hold no restricting outlines, so the
+    allowable outlines, real OSM vertices as dense as residential ones, are simplified and distances are measured
+    from the synthesized restricting nodes, which lie at realistic distances from them
+    :return: dictionary tolerance -> nodes kept, maximal and mean error in km, best time of the closest restriction search
+    """
+    rng = random.Random(SEED)
+    outlines = NodeStore.from_documents(fixture["allowable_nodes"])
+    outlines.landuse[:] = landuse.tag_code("residential")
+    queries = [dict(node) for node in rng.sample(fixture["restricting_nodes"],
+                                                 min(SAMPLE_NODES, len(fixture["restricting_nodes"])))]
+
+    def nearest(store: NodeStore):
+        minima = []
+        for node in queries:
+            subset = distance.get_subset_restricting_nodes(node, store)
+            minima.append(subset.distances_to(node["coordinates"]).min() if len(subset) != 0 else math.inf)
+        return np.array(minima)
+
+    exact = nearest(outlines)
+    found = np.isfinite(exact)
+    results = {}
+    for tolerance in [0] + tolerances:
+        simplified, _ = outlines.simplify(tolerance)
+        error = nearest(simplified)[found] - exact[found]
+        timings = time_function(lambda: [distance.find_closest_restriction(dict(node), simplified, "curr_region")
+                                         for node in queries], repeat)
+        results[tolerance] = {"nodes": len(simplified), "max_error": float(error.max()),
+                              "mean_error": float(error.mean()), "best": min(timings)}
+        log.info(f"tolerance {tolerance} km: {len(simplified)} of {len(outlines)} nodes, max error "
+                 f"{error.max():.4f} km, mean error {error.mean():.4f} km, {min(timings):.4f} s "
+                 f"for {len(queries)} searches")
+    return results
+
+
+def settlement_ways(fixture: dict, vertex_spacing: float = None):
+    """
+    Rectangular restricting outlines around the synthesized restricting nodes, sides of 0.2 to 1.5 km in random
+    directions, as residential areas with long straight edges
+    :param vertex_spacing: km between vertices along the edges, only the corners when None
+    :return: way documents and NodeStore of their nodes
+    """
+    rng = random.Random(SEED)
+    ways, nodes = [], []
+    for way_number, restriction in enumerate(fixture["restricting_nodes"]):
+        lon, lat = restriction["coordinates"]
+        half_width, half_height = rng.uniform(0.1, 0.75), rng.uniform(0.1, 0.75)
+        angle = rng.uniform(0, math.pi)
+        corners = [(-half_width, -half_height), (half_width, -half_height), (half_width, half_height),
+                   (-half_width, half_height), (-half_width, -half_height)]
+        outline = []
+        for (x1, y1), (x2, y2) in zip(corners, corners[1:]):
+            steps = 1 if vertex_spacing is None else max(1, math.ceil(math.hypot(x2 - x1, y2 - y1) / vertex_spacing))
+            outline.extend((x1 + (x2 - x1) * step / steps, y1 + (y2 - y1) * step / steps) for step in range(steps))
+        node_ids = []
+        for x, y in outline:
+            east = x * math.cos(angle) - y * math.sin(angle)
+            north = x * math.sin(angle) + y * math.cos(angle)
+            node_ids.append(2 * 10 ** 12 + len(nodes))
+            nodes.append({"id": node_ids[-1], "landuse_code": landuse.tag_code("residential"),
+                          "coordinates": [lon + east / (111.195 * math.cos(math.radians(lat))), lat + north / 111.195]})
+        ways.append({"id": 10 ** 12 + way_number, "landuse": "residential", "nodes": node_ids + node_ids[:1]})
+    return ways, NodeStore.from_documents(nodes)
+
+
+def edge_cases(fixture: dict, repeat: int):
+    """
+    Accuracy and time of restriction_polygons against nearest vertex distances on settlement_ways outlines.
+    Vertices every 5 m give the reference, within 2.5 m of the true edge distance outside the outlines
+    :return: dictionary case -> geometries or nodes, maximal and mean error in km, best time for a sample of nodes
+    """
+    rng = random.Random(SEED)
+    sample = rng.sample(fixture["allowable_nodes"], min(5 * SAMPLE_NODES, len(fixture["allowable_nodes"])))
+    allowable = NodeStore.from_documents(sample)
+    coordinates = [[lon, lat] for lon, lat in zip(allowable.lon, allowable.lat)]
+    center = [float(allowable.lon.mean()), float(allowable.lat.mean())]
+
+    def vertex_distances(store: NodeStore):
+        minima = []
+        for point in coordinates:
+            subset = distance.get_subset_restricting_nodes({"coordinates": point}, store)
+            minima.append(min(subset.distances_to(point).min(), landuse.NO_RESTRICTION_DISTANCE)
+                          if len(subset) != 0 else landuse.NO_RESTRICTION_DISTANCE)
+        return np.array(minima)
+
+    ways, reference_store = settlement_ways(fixture, 0.005)
+    reference = vertex_distances(reference_store)
+    results = {}
+    for spacing in [None, 0.05]:
+        _, store = settlement_ways(fixture, spacing)
+        timings = time_function(lambda: vertex_distances(store), repeat)
+        error = vertex_distances(store) - reference
+        results[f"vertices_{spacing or 'corners'}"] = {"geometries": len(store), "max_error": float(np.abs(error).max()),
+                                                       "mean_error": float(np.abs(error).mean()), "best": min(timings)}
+
+    corner_ways, corner_store = settlement_ways(fixture)
+
+    def edge_distances():
+        index = restriction_polygons.PolygonIndex.from_ways(corner_ways, corner_store, center)
+        return np.minimum(index.nearest(allowable.lon, allowable.lat)[0], landuse.NO_RESTRICTION_DISTANCE)
+
+    timings = time_function(edge_distances, repeat)
+    edges = edge_distances()
+    # nodes inside an outline are at distance 0 of the polygon but not of its vertices, they are left out
+    outside = edges > 0
+    error = edges[outside] - reference[outside]
+    results["edges"] = {"geometries": len(corner_ways), "max_error": float(np.abs(error).max()),
+                        "mean_error": float(np.abs(error).mean()), "best": min(timings)}
+    for name, result in results.items():
+        log.info(f"{name}: {result['geometries']} geometries, max error {result['max_error']:.4f} km, mean error "
+                 f"{result['mean_error']:.4f} km, {result['best']:.4f} s for {len(coordinates)} nodes")
+    return results
+
+
+def run_benchmarks(tiers: dict, repeat: int):
+    results = {}
+    fixtures = {}
+    for tier, region_name in tiers.items():
+        fixture = load_fixture(region_name)
+        fixtures[tier] = {"region": region_name,
+                          "allowable_nodes": len(fixture["allowable_nodes"]),
+                          "restricting_nodes": len(fixture["restricting_nodes"]),
+                          "ways": len(fixture["ways"])}
+        for name, (calls, function) in spatial_cases(fixture).items():
+            timings = time_function(function, repeat)
+            results[f"{tier}/{name}"] = {"calls": calls, "best": min(timings), "median": statistics.median(timings),
+                                         "per_call": min(timings) / max(calls, 1)}
+            log.info(f"{tier}/{name}: best {min(timings):.4f} s for {calls} calls")
+    return fixtures, results
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def save_results(fixtures: dict, results: dict, folder_name: str = RESULTS_FOLDER):
+    folder_path: p.Path = p.Path.cwd().joinpath(folder_name)
+    if not folder_path.exists():
+        folder_path.mkdir()
+    commit = git_commit()
+    file_path: p.Path = folder_path.joinpath(f"spatial_{commit}.json")
+    with file_path.open(mode="w", encoding="utf-8") as written_file:
+        json.dump({"commit": commit, "date": datetime.datetime.now().isoformat(timespec="seconds"),
+                   "python": platform.python_version(), "fixtures": fixtures, "results": results},
+                  written_file, indent=2)
+    log.info(f"Results saved to {file_path}")
+    return file_path
+
+
+def compare_results(results: dict, baseline_fname: str, tolerance: float = 0.1):
+    """
+    Logs the ratio of best timings against an earlier results file, flagging cases slower by more than tolerance
+    """
+    with open(baseline_fname, encoding="utf-8") as read_file:
+        baseline = json.load(read_file)
+    for name, result in results.items():
+        if name not in baseline["results"]:
+            continue
+        ratio = result["best"] / baseline["results"][name]["best"]
+        if ratio > 1 + tolerance:
+            log.warning(f"{name} is {ratio:.2f}x slower than in {baseline['commit']}")
+        else:
+            log.info(f"{name}: {ratio:.2f}x of {baseline['commit']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Microbenchmarks of the distance and power stages")
+    parser.add_argument("--tiers", nargs="*", default=list(SIZE_TIERS), choices=list(SIZE_TIERS))
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    parser.add_argument("--simplify", nargs="*", type=float, metavar="KM",
+                        help="measure restriction simplification with these tolerances instead")
+    parser.add_argument("--edges", action="store_true",
+                        help="measure polygon edge distances against vertex distances instead")
+    args = parser.parse_args()
+
+    if args.edges:
+        for tier in args.tiers:
+            log.info(f"Polygon edge distances of {SIZE_TIERS[tier]}")
+            edge_cases(load_fixture(SIZE_TIERS[tier]), args.repeat)
+        raise SystemExit()
+    if args.simplify:
+        for tier in args.tiers:
+            log.info(f"Simplification of {SIZE_TIERS[tier]}")
+            simplification_cases(load_fixture(SIZE_TIERS[tier]), args.simplify, args.repeat)
+        raise SystemExit()
+    fixtures, results = run_benchmarks({tier: SIZE_TIERS[tier] for tier in args.tiers}, args.repeat)
+    save_results(fixtures, results)
+    if args.compare:
+        compare_results(results, args.compare)
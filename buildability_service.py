@@ -0,0 +1,285 @@
+import argparse
+import json
+import logging as log
+import pathlib as p
+import threading
+import time
+import urllib.parse
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import shapely
+
+import get_power_areas as power
+import region_store
+import restriction_index
+from node_store import NodeStore
+from power_results_cache import SETBACKS
+
+log.getLogger().setLevel(log.INFO)
+log.basicConfig(format="%(asctime)s - [%(levelname)s]: %(message)s", datefmt="%H:%M:%S")
+
+HOST = "127.0.0.1"
+PORT = 8050
+MAX_NODES = 10000 # nodes listed in one answer, the totals always cover every node
+MAX_CACHED_WAYS = 2000000 # (way, setback) results kept by the index
+
+
+class BuildabilityIndex:
+    """
+    Allowable nodes of all regions held in memory with the grid of restriction_index, answers how many nodes are
+    buildable in an area and how much power their hulls allow, as get_power_areas does per region
+
+    Attributes:
+        store (NodeStore): nodes with way ids and distances to the closest restriction
+        grid (restriction_index.RestrictionIndex): grid over the rows of the store
+        region_names (list): names of the regions, indexed by the region number of the grid
+        way_ids, way_sizes (np.ndarray): sorted way ids and their number of nodes
+    """
+
+    def __init__(self, store: NodeStore, region_numbers, region_names: list):
+        store, region_numbers = unique_nodes(store, region_numbers)
+        self.store = store
+        arrays, descriptor = restriction_index.build_arrays(store, region_numbers)
+        self.grid = restriction_index.RestrictionIndex(arrays, descriptor)
+        self.region_names = region_names
+        self.way_ids, self.way_sizes = np.unique(store.way_ids, return_counts=True)
+        self._way_results = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_region_files(cls, json_folder: str = region_store.JSON_FOLDER,
+                          store_folder: str = region_store.STORE_FOLDER):
+        """
+        Loads every region file, from its region_store copy when there is an up to date one
+        """
+        stores, region_numbers, region_names = [], [], []
+        for json_path in sorted(p.Path(json_folder).glob("*.json")):
+            columns = region_store.load_region(json_path.stem, json_folder, store_folder)
+            stores.append(NodeStore(columns["id"], columns["lon"], columns["lat"], columns["way_id"],
+                                    columns["landuse"], columns["closest_distance_restriction"]))
+            region_numbers.append(np.full(len(columns["id"]), len(region_names), dtype=np.int32))
+            region_names.append(json_path.stem)
+        store = NodeStore.concatenate(stores)
+        numbers = np.concatenate(region_numbers) if len(region_numbers) != 0 else np.empty(0, dtype=np.int32)
+        log.info(f"Loaded {len(store)} nodes of {len(region_names)} regions")
+        return cls(store, numbers, region_names)
+
+    def rows(self, bbox: list = None, polygon=None):
+        """
+        :param bbox: [min_lon, min_lat, max_lon, max_lat]
+        :param polygon: shapely geometry in lon, lat, its bounds are used when no bbox is given
+        :return: row numbers of the nodes inside both
+        """
+        if bbox is None:
+            bbox = list(polygon.bounds) if polygon is not None else [-180., -90., 180., 90.]
+        rows = self.grid.rows_within(*bbox)
+        if polygon is not None and len(rows) != 0:
+            shapely.prepare(polygon)
+            rows = rows[shapely.contains_xy(polygon, self.store.lon[rows], self.store.lat[rows])]
+        return rows
+
+    def way_result(self, way_id: int, node_coordinates, setback: float):
+        """
+        Hull area and power of the buildable nodes of a whole way, computed once per way and setback
+        """
+        key = (way_id, setback)
+        with self._lock:
+            result = self._way_results.get(key)
+        if result is None:
+            result = hull_result(node_coordinates)
+            with self._lock:
+                if len(self._way_results) >= MAX_CACHED_WAYS:
+                    self._way_results.clear()
+                self._way_results[key] = result
+        return result
+
+    def query(self, bbox: list = None, polygon=None, setback: float = SETBACKS[0], min_allowable_power: float = 0,
+              nodes: bool = False):
+        """
+        Buildable nodes of the area and the power of their ways, a way crossing the border of the area only counts
+        with its nodes inside it
+        :param setback: minimal distance to the closest restriction, km
+        :param min_allowable_power: ways with less power are left out of the totals, MW
+        :param nodes: list the buildable nodes, at most MAX_NODES of them
+        :return: dictionary of totals, as get_power_areas.result_fields
+        """
+        start = time.perf_counter()
+        rows = self.rows(bbox, polygon)
+        store = self.store
+        buildable = rows[store.distances[rows] >= setback]
+
+        # ways with all their nodes in the area are cached, the others are clipped to it
+        area_ways, area_counts = np.unique(store.way_ids[rows], return_counts=True)
+        complete_ways = set(area_ways[area_counts == self.way_sizes[np.searchsorted(self.way_ids, area_ways)]].tolist())
+        # nodes of a way sorted by distance as in NodeStore.ways, calculate_hull_area depends on their order
+        order = buildable[np.lexsort((store.distances[buildable], store.way_ids[buildable]))]
+        way_ids = store.way_ids[order]
+        boundaries = np.flatnonzero(np.diff(way_ids)) + 1
+
+        overall_area, overall_power, node_number, way_number = 0., 0., 0, 0
+        for way_rows in np.split(order, boundaries):
+            if len(way_rows) <= 2:
+                continue
+            way_id = int(store.way_ids[way_rows[0]])
+            coordinates = np.column_stack((store.lon[way_rows], store.lat[way_rows]))
+            area = self.way_result(way_id, coordinates, setback) if way_id in complete_ways else hull_result(coordinates)
+            way_power = area * power.AVG_POWER_COEFFICIENT
+            if area != 0 and way_power >= min_allowable_power:
+                overall_area = overall_area + area
+                overall_power = overall_power + way_power
+                node_number = node_number + len(way_rows)
+                way_number = way_number + 1
+
+        answer = {"setback": setback, "min_allowable_power": min_allowable_power, "nodes_in_area": len(rows),
+                  "buildable_nodes": len(buildable), "ways": way_number, "overall_area": overall_area,
+                  "overall_power": overall_power, "node_number": node_number}
+        if nodes:
+            listed = buildable[:MAX_NODES]
+            answer["nodes"] = [{"id": int(store.ids[row]), "coordinates": [float(store.lon[row]), float(store.lat[row])],
+                                "way_id": int(store.way_ids[row]),
+                                "closest_distance_restriction": float(store.distances[row])} for row in listed]
+            answer["nodes_truncated"] = len(buildable) > MAX_NODES
+        answer["elapsed_ms"] = (time.perf_counter() - start) * 1000
+        return answer
+
+    def warm_up(self, setbacks: list = SETBACKS):
+        """
+        Computes the hulls of every way at the given setbacks in a background thread
+        :return: the started thread
+        """
+        def compute():
+            for setback in setbacks:
+                self.query(setback=setback)
+            log.info(f"Way results cached for setbacks {setbacks}")
+
+        thread = threading.Thread(target=compute, name="buildability-warm-up", daemon=True)
+        thread.start()
+        return thread
+
+
+def unique_nodes(store: NodeStore, region_numbers):
+    """
+    Nodes on a region border are listed in the files of both regions, one row is kept per node id, one with a
+    known distance when there is one
+    :return: store and region numbers of the kept rows, in their original order
+    """
+    region_numbers = np.asarray(region_numbers)
+    order = np.lexsort((np.isnan(store.distances), store.ids))
+    first_rows = np.unique(store.ids[order], return_index=True)[1]
+    rows = np.sort(order[first_rows])
+    if len(rows) == len(store):
+        return store, region_numbers
+    log.info(f"Dropped {len(store) - len(rows)} nodes listed in two regions")
+    return store[rows], region_numbers[rows]
+
+
+def hull_result(node_coordinates):
+    """Hull area in km2 of at least 3 nodes, as get_power_areas.calculate_way_results"""
+    if len(node_coordinates) <= 2:
+        return 0.
+    return power.calculate_hull_area(node_coordinates)
+
+
+def parse_query(parameters: dict):
+    """
+    :param parameters: JSON body or query string values: bbox as a list or "min_lon,min_lat,max_lon,max_lat",
+    polygon as a GeoJSON geometry or list of [lon, lat], setback, min_allowable_power and nodes
+    :return: keyword arguments of BuildabilityIndex.query
+    """
+    bbox = parameters.get("bbox")
+    if isinstance(bbox, str):
+        bbox = [float(x) for x in bbox.split(",")]
+    if bbox is not None and len(bbox) != 4:
+        raise ValueError("bbox needs 4 values: min_lon, min_lat, max_lon, max_lat")
+    polygon = parameters.get("polygon")
+    if isinstance(polygon, str):
+        polygon = json.loads(polygon)
+    if isinstance(polygon, dict):
+        polygon = shapely.from_geojson(json.dumps(polygon))
+    elif polygon is not None:
+        polygon = shapely.polygons(polygon)
+    nodes = parameters.get("nodes", False)
+    return {"bbox": bbox, "polygon": polygon, "setback": float(parameters.get("setback", SETBACKS[0])),
+            "min_allowable_power": float(parameters.get("min_allowable_power", 0)),
+            "nodes": nodes in (True, "1", "true")}
+
+
+def make_handler(index: BuildabilityIndex):
+    class Handler(BaseHTTPRequestHandler):
+        """
+        GET /health, GET /query?bbox=...&setback=... and POST /query with a JSON body, see parse_query
+        """
+
+        def do_GET(self):
+            url = urllib.parse.urlparse(self.path)
+            if url.path == "/health":
+                self.answer(200, {"nodes": len(index.store), "regions": len(index.region_names)})
+            elif url.path == "/query":
+                self.run_query({k: v[-1] for k, v in urllib.parse.parse_qs(url.query).items()})
+            else:
+                self.answer(404, {"error": f"Unknown path {url.path}"})
+
+        def do_POST(self):
+            if urllib.parse.urlparse(self.path).path != "/query":
+                self.answer(404, {"error": f"Unknown path {self.path}"})
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            except ValueError as error:
+                self.answer(400, {"error": f"Invalid JSON: {error}"})
+                return
+            self.run_query(body)
+
+        def run_query(self, parameters: dict):
+            try:
+                arguments = parse_query(parameters)
+            except (ValueError, TypeError, shapely.errors.GEOSException) as error:
+                self.answer(400, {"error": str(error)})
+                return
+            self.answer(200, index.query(**arguments))
+
+        def answer(self, status: int, body: dict):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            log.debug(format % args)
+
+    return Handler
+
+
+def serve(index: BuildabilityIndex, host: str = HOST, port: int = PORT):
+    server = ThreadingHTTPServer((host, port), make_handler(index))
+    log.info(f"Buildability service listening on http://{host}:{server.server_port}")
+    return server
+
+
+def query_service(url: str = f"http://{HOST}:{PORT}", timeout: float = 30, **parameters):
+    """
+    Client for the dashboard and ad-hoc analyses
+    :param parameters: bbox, polygon, setback, min_allowable_power, nodes, see parse_query
+    :return: answer of the service
+    """
+    request = urllib.request.Request(f"{url}/query", data=json.dumps(parameters).encode("utf-8"),
+                                     headers={"Content-Type": "application/json"}, method="POST")
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return json.loads(response.read())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local HTTP service answering buildability queries")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--no-warm-up", action="store_true", help="do not compute the way hulls at startup")
+    args = parser.parse_args()
+
+    buildability_index = BuildabilityIndex.from_region_files()
+    if not args.no_warm_up:
+        buildability_index.warm_up()
+    serve(buildability_index, args.host, args.port).serve_forever()
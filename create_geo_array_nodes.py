@@ -1,54 +1,93 @@
-from pymongo import MongoClient
-from pymongo.errors import OperationFailure
 import math
 import logging as log
-import time
+from pymongo import ASCENDING, UpdateOne
+import db_connection
+import job_ledger
+import metrics
 
 
 log.getLogger().setLevel(log.INFO)
 log.basicConfig(format="%(asctime)s - [%(levelname)s]: %(message)s", datefmt="%H:%M:%S")
 
-def connect(host: str, port: int):
-    log.info(f"Connecting to the database")
-    connection = MongoClient(host, port)
-    try:
-        connection.server_info()
-        log.info(f"Connected successfully")
-    except OperationFailure:
-        log.error(f"Could not connect to db")
+NODE_BYTES = 600 # approximate size of a decoded node document
 
-    db = connection.Poland_spatial_data
-    current_collection = db["nodes"]
+LEDGER_STAGE = "create_geo_array_nodes"
 
-    for i in range(6,381):
-        start = time.time()
+def connect(region_ids: list = job_ledger.REGION_IDS):
+    """
+    Converts the nodes of every region not converted yet according to the job ledger. Regions whose last attempt
+    did not finish are converted from scratch, the others are upserted so fields written by later stages stay, and
+    the regions converted again are done again by add_ways_to_node and process_nodes, see job_ledger.UPSTREAM
+    """
+    current_collection = db_connection.get_collection("nodes", "read")
+    target_collection = db_connection.get_collection("testing_col", "bulk")
+    # a node on a region border is listed in both region files and kept once per region
+    target_collection.create_index([("region_id", ASCENDING), ("id", ASCENDING)])
+    ledger = job_ledger.get_ledger()
+    interrupted = {int(x) for x, status in ledger.statuses(LEDGER_STAGE).items() if status != "done"}
+
+    def convert(i: int):
         log.info(f"Getting data for region {i}")
-        region_nodes = iterate_over_region(i, current_collection)
-        if region_nodes != 0:
-            send_to_db(region_nodes, db["testing_col"])
-        time.sleep(1)
-        end = time.time()
-        log.info(f"Process took {(end - start) / 60} minutes")
+        with metrics.stage("create_geo_array_nodes.region", region_id=i):
+            try:
+                convert_region(i, current_collection, target_collection, clean=i in interrupted)
+            except Exception:
+                interrupted.add(i)
+                raise
+
+    job_ledger.run_regions(LEDGER_STAGE, region_ids, convert, ledger)
+
+def convert_region(region_id: int, collection, target_collection, clean: bool = False):
+    """
+    Converts the region nodes into the target collection
+    :param clean: remove the region nodes of the target collection first, e.g. left by an interrupted attempt,
+    otherwise nodes already there are updated by region and id and keep the fields other stages wrote, e.g. landuse
+    :return: number of converted nodes
+    """
+    if clean:
+        result = target_collection.delete_many({"region_id": region_id})
+        if result.deleted_count != 0:
+            log.info(f"Removed {result.deleted_count} nodes of an earlier attempt")
+    elif target_collection.find_one({"region_id": region_id}, {"_id": 1}) is None:
+        clean = True
+    docs = 0
+    for region_nodes in iterate_over_region(region_id, collection):
+        if clean:
+            send_to_db(region_nodes, target_collection)
+        else:
+            upsert_to_db(region_nodes, target_collection)
+        docs = docs + len(region_nodes)
+    return docs
 
 def iterate_over_region(region_id: int, collection):
-    final_nodes_list = []
-    cursor = collection.find({"region_id": region_id})
-    data_nodes = list(cursor)
-    if len(data_nodes)!=0:
+    """
+    Converts lon and lat of the region nodes into a coordinates array, batch by batch
+    :return: generator of lists of converted nodes, each within the memory budget
+    """
+    for data_nodes in db_connection.stream(collection, {"region_id": region_id}, doc_bytes=NODE_BYTES):
+        metrics.count("docs_read", len(data_nodes))
         for element in data_nodes:
             element["coordinates"] = [element["lon"], element["lat"]]
             element.pop("lon")
             element.pop("lat")
-            final_nodes_list.append(element)
 
-        return final_nodes_list
-    else:
-        return 0
+        yield data_nodes
 
 def send_to_db(data_to_send: list, collection):
 
     collection.insert_many(data_to_send)
+    metrics.count("docs_written", len(data_to_send))
+
+def upsert_to_db(data_to_send: list, collection):
+    """
+    Sets the converted fields of nodes already in the collection, matched by region and id, and inserts the others
+    """
+    requests = [UpdateOne({"id": element["id"], "region_id": element["region_id"]}, {"$set": {k: v for k, v in element.items() if k != "_id"}},
+                          upsert=True) for element in data_to_send]
+    collection.bulk_write(requests, ordered=False)
+    metrics.count("docs_written", len(data_to_send))
 
 
 if __name__ == "__main__":
-    connect('localhost', 27017)
\ No newline at end of file
+    connect()
+    metrics.write_report("create_geo_array_nodes")
\ No newline at end of file
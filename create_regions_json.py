@@ -1,8 +1,7 @@
 import pathlib as p
 import logging as log
-from pymongo import MongoClient
-from pymongo.errors import OperationFailure
 import json
+import db_connection
 
 
 log.getLogger().setLevel(log.INFO)
@@ -18,7 +17,7 @@ def iterate_region_list(region_fname: str, neighbour_dict: dict, all_region_numb
             neighbour_numbers = get_neighbour_number_list(region_name, neighbour_dict, all_region_numbers)
             region_list = create_json(region_name, region_numbers[region_name], neighbour_numbers)
             all_regions.extend(region_list)
-            insert_to_db("localhost", 27017, "regions", region_list)
+            insert_to_db("regions", region_list)
     log.info(f"Regiony {all_regions}")
     save_file("all_regions_file", all_regions)
 
@@ -39,31 +38,22 @@ def create_json(region_name: str, count: int, neighbour_nums: list):
             379729638
         ]
     }"""
-    way_ids = get_ways_id('localhost', 27017, count, 'ways')
+    way_ids = get_ways_id(count, 'ways')
 
     return [{"id": count, "name": region_name, "ways": way_ids, "neighbours": neighbour_nums}]
 
-def get_ways_id(host: str, port: int, region_id: int, collection: str):
+def get_ways_id(region_id: int, collection: str):
+    db = db_connection.get_db()
+    current_collection = db[collection]
 
-    connection = MongoClient(host, port)
-    try:
-        connection.server_info()
-        log.info(f"Connected successfully")
-    except OperationFailure:
-        log.error(f"Could not connect to db")
+    query = {"region_id": region_id}
+    attributes = {"id": 1, "_id": 0}
+    cursor = current_collection.find(query, attributes)
+    way_ids = []
+    for doc in cursor:
+        way_ids.append(doc["id"])
 
-    with connection:
-        db = connection.Poland_spatial_data
-        current_collection = db[collection]
-
-        query = {"region_id": region_id}
-        attributes = {"id": 1, "_id": 0}
-        cursor = current_collection.find(query, attributes)
-        way_ids = []
-        for doc in cursor:
-            way_ids.append(doc["id"])
-
-        return way_ids
+    return way_ids
 
 def save_file(fname: str, file: list) -> None:
 
@@ -73,19 +63,10 @@ def save_file(fname: str, file: list) -> None:
         json.dump(file, written_file)
     log.info(f"Data for {fname} saved correctly")
 
-def insert_to_db(host: str, port: int, collection: str, doc: dict) -> None:
-
-    connection = MongoClient(host, port)
-    try:
-        connection.server_info()
-        log.info(f"Connected successfully")
-    except OperationFailure:
-        log.error(f"Could not connect to db")
-
-    with connection:
-        db = connection.Poland_spatial_data
-        current_collection = db[collection]
-        current_collection.insert(doc)
+def insert_to_db(collection: str, doc: dict) -> None:
+    db = db_connection.get_db()
+    current_collection = db[collection]
+    current_collection.insert_one(doc)
 
 def get_neighbour_list(file_name: str):
 
@@ -1,6 +1,21 @@
-import json
+import collections
+import logging as log
+import os
+import threading
+import time
+import numpy as np
 import pandas as pd
 import pathlib as p
+import region_store
+
+log.getLogger().setLevel(log.INFO)
+log.basicConfig(format="%(asctime)s - [%(levelname)s]: %(message)s", datefmt="%H:%M:%S")
+
+JSON_FOLDER_PATH: p.Path = p.Path(os.environ.get("MGR_REGION_FILES",
+                                                 '/Users/Olga/PycharmProjects/MGR_Project/MGR/region_data_files'))
+CACHE_MB = float(os.environ.get("MGR_DASH_CACHE_MB", 512)) # memory cap of the voivodeship frames
+MAX_RAW_POINTS = 20000 # nodes in the viewport sent to the map as points, above it they are aggregated
+CELLS_PER_TILE = 32 # grid cells across one 256 px map tile, about 8 px per cell at any zoom
 
 
 def read_voivodeship_data(file_name: str):
@@ -24,39 +39,185 @@ def read_voivodeship_data(file_name: str):
 
 def read_json_file(region_name:str):
     """
-    Loads nodal data for chosen region
+    Loads nodal data for chosen region, from its region_store copy when there is an up to date one
     :param region_name: name of the region for which to extract data
     :param folder_name: directory where all the json files are contained
     :return: DataFrame of nodal data for chosen region
     """
 
-    json_folder_path: p.Path = p.Path('/Users/Olga/PycharmProjects/MGR_Project/MGR/region_data_files')
+    json_folder_path: p.Path = JSON_FOLDER_PATH
     #print(json_folder_path)
-    region_file_path: p.Path = json_folder_path.joinpath(f"{region_name}.json")
 
-    with region_file_path.open(mode="r", encoding="utf-8-sig") as read_file:
-        file = json.load(read_file)
-
-    df = pd.DataFrame(file["nodes"])
+    df = region_store.region_frame(region_name, str(json_folder_path))
 
     return df
 
 
 def get_data_voivodeship(voivodeship_name: str, voivodeships_dict: dict ):
+    """
+    Nodal data of all regions of the voivodeship, built once and then served from the frame cache
+    :return: DataFrame with lon, lat, landuse_code and closest_distance_restriction columns
+    """
+    regions = voivodeships_dict[voivodeship_name]
+    return frame_cache.get(voivodeship_name, files_signature(regions), lambda: build_voivodeship_frame(regions))
+
+
+def files_signature(regions: list):
+    """
+    Modification time and size of every region file, a frame built for another signature is stale
+    """
+    signature = []
+    for region in regions:
+        region_file_path: p.Path = JSON_FOLDER_PATH.joinpath(f"{region}.json")
+        if region_file_path.exists():
+            stat = region_file_path.stat()
+            signature.append((region, stat.st_mtime_ns, stat.st_size))
+        else:
+            signature.append((region, None, None))
+    return tuple(signature)
+
+
+def build_voivodeship_frame(regions: list):
+    """
+    Reads the columns of every region and concatenates them once, landuse is kept as its integer code
+    """
+    columns = {"lon": [], "lat": [], "landuse_code": [], "closest_distance_restriction": []}
+    for region in regions:
+        try:
+            region_columns = region_store.load_region(region, str(JSON_FOLDER_PATH))
+        except FileNotFoundError:
+            log.warning(f"No data file for {region}")
+            continue
+        columns["lon"].append(region_columns["lon"])
+        columns["lat"].append(region_columns["lat"])
+        columns["landuse_code"].append(region_columns["landuse"])
+        columns["closest_distance_restriction"].append(region_columns["closest_distance_restriction"])
+
+    dtypes = {"lon": np.float64, "lat": np.float64, "landuse_code": np.uint8, "closest_distance_restriction": np.float64}
+    return pd.DataFrame({name: np.concatenate(values) if len(values) != 0 else np.empty(0, dtype=dtypes[name])
+                         for name, values in columns.items()})
+
+
+class FrameCache:
+    """
+    Least recently used DataFrames kept within a memory cap, each stored with the signature of its source files
+
+    Attributes:
+        max_bytes (int): memory cap, the least recently used frames are dropped above it
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._frames = collections.OrderedDict()
+        self._lock = threading.Lock()
+        # one build at a time, a callback asking for the frame being warmed up waits for it instead of reading twice
+        self._build_lock = threading.Lock()
+
+    def _lookup(self, key, signature):
+        with self._lock:
+            entry = self._frames.get(key)
+            if entry is not None and entry[0] == signature:
+                self._frames.move_to_end(key)
+                return entry[1]
+            return None
+
+    def get(self, key, signature, build):
+        """
+        :param signature: hashable description of the sources, e.g. files_signature
+        :param build: function creating the frame when it is missing or stale
+        """
+        frame = self._lookup(key, signature)
+        if frame is not None:
+            return frame
+        with self._build_lock:
+            frame = self._lookup(key, signature)
+            if frame is not None:
+                return frame
+            start = time.perf_counter()
+            frame = build()
+            log.info(f"Built data of {key}: {len(frame)} nodes in {time.perf_counter() - start:.2f} s")
+        self.put(key, signature, frame)
+        return frame
+
+    def put(self, key, signature, frame):
+        frame_bytes = int(frame.memory_usage(index=True).sum())
+        with self._lock:
+            self._frames[key] = (signature, frame, frame_bytes)
+            self._frames.move_to_end(key)
+            while len(self._frames) > 1 and self.nbytes() > self.max_bytes:
+                evicted, _ = self._frames.popitem(last=False)
+                log.info(f"Dropped cached data of {evicted}")
+
+    def nbytes(self):
+        return sum(entry[2] for entry in self._frames.values())
+
+
+frame_cache = FrameCache(int(CACHE_MB * 1024 * 1024))
+
+
+def warm_up(voivodeships_dict: dict, names: list = None):
+    """
+    Builds the voivodeship frames in a background thread, so the first dropdown changes are served from the cache
+    :param names: voivodeships to build, all by default
+    :return: the started thread
+    """
+    names = list(voivodeships_dict) if names is None else names
 
-    data_voivodeship = pd.DataFrame()
-    for region in voivodeships_dict[voivodeship_name]:
-        #print(f"Getting data for {region}")
-        df_region = read_json_file(region)
-        if type(df_region) != int:
-            #print(f"Len of data for {region} is {len(df_region)}")
-            data_voivodeship = pd.concat([data_voivodeship,df_region], ignore_index= True)
-        #else:
-        #    print(f"Dataframe for {region} is empty")
+    def build_all():
+        for name in names:
+            get_data_voivodeship(name, voivodeships_dict)
 
-        #if data_voivodeship.empty == False:
-        #    print(f"Length of voivodeship data after appending data from {region} is {len(data_voivodeship)}")
-    return  data_voivodeship
+    thread = threading.Thread(target=build_all, name="voivodeship-warm-up", daemon=True)
+    thread.start()
+    return thread
 
 
+def grid_cell_size(zoom: float, center_lat: float):
+    """
+    Cell size in degrees which keeps cells at the same size on screen at the given web mercator zoom
+    :return: longitude and latitude size of a cell
+    """
+    lon_size = 360. / 2 ** zoom / CELLS_PER_TILE
+    return lon_size, lon_size * np.cos(np.radians(center_lat))
+
 
+def viewport_nodes(frame, bounds: list = None):
+    """
+    :param bounds: [min_lon, min_lat, max_lon, max_lat] of the map, every node when None
+    """
+    if bounds is None:
+        return frame
+    lon, lat = frame["lon"].values, frame["lat"].values
+    mask = (lon >= bounds[0]) & (lon <= bounds[2]) & (lat >= bounds[1]) & (lat <= bounds[3])
+    return frame[mask]
+
+
+def aggregate_nodes(frame, zoom: float, bounds: list = None, max_points: int = MAX_RAW_POINTS):
+    """
+    Nodes of the viewport as points when there are at most max_points of them, grid cells sized to the zoom
+    otherwise, so the figure holds at most about one cell per 8x8 screen pixels whatever the size of the data
+    :param frame: DataFrame with lon, lat and closest_distance_restriction, see get_data_voivodeship
+    :return: "points" and the nodes, or "cells" and a DataFrame with the lon and lat of the cell centers, the count
+    of nodes and their mean_distance
+    """
+    nodes = viewport_nodes(frame, bounds)
+    if len(nodes) <= max_points:
+        return "points", nodes
+
+    lon, lat = nodes["lon"].values, nodes["lat"].values
+    center_lat = (bounds[1] + bounds[3]) / 2 if bounds is not None else float(lat.mean())
+    lon_size, lat_size = grid_cell_size(zoom, center_lat)
+    columns = np.floor(lon / lon_size).astype(np.int64)
+    rows = np.floor(lat / lat_size).astype(np.int64)
+    # one integer key per cell, a 1-D unique is much faster than a unique over rows
+    first_row = rows.min()
+    height = rows.max() - first_row + 1
+    cells, inverse = np.unique(columns * height + (rows - first_row), return_inverse=True)
+    inverse = inverse.reshape(-1)
+    counts = np.bincount(inverse, minlength=len(cells))
+    distances = np.bincount(inverse, weights=nodes["closest_distance_restriction"].values, minlength=len(cells))
+    cell_columns, cell_rows = np.divmod(cells, height)
+
+    return "cells", pd.DataFrame({"lon": (cell_columns + 0.5) * lon_size,
+                                  "lat": (cell_rows + first_row + 0.5) * lat_size,
+                                  "count": counts, "mean_distance": distances / counts})
@@ -1,3 +1,5 @@
+import functools
+import os
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
@@ -6,11 +8,17 @@ import base64
 import plotly.express as px
 
 import dash_data_processing as extra
+import db_connection
+import map_tiles
+import region_summaries
+from power_results_cache import SETBACKS
 
 
 external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
 
 voivodeships = extra.read_voivodeship_data("/Users/Olga/PycharmProjects/MGR_Project/MGR/wojewodztwa.txt")
+if os.environ.get("MGR_DASH_WARM_UP", "1") == "1":
+    extra.warm_up(voivodeships)
 
 
 
@@ -66,32 +74,213 @@ app.layout = html.Div(
             value= 'województwo kujawsko-pomorskie'
         ),
     ]),
+    html.Div([
+        dcc.RadioItems(
+            id='view',
+            options=[{'label': 'Nodes of the voivodeship', 'value': 'nodes'},
+                     {'label': 'Tiles of Poland', 'value': 'tiles'}],
+            value='nodes',
+            labelStyle={'display': 'inline-block'}
+        ),
+        dcc.Checklist(
+            id='tile_layers',
+            options=[{'label': layer.replace('_', ' ').capitalize(), 'value': layer} for layer in map_tiles.LAYERS],
+            value=['buildable'],
+            labelStyle={'display': 'inline-block'}
+        ),
+    ]),
+    html.Div([
+        dcc.RadioItems(
+            id='color_by',
+            options=[{'label': 'Number of nodes', 'value': 'count'},
+                     {'label': 'Mean distance to restriction', 'value': 'mean_distance'}],
+            value='count',
+            labelStyle={'display': 'inline-block'}
+        ),
+    ]),
     html.Div([
         dcc.Graph(id='map_plot')
     ], style={'width': '100%', 'display': 'inline-block', 'padding': '0 20'}),
 
+    html.H3(children="Buildable area and power per powiat"),
+    html.Div([
+        dcc.RadioItems(
+            id='results_metric',
+            options=[{'label': 'Overall power', 'value': 'overall_power'},
+                     {'label': 'Overall area', 'value': 'overall_area'}],
+            value='overall_power',
+            labelStyle={'display': 'inline-block'}
+        ),
+        # only the minimal powers get_power_areas wrote results for, see update_min_powers
+        dcc.Dropdown(id='results_min_power', value=30, clearable=False, style={'width': '200px'}),
+        dcc.Slider(
+            id='results_setback',
+            min=min(SETBACKS), max=max(SETBACKS), step=None, value=SETBACKS[0],
+            marks={setback: f"{setback} km" for setback in SETBACKS}
+        ),
+    ]),
+    html.Div([
+        dcc.Graph(id='results_map')
+    ], style={'width': '100%', 'display': 'inline-block', 'padding': '0 20'}),
+
 ])
 
+DEFAULT_ZOOM = 5.2
+DEFAULT_CENTER = dict(lat = 52.05, lon = 19.08)
+
+# tiles of all voivodeships served by the Flask server of the app, the browser only fetches the visible ones
+map_tiles.register(app.server, lambda: map_tiles.voivodeships_source(voivodeships))
+
+
 @app.callback(
     dash.dependencies.Output('map_plot', 'figure'),
-    [dash.dependencies.Input('menu', 'value')])
-def update_graph(value):
+    [dash.dependencies.Input('menu', 'value'),
+     dash.dependencies.Input('color_by', 'value'),
+     dash.dependencies.Input('map_plot', 'relayoutData'),
+     dash.dependencies.Input('view', 'value'),
+     dash.dependencies.Input('tile_layers', 'value')])
+def update_graph(value, color_by, relayout_data, view, tile_layers):
+    triggered = [x['prop_id'] for x in dash.callback_context.triggered]
+    if 'menu.value' in triggered:
+        #the viewport of the previous voivodeship does not show the selected one, start from the whole map
+        relayout_data = None
+    if view == 'tiles':
+        #panning only loads tiles, the figure itself does not change
+        if triggered == ['map_plot.relayoutData']:
+            return dash.no_update
+        zoom, center, _ = map_viewport(relayout_data)
+        return plot_tiles_on_map(tile_layers, zoom, center)
     data_to_plot = extra.get_data_voivodeship(value, voivodeships)
-    return plot_data_on_map(data_to_plot)
+    zoom, center, bounds = map_viewport(relayout_data)
+    kind, data = extra.aggregate_nodes(data_to_plot, zoom, bounds)
+    return plot_data_on_map(data, kind, color_by, zoom, center, value)
+
+def map_viewport(relayout_data):
+    """
+    :param relayout_data: relayoutData of the map, None before the first pan or zoom
+    :return: zoom, center and [min_lon, min_lat, max_lon, max_lat] of the visible map, None when not known yet
+    """
+    relayout_data = relayout_data or {}
+    zoom = relayout_data.get('mapbox.zoom', DEFAULT_ZOOM)
+    center = relayout_data.get('mapbox.center', DEFAULT_CENTER)
+    corners = relayout_data.get('mapbox._derived', {}).get('coordinates')
+    bounds = None
+    if corners:
+        lons, lats = [x[0] for x in corners], [x[1] for x in corners]
+        bounds = [min(lons), min(lats), max(lons), max(lats)]
+    return zoom, center, bounds
+
+@functools.lru_cache(maxsize=1)
+def results_data():
+    """
+    Per region results and simplified powiat boundaries, loaded on the first use only. Results are read from the
+    file named by MGR_RESULTS_FILE, e.g. a get_power_areas dry run, or from the regions collection
+    """
+    results_file = os.environ.get("MGR_RESULTS_FILE")
+    if results_file:
+        summaries = region_summaries.load_results_file(results_file)
+    else:
+        summaries = region_summaries.load_region_summaries(db_connection.get_db())
+    return summaries, region_summaries.load_boundaries()
 
-def plot_data_on_map(data):
 
-    lon, lat = data['lon'].values, data['lat'].values
-    fig = px.scatter_mapbox(lat = lat, lon = lon, color_discrete_sequence= ["cadetblue"],
-                            zoom=5.2, height=600)
+@app.callback(
+    [dash.dependencies.Output('results_min_power', 'options'),
+     dash.dependencies.Output('results_min_power', 'value')],
+    [dash.dependencies.Input('results_setback', 'value')],
+    [dash.dependencies.State('results_min_power', 'value')])
+def update_min_powers(setback, min_power):
+    """
+    Minimal powers with results for the setback, the chosen one is kept when it has results
+    """
+    summaries, _ = results_data()
+    min_powers = sorted(summaries.loc[summaries['min_distance'] == setback, 'min_allowable_power'].unique().tolist())
+    if min_power not in min_powers:
+        min_power = min_powers[0] if len(min_powers) != 0 else None
+    return [{'label': f"{x} MW", 'value': x} for x in min_powers], min_power
+
+
+@app.callback(
+    dash.dependencies.Output('results_map', 'figure'),
+    [dash.dependencies.Input('results_setback', 'value'),
+     dash.dependencies.Input('results_metric', 'value'),
+     dash.dependencies.Input('results_min_power', 'value')])
+def update_results_map(setback, metric, min_power):
+    summaries, boundaries = results_data()
+    selected = summaries[(summaries['min_distance'] == setback) &
+                         (summaries['min_allowable_power'] == min_power)]
+    return plot_results_on_map(selected, boundaries, metric)
+
+def plot_results_on_map(results, boundaries, metric):
+    """
+    :param results: region summaries of one setback and minimal power, see region_summaries.SUMMARY_COLUMNS
+    :param boundaries: GeoJSON of region_summaries.load_boundaries, regions are shown as points without it
+    """
+    labels = {'overall_power': 'Power [MW]', 'overall_area': 'Area [km2]'}
+    if boundaries is None:
+        fig = px.scatter_mapbox(lat = [], lon = [], zoom=DEFAULT_ZOOM, height=600)
+    else:
+        fig = px.choropleth_mapbox(results, geojson = boundaries, locations = 'region_id',
+                                   featureidkey = 'properties.id', color = metric, hover_name = 'name',
+                                   hover_data = ['overall_power', 'overall_area', 'node_number'],
+                                   labels = labels, color_continuous_scale = "Viridis",
+                                   zoom=DEFAULT_ZOOM, height=600)
+        fig.update_traces(marker_line_width = 0.3)
+    fig.update_layout(mapbox_style = "carto-positron")
+    fig.update_layout(margin={"r": 200, "t": 20, "l": 200, "b": 20})
+    fig.update_layout(autosize = True,
+                      uirevision = 'results',
+                    mapbox = dict (
+                            bearing = 0,
+                            center = DEFAULT_CENTER,
+                            pitch = 0))
+
+    return fig
+
+def plot_tiles_on_map(tile_layers, zoom, center):
+    """
+    Empty map with the raster tile layers of map_tiles
+    """
+    source = map_tiles.voivodeships_source(voivodeships)
+    fig = px.scatter_mapbox(lat = [], lon = [], zoom=zoom, height=600)
+    fig.update_layout(mapbox_style = "carto-positron")
+    fig.update_layout(margin={"r": 200, "t": 20, "l": 200, "b": 20})
+    fig.update_layout(autosize = True,
+                      uirevision = 'tiles',
+                    mapbox = dict (
+                            bearing = 0,
+                            center = center,
+                            zoom = zoom,
+                            pitch = 0,
+                            layers = [dict(sourcetype = "raster", below = "traces",
+                                           source = [map_tiles.tile_url(source, layer)])
+                                      for layer in tile_layers]))
+
+    return fig
+
+def plot_data_on_map(data, kind, color_by, zoom, center, voivodeship):
+    """
+    :param kind: points for single nodes, cells for the grid of extra.aggregate_nodes
+    :param color_by: count or mean_distance, used for cells
+    """
+    if kind == 'points':
+        fig = px.scatter_mapbox(lat = data['lat'].values, lon = data['lon'].values,
+                                color_discrete_sequence= ["cadetblue"], zoom=zoom, height=600)
+    else:
+        fig = px.scatter_mapbox(data, lat = 'lat', lon = 'lon', color = color_by,
+                                hover_data = ['count', 'mean_distance'],
+                                color_continuous_scale = "Viridis", zoom=zoom, height=600)
+        fig.update_traces(marker = dict(size = 8))
     fig.update_layout(mapbox_style = "carto-positron")
     fig.update_layout(margin={"r": 200, "t": 20, "l": 200, "b": 20})
     fig.update_layout(autosize = True,
                       hovermode='closest',
+                      # keeps the user's pan and zoom when the data changes, reset for another voivodeship
+                      uirevision = voivodeship,
                     mapbox = dict (
                             bearing = 0,
-                            center = dict( lat = 52.05,
-                                           lon = 19.08),
+                            center = center,
+                            zoom = zoom,
                             pitch = 0))
 
     return fig
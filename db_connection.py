@@ -0,0 +1,175 @@
+import functools
+import json
+import logging as log
+import os
+import pathlib as p
+
+from pymongo import MongoClient, ReadPreference
+from pymongo.errors import OperationFailure
+from pymongo.read_concern import ReadConcern
+from pymongo.write_concern import WriteConcern
+
+import mongo_profiler
+
+log.getLogger().setLevel(log.INFO)
+log.basicConfig(format="%(asctime)s - [%(levelname)s]: %(message)s", datefmt="%H:%M:%S")
+
+CONFIG_FILE = os.environ.get("MGR_DB_CONFIG", "db_config.json")
+DEFAULT_CONFIG = {
+    "uri": "mongodb://localhost:27017",
+    "database": "Poland_spatial_data",
+    "max_pool_size": 20,
+    "min_pool_size": 1,
+    "tls_allow_invalid_certificates": False,
+    # memory a stage may spend on documents read from one cursor, MB
+    "memory_budget_mb": 256,
+}
+# (write concern, read concern, read preference) per kind of stage
+PRESETS = {
+    "default": (None, None, None),
+    # large inserts and updates of nodes which can be redone, acknowledged by the primary only
+    "bulk": (WriteConcern(w=1, j=False), ReadConcern("local"), None),
+    # final results read by the dashboard
+    "results": (WriteConcern(w="majority", j=True), ReadConcern("majority"), None),
+    # read only scans which may be served by a secondary
+    "read": (None, ReadConcern("local"), ReadPreference.SECONDARY_PREFERRED),
+}
+
+_database_override = None
+
+
+@functools.lru_cache(maxsize=None)
+def read_config():
+    """
+    Reads the connection settings, starting from DEFAULT_CONFIG, then the JSON config file (MGR_DB_CONFIG,
+    ./db_config.json by default) and finally the MGR_MONGO_URI and MGR_MONGO_DB environment variables. Read once
+    per process, batch_size and get_db call it for every batch and collection
+    """
+    config = dict(DEFAULT_CONFIG)
+    config_path: p.Path = p.Path.cwd().joinpath(CONFIG_FILE)
+    if config_path.exists():
+        with config_path.open(mode="r", encoding="utf-8") as read_file:
+            config.update(json.load(read_file))
+    if os.environ.get("MGR_MONGO_URI"):
+        config["uri"] = os.environ["MGR_MONGO_URI"]
+    if os.environ.get("MGR_MONGO_DB"):
+        config["database"] = os.environ["MGR_MONGO_DB"]
+    if os.environ.get("MGR_MEMORY_BUDGET_MB"):
+        config["memory_budget_mb"] = float(os.environ["MGR_MEMORY_BUDGET_MB"])
+    return config
+
+
+@functools.lru_cache(maxsize=None)
+def get_client():
+    """
+    The MongoClient shared by the whole process, created on first use. The client keeps a connection pool,
+    so TLS and handshake cost is paid once per process and not once per region
+    """
+    config = read_config()
+    mongo_profiler.enable_from_env()
+
+    options = {"maxPoolSize": config["max_pool_size"], "minPoolSize": config["min_pool_size"],
+               "retryWrites": True, "retryReads": True}
+    if config["tls_allow_invalid_certificates"]:
+        options["tlsAllowInvalidCertificates"] = True
+
+    log.info(f"Connecting to the database")
+    client = MongoClient(config["uri"], **options)
+    try:
+        client.server_info()
+        log.info(f"Connected successfully")
+    except OperationFailure:
+        log.error(f"Could not connect to db")
+
+    return client
+
+
+def get_db():
+    if _database_override is not None:
+        return _database_override
+    return get_client()[read_config()["database"]]
+
+
+def get_collection(name: str, preset: str = "default"):
+    """
+    :param name: collection name
+    :param preset: one of PRESETS, sets write concern, read concern and read preference for the kind of stage
+    """
+    collection = get_db()[name]
+    write_concern, read_concern, read_preference = PRESETS[preset]
+    if write_concern is None and read_concern is None and read_preference is None:
+        return collection
+    return collection.with_options(write_concern=write_concern, read_concern=read_concern,
+                                   read_preference=read_preference)
+
+
+def batch_size(doc_bytes: int, min_size: int = 100, max_size: int = 50000):
+    """
+    Number of documents read at once so that one batch stays within the memory budget
+    :param doc_bytes: approximate size of one document once decoded to Python objects
+    """
+    budget_bytes = read_config()["memory_budget_mb"] * 1024 * 1024
+    return int(max(min_size, min(max_size, budget_bytes // doc_bytes)))
+
+
+def stream(collection, query: dict, projection: dict = None, doc_bytes: int = 1024, **kwargs):
+    """
+    Reads the query results in batches sized by the memory budget, the driver fetches the same number of
+    documents per round trip. Only one batch is held at a time when the caller does not keep them
+    :param doc_bytes: approximate size of one decoded document, see batch_size
+    :param kwargs: other arguments of find, e.g. sort
+    :return: generator of lists of documents
+    """
+    size = batch_size(doc_bytes)
+    cursor = collection.find(query, projection, batch_size=size, **kwargs)
+    return iterate_batches(cursor, size)
+
+
+def stream_pages(collection, query: dict, projection: dict = None, doc_bytes: int = 1024, **kwargs):
+    """
+    Same as stream, but every batch is read by its own query starting after the last _id of the previous one, so
+    no cursor is left open, and timed out by the server, while the caller spends long on a batch. Documents updated
+    by the caller are not read again
+    :param kwargs: other arguments of find, except sort and limit
+    :return: generator of lists of documents in _id order
+    """
+    size = batch_size(doc_bytes)
+    keep_id = projection is None or projection.get("_id", 1) != 0
+    if projection is not None:
+        projection = {k: v for k, v in projection.items() if k != "_id"} or None
+    last_id = None
+    while True:
+        page_query = query if last_id is None else {"$and": [query, {"_id": {"$gt": last_id}}]}
+        batch = list(collection.find(page_query, projection, sort=[("_id", 1)], limit=size, **kwargs))
+        if len(batch) == 0:
+            return
+        last_id = batch[-1]["_id"]
+        if not keep_id:
+            for document in batch:
+                document.pop("_id")
+        yield batch
+        if len(batch) < size:
+            return
+
+
+def iterate_batches(cursor, size: int):
+    """
+    Groups the documents of a cursor (or any iterable) into lists of size documents
+    """
+    batch = []
+    for document in cursor:
+        batch.append(document)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if len(batch) != 0:
+        yield batch
+
+
+def use_database(db):
+    """
+    Makes get_db and get_collection return the given database, e.g. an in-process stand-in used by benchmarks.
+    None goes back to the configured database
+    """
+    global _database_override
+    _database_override = db
@@ -0,0 +1,347 @@
+import argparse
+import hashlib
+import importlib
+import json
+import logging as log
+import os
+import pathlib as p
+import random
+import sqlite3
+import threading
+import time
+
+log.getLogger().setLevel(log.INFO)
+log.basicConfig(format="%(asctime)s - [%(levelname)s]: %(message)s", datefmt="%H:%M:%S")
+
+LEDGER_FILE = os.environ.get("MGR_JOB_LEDGER", "job_ledger.sqlite")
+MAX_ATTEMPTS = 4 # attempts of one region in one run
+BACKOFF_SECONDS = 30. # wait before the first retry, doubled for every next one
+MAX_BACKOFF_SECONDS = 600.
+REGION_IDS = list(range(1, 381)) # ids of the regions collection
+# stage -> stages writing the documents it reads for the same region. A region done again upstream gets another
+# input hash downstream, see chained_inputs, so the stages after it are done again for that region
+UPSTREAM = {
+    "add_ways_to_node": ["create_geo_array_nodes"],
+    "process_nodes": ["add_ways_to_node"],
+    "get_power_areas": ["process_nodes"],
+    "db_operations.get_nodes_from_way": ["create_geo_array_nodes"],
+    "temporary.get_nodes_from_way": ["create_geo_array_nodes"],
+}
+# stage -> module registering its inputs, see register_inputs, when it is not the part of the stage name before a dot
+STAGE_MODULES = {"process_nodes": "restriction_index", "fetch": "region_pipeline", "parse": "region_pipeline",
+                 "load": "region_pipeline", "enrich": "region_pipeline", "distance": "region_pipeline",
+                 "power": "region_pipeline"}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    stage TEXT NOT NULL,
+    region TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    input_hash TEXT,
+    started REAL,
+    finished REAL,
+    seconds REAL,
+    error TEXT,
+    PRIMARY KEY (stage, region)
+)
+"""
+
+
+def input_hash(*values):
+    """
+    Hash of the inputs of a stage, e.g. the landuse policy or file signatures, a region done with other inputs is
+    done again
+    :param values: JSON serializable values
+    """
+    return hashlib.sha256(json.dumps(values, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:16]
+
+
+def file_signature(file_paths: list):
+    """Names, sizes and modification times of the files, cheap enough to compute before every job"""
+    return [[p.Path(x).name, p.Path(x).stat().st_size, p.Path(x).stat().st_mtime] if p.Path(x).exists() else
+            [p.Path(x).name, None, None] for x in file_paths]
+
+
+def backoff_delay(attempt: int, backoff: float = BACKOFF_SECONDS):
+    """
+    Seconds to wait before the next attempt, doubled after every failed attempt, with jitter so regions failed
+    together, e.g. by a rate limit, are not retried together
+    """
+    return min(backoff * 2 ** (attempt - 1), MAX_BACKOFF_SECONDS) * random.uniform(0.5, 1.)
+
+
+class JobLedger:
+    """
+    Status of every (stage, region) job in a local SQLite file, so loops over regions resume where they stopped.
+    A job is running, done or failed, a crash leaves it running and it is done again on the next run. Regions are
+    stored as text, a region id or a file name
+
+    Attributes:
+        path (pathlib.Path): ledger file
+    """
+
+    def __init__(self, path: str = LEDGER_FILE):
+        self.path = p.Path(path)
+        self._connection = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(SCHEMA)
+        self._lock = threading.Lock()
+
+    def _execute(self, query: str, parameters: tuple = ()):
+        with self._lock:
+            return self._connection.execute(query, parameters).fetchall()
+
+    def job(self, stage: str, region):
+        """
+        :return: dictionary of the job columns, None when the job never ran
+        """
+        with self._lock:
+            cursor = self._connection.execute("SELECT * FROM jobs WHERE stage = ? AND region = ?", (stage, str(region)))
+            row = cursor.fetchone()
+            return dict(zip([x[0] for x in cursor.description], row)) if row is not None else None
+
+    def statuses(self, stage: str):
+        """
+        :return: dictionary region -> status of the jobs of the stage, regions as text
+        """
+        return dict(self._execute("SELECT region, status FROM jobs WHERE stage = ?", (stage,)))
+
+    def is_done(self, stage: str, region, inputs: str = None):
+        """
+        :param inputs: input hash of the job, a job done with other inputs is not done, None accepts any
+        """
+        job = self.job(stage, region)
+        return job is not None and job["status"] == "done" and (inputs is None or job["input_hash"] == inputs)
+
+    def pending(self, stage: str, regions: list, inputs=None):
+        """
+        :param inputs: input hash of the stage or function returning the input hash of one region, see is_done
+        :return: regions of the list which are not done, in the same order
+        """
+        done = dict(self._execute("SELECT region, input_hash FROM jobs WHERE stage = ? AND status = 'done'", (stage,)))
+        region_inputs = inputs if callable(inputs) else lambda region: inputs
+        return [x for x in regions
+                if str(x) not in done or (region_inputs(x) is not None and done[str(x)] != region_inputs(x))]
+
+    def start(self, stage: str, region, inputs: str = None):
+        self._execute("INSERT INTO jobs (stage, region, status, attempts, input_hash, started) "
+                      "VALUES (?, ?, 'running', 1, ?, ?) "
+                      "ON CONFLICT (stage, region) DO UPDATE SET status = 'running', attempts = attempts + 1, "
+                      "input_hash = excluded.input_hash, started = excluded.started, finished = NULL, seconds = NULL, "
+                      "error = NULL",
+                      (stage, str(region), inputs, time.time()))
+
+    def finish(self, stage: str, region, seconds: float):
+        self._execute("UPDATE jobs SET status = 'done', finished = ?, seconds = ? WHERE stage = ? AND region = ?",
+                      (time.time(), seconds, stage, str(region)))
+
+    def fail(self, stage: str, region, error: str, seconds: float):
+        self._execute("UPDATE jobs SET status = 'failed', finished = ?, seconds = ?, error = ? "
+                      "WHERE stage = ? AND region = ?", (time.time(), seconds, error, stage, str(region)))
+
+    def mark_done(self, stage: str, regions: list, inputs=None):
+        """
+        Records regions done outside of the ledger, e.g. by runs before the ledger existed
+        :param inputs: input hash of the stage or function returning the input hash of one region, stage_inputs by
+        default so the regions are not pending for the stage
+        """
+        region_inputs = inputs if callable(inputs) else lambda region: inputs
+        if inputs is None:
+            region_inputs = lambda region: stage_inputs(stage, region, self)
+        for region in regions:
+            self.start(stage, region, region_inputs(region))
+            self.finish(stage, region, 0.)
+
+    def reset(self, stage: str, regions: list = None):
+        """
+        Forgets the jobs of a stage, all of them or of the given regions, so they are done again
+        """
+        if regions is None:
+            self._execute("DELETE FROM jobs WHERE stage = ?", (stage,))
+        else:
+            for region in regions:
+                self._execute("DELETE FROM jobs WHERE stage = ? AND region = ?", (stage, str(region)))
+
+    def summary(self, stage: str = None):
+        """
+        :return: dictionary stage -> status -> number of jobs, total seconds and attempts
+        """
+        query = "SELECT stage, status, COUNT(*), SUM(seconds), SUM(attempts) FROM jobs"
+        rows = self._execute(query + (" WHERE stage = ?" if stage else "") + " GROUP BY stage, status",
+                             (stage,) if stage else ())
+        summary = {}
+        for stage_name, status, jobs, seconds, attempts in rows:
+            summary.setdefault(stage_name, {})[status] = {"jobs": jobs, "seconds": seconds or 0., "attempts": attempts}
+        return summary
+
+    def failed(self, stage: str):
+        """
+        :return: list of (region, attempts, error) of the failed jobs of the stage
+        """
+        return self._execute("SELECT region, attempts, error FROM jobs WHERE stage = ? AND status = 'failed' "
+                             "ORDER BY region", (stage,))
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+_ledger = None
+_ledger_lock = threading.Lock()
+_stage_inputs = {}
+
+
+def get_ledger():
+    """Ledger of LEDGER_FILE, opened once per process"""
+    global _ledger
+    with _ledger_lock:
+        if _ledger is None:
+            _ledger = JobLedger()
+        return _ledger
+
+
+def chained_inputs(stage: str, region, values=None, ledger: JobLedger = None):
+    """
+    Input hash of one region of a stage: its own values and the runs of its UPSTREAM stages for the region, which
+    change whenever an upstream stage is done again
+    :param values: JSON serializable values the stage depends on, see input_hash
+    """
+    ledger = ledger or get_ledger()
+    runs = []
+    for stage_before in UPSTREAM.get(stage, []):
+        job = ledger.job(stage_before, region)
+        done = job is not None and job["status"] == "done"
+        runs.append([job["input_hash"], job["attempts"], job["finished"]] if done else None)
+    return input_hash(values, runs)
+
+
+def register_inputs(stage: str, function):
+    """
+    Registers how a stage computes its input hash, so the done command records the hash the stage expects
+    :param function: called with one region and a ledger, returns the input hash of the region
+    """
+    _stage_inputs[stage] = function
+
+
+def stage_inputs(stage: str, region, ledger: JobLedger = None):
+    """
+    Input hash of one region as the stage computes it, the module of the stage is imported to register it
+    :return: None for stages without inputs, their regions are done whatever their input hash
+    """
+    if stage not in _stage_inputs:
+        module_name = STAGE_MODULES.get(stage, stage.split(".")[0])
+        try:
+            importlib.import_module(module_name)
+        except ModuleNotFoundError as error:
+            if error.name != module_name:
+                raise
+    if stage in _stage_inputs:
+        return _stage_inputs[stage](region, ledger)
+    return chained_inputs(stage, region, ledger=ledger) if stage in UPSTREAM else None
+
+
+def run_regions(stage: str, regions: list, function, ledger: JobLedger = None, inputs=None,
+                max_attempts: int = MAX_ATTEMPTS, backoff: float = BACKOFF_SECONDS, flush=None,
+                flush_every: int = 1):
+    """
+    Calls the function for every region not done yet. Failed regions are retried after the others, waiting
+    backoff_delay, until max_attempts
+    :param stage: name of the stage in the ledger, e.g. create_geo_array_nodes
+    :param regions: region ids or other job keys, e.g. file names
+    :param function: called with one region
+    :param inputs: input hash of the stage, see input_hash, or function returning the input hash of one region,
+    stage_inputs by default
+    :param flush: optional function writing what the function kept for the regions since the previous call, called
+    every flush_every regions and once no region is left. Regions are done only when flushed, all regions of a
+    failed flush are failed
+    :return: list of regions which still failed after max_attempts
+    """
+    ledger = ledger or get_ledger()
+    if inputs is None:
+        inputs = lambda region: stage_inputs(stage, region, ledger)
+    region_inputs = inputs if callable(inputs) else lambda region: inputs
+    waiting = ledger.pending(stage, regions, inputs)
+    log.info(f"Stage {stage}: {len(regions) - len(waiting)} of {len(regions)} regions already done")
+
+    attempts = {region: 0 for region in waiting}
+    retries = {}
+    given_up = []
+    unflushed = []
+
+    def fail(region, error: Exception, seconds: float):
+        ledger.fail(stage, region, repr(error), seconds)
+        if attempts[region] < max_attempts:
+            delay = backoff_delay(attempts[region], backoff)
+            retries[region] = time.time() + delay
+            log.exception(f"Stage {stage} failed for region {region}, retrying in {delay:.0f} s")
+        else:
+            given_up.append(region)
+            log.exception(f"Stage {stage} failed for region {region} {attempts[region]} times, giving up")
+
+    while len(waiting) != 0 or len(retries) != 0 or len(unflushed) != 0:
+        if len(unflushed) != 0 and (len(unflushed) >= flush_every or len(waiting) == 0):
+            start = time.perf_counter()
+            try:
+                flush()
+            except Exception as error:
+                for region, seconds in unflushed:
+                    fail(region, error, seconds + time.perf_counter() - start)
+            else:
+                for region, seconds in unflushed:
+                    ledger.finish(stage, region, seconds + time.perf_counter() - start)
+            unflushed.clear()
+            continue
+        if len(waiting) == 0:
+            time.sleep(max(min(retries.values()) - time.time(), 0))
+            now = time.time()
+            waiting.extend(sorted((x for x in retries if retries[x] <= now), key=retries.get))
+            for region in waiting:
+                retries.pop(region)
+        region = waiting.pop(0)
+        attempts[region] = attempts[region] + 1
+        ledger.start(stage, region, region_inputs(region))
+        start = time.perf_counter()
+        try:
+            function(region)
+        except Exception as error:
+            fail(region, error, time.perf_counter() - start)
+            continue
+        if flush is None:
+            ledger.finish(stage, region, time.perf_counter() - start)
+        else:
+            unflushed.append((region, time.perf_counter() - start))
+
+    if len(given_up) != 0:
+        log.error(f"Stage {stage}: {len(given_up)} regions failed: {given_up}")
+    return given_up
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Status of the job ledger")
+    parser.add_argument("command", choices=["status", "failed", "reset", "done"])
+    parser.add_argument("--stage")
+    parser.add_argument("--regions", nargs="*", help="regions to reset, all regions of the stage by default, or to "
+                                                     "mark done")
+    parser.add_argument("--inputs", help="input hash recorded by done, computed as the stage does by default")
+    args = parser.parse_args()
+    if args.command != "status" and args.stage is None:
+        parser.error(f"{args.command} needs --stage")
+
+    # stage modules register their inputs in the imported module, not in __main__
+    import job_ledger
+    ledger = job_ledger.get_ledger()
+    if args.command == "status":
+        for stage_name, statuses in sorted(ledger.summary(args.stage).items()):
+            for status, values in sorted(statuses.items()):
+                log.info(f"{stage_name:>30} {status:>8}: {values['jobs']:4d} regions, {values['seconds']:9.1f} s, "
+                         f"{values['attempts']} attempts")
+    elif args.command == "done":
+        ledger.mark_done(args.stage, args.regions or [], args.inputs)
+        log.info(f"Marked {len(args.regions or [])} regions of {args.stage} done")
+    elif args.command == "failed":
+        for region, region_attempts, region_error in ledger.failed(args.stage):
+            log.info(f"{region}: {region_attempts} attempts, {region_error}")
+    else:
+        ledger.reset(args.stage, args.regions)
+        log.info(f"Reset {args.stage} for {args.regions or 'all regions'}")
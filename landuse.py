@@ -0,0 +1,184 @@
+from pymongo import ASCENDING
+import logging as log
+import numpy as np
+import db_connection
+import job_ledger
+
+log.getLogger().setLevel(log.INFO)
+log.basicConfig(format="%(asctime)s - [%(levelname)s]: %(message)s", datefmt="%H:%M:%S")
+
+# classes of landuse, one bit each so a tag may belong to several classes
+ALLOWABLE = 1 # wind farms may be built on it
+RESTRICTING = 2 # wind farms must keep a distance from it
+
+# landuse tag -> (integer code stored on documents as landuse_code, classes). Codes must stay below 64 and must not
+# be reused for another tag, they are stored in the database; classes may be changed freely
+REGISTRY = {
+    "farmland": (1, ALLOWABLE),
+    "meadow": (2, ALLOWABLE),
+    "brownfield": (3, ALLOWABLE),
+    "orchard": (4, ALLOWABLE),
+    "grass": (5, ALLOWABLE),
+    "residential": (6, RESTRICTING),
+    "nature_reserve": (7, RESTRICTING),
+    "construction": (8, RESTRICTING),
+    "military": (9, RESTRICTING),
+}
+UNKNOWN_CODE = 0
+
+LANDUSE_CODES = {tag: code for tag, (code, _) in REGISTRY.items()}
+LANDUSE_NAMES = {code: tag for tag, code in LANDUSE_CODES.items()}
+
+
+def tags(landuse_class: int):
+    """
+    :param landuse_class: ALLOWABLE, RESTRICTING or both combined with |
+    :return: list of tags in any of the classes
+    """
+    return [tag for tag, (_, classes) in REGISTRY.items() if classes & landuse_class]
+
+
+def codes(landuse_class: int):
+    return [LANDUSE_CODES[tag] for tag in tags(landuse_class)]
+
+
+def code_mask(landuse_class: int):
+    """
+    :return: integer with bit n set for every code n in the classes
+    """
+    mask = 0
+    for code in codes(landuse_class):
+        mask = mask | (1 << code)
+    return mask
+
+
+def tag_code(tag: str):
+    return LANDUSE_CODES.get(tag, UNKNOWN_CODE)
+
+
+def is_class(tag: str, landuse_class: int):
+    return bool(code_mask(landuse_class) >> tag_code(tag) & 1)
+
+
+def class_mask(landuse_codes, landuse_class: int):
+    """
+    Vectorized membership test, one shift and one and per node
+    :param landuse_codes: array of codes, e.g. NodeStore.landuse
+    :return: boolean array
+    """
+    return (np.uint64(code_mask(landuse_class)) >> np.asarray(landuse_codes, dtype=np.uint64)) & np.uint64(1) == 1
+
+
+def code_filter(landuse_tags: list):
+    """
+    :return: query on the indexed landuse_code field matching the given tags
+    """
+    return {"landuse_code": {"$in": [tag_code(tag) for tag in landuse_tags]}}
+
+
+def overpass_filter(landuse_class: int = ALLOWABLE | RESTRICTING):
+    """
+    :return: tags joined for an Overpass regular expression, e.g. residential|nature_reserve
+    """
+    return "|".join(tags(landuse_class))
+
+
+ALLOWABLE_LANDUSE = tags(ALLOWABLE)
+RESTRICTING_LANDUSE = tags(RESTRICTING)
+ALLOWABLE_CODES = codes(ALLOWABLE)
+RESTRICTING_CODES = codes(RESTRICTING)
+# position of every code in the per-class distance vector, ordered as RESTRICTING_LANDUSE, -1 for other codes
+RESTRICTING_POSITIONS = np.full(64, -1, dtype=np.int64)
+RESTRICTING_POSITIONS[RESTRICTING_CODES] = np.arange(len(RESTRICTING_CODES))
+
+NO_RESTRICTION_DISTANCE = 4. # km, stored when no restricting node of a class is in the search window
+# minimal distance to each restricting class in km, the single setback applied by process_nodes
+DEFAULT_SETBACKS = {tag: 0.5 for tag in RESTRICTING_LANDUSE}
+
+
+def class_distances_document(minima):
+    """
+    :param minima: nearest distance per restricting class, ordered as RESTRICTING_LANDUSE, inf when none was found
+    :return: dictionary tag -> distance stored on nodes as class_distances
+    """
+    return {tag: float(value) if np.isfinite(value) else NO_RESTRICTION_DISTANCE
+            for tag, value in zip(RESTRICTING_LANDUSE, minima)}
+
+
+def is_buildable(class_distances: dict, setbacks: dict = None):
+    """
+    Buildability of one node under a setback policy, from its stored class_distances. A class missing from them
+    counts as NO_RESTRICTION_DISTANCE away, a node without class_distances is not processed yet and not buildable
+    :param setbacks: dictionary tag -> minimal distance in km, DEFAULT_SETBACKS when not given
+    """
+    if class_distances is None:
+        return False
+    setbacks = DEFAULT_SETBACKS if setbacks is None else setbacks
+    return all(class_distances.get(tag, NO_RESTRICTION_DISTANCE) >= distance for tag, distance in setbacks.items())
+
+
+def policy_filter(setbacks: dict):
+    """
+    :return: query matching the nodes buildable under the setback policy, as is_buildable
+    """
+    conditions = [{"class_distances": {"$exists": True}}]
+    for tag, distance in setbacks.items():
+        field = f"class_distances.{tag}"
+        if distance <= NO_RESTRICTION_DISTANCE:
+            conditions.append({"$or": [{field: {"$gte": distance}}, {field: {"$exists": False}}]})
+        else:
+            conditions.append({field: {"$gte": distance}})
+    return {"$and": conditions}
+
+
+def policy_distance(setbacks: dict):
+    """
+    :return: aggregation expression of the distance of a node to the closest restriction of the classes in the
+    setback policy, as is_buildable reads class_distances
+    """
+    return {"$min": [{"$ifNull": [f"$class_distances.{tag}", NO_RESTRICTION_DISTANCE]} for tag in setbacks]}
+
+
+def ensure_indexes(collection):
+    """
+    Indexes used by the queries filtering nodes by landuse code
+    """
+    collection.create_index([("region_id", ASCENDING), ("landuse_code", ASCENDING)])
+    collection.create_index([("landuse_code", ASCENDING)])
+
+
+def backfill_codes(collection):
+    """
+    Sets landuse_code on documents which have a landuse tag but no code or an outdated one, one update per tag
+    """
+    ensure_indexes(collection)
+    for tag, code in LANDUSE_CODES.items():
+        result = collection.update_many({"landuse": tag, "landuse_code": {"$ne": code}},
+                                        {"$set": {"landuse_code": code}})
+        log.info(f"Landuse code {code} set on {result.modified_count} {tag} nodes")
+
+
+BACKFILL_STAGE = "landuse.backfill_codes"
+
+
+def registry_inputs(collection_name: str = None, ledger=None):
+    """Input hash of the backfill, codes are set again when a tag gets another code"""
+    return job_ledger.input_hash(LANDUSE_CODES)
+
+
+job_ledger.register_inputs(BACKFILL_STAGE, registry_inputs)
+
+
+def ensure_codes(collection, ledger=None):
+    """
+    Prepares a collection for the queries on landuse_code, called at startup of the stages using them: creates the
+    indexes and backfills the codes of documents written before they existed, once per version of the registry
+    according to the job ledger. Stages writing landuse set the code with it
+    """
+    ensure_indexes(collection)
+    job_ledger.run_regions(BACKFILL_STAGE, [collection.name], lambda x: backfill_codes(collection), ledger,
+                           inputs=lambda x: registry_inputs(x))
+
+
+if __name__ == "__main__":
+    backfill_codes(db_connection.get_collection("testing_col", "bulk"))
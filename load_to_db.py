@@ -1,52 +1,76 @@
-from pymongo import MongoClient
-from pymongo.errors import OperationFailure
 import logging as log
-import time
+from pymongo import UpdateOne
+import db_connection
+import job_ledger
+import landuse
+import metrics
 import pathlib as p
 import os
 import json
 log.getLogger().setLevel(log.INFO)
 log.basicConfig(format="%(asctime)s - [%(levelname)s]: %(message)s", datefmt="%H:%M:%S")
 
+REGION_FOLDER = "region_data" # region files read by get_files, as region_data_generator.get_data_for_each_region
+UPDATE_FOLDER = "files_to_insert" # files applied by update_files
 
-def insert_to_collection(host: str, port: int, file:list, collection: str):
-    start = time.time()
-    log.info(f"Connecting to the database")
-    connection = MongoClient(host, port)
-    try:
-        connection.server_info()
-        log.info(f"Connected successfully")
-    except OperationFailure:
-        log.error(f"Could not connect to db")
 
-    with connection:
+def insert_to_collection(file:list, collection: str):
+    with metrics.stage("load_to_db.insert", collection=collection):
         log.info(f"Inserting data to {collection} collection")
-        db = connection.Poland_spatial_data
-        current_collection = db[collection]
+        current_collection = db_connection.get_collection(collection, "bulk")
         #current_collection.delete_many({})
         current_collection.insert_many(file)
+        metrics.count("docs_written", len(file))
         log.info(f"Data inserted successfully")
-        time.sleep(1)
-        end = time.time()
-        log.info(f"Process of inserting data took {end - start} seconds")
 
 def get_files(folder_name: str):
+    """
+    Inserts the nodes and ways files of every region not loaded yet according to the job ledger, a region is loaded
+    again when its files changed
+    """
     folder_path: p.Path = p.Path.cwd().joinpath(folder_name)
     if not folder_path.exists():
         log.error(f"The folder {folder_name} does not exist")
     else:
-        files = os.listdir(folder_path)
-        node_files = [x for x in files if "_nodes.json" in x]
-        way_files = [x for x in files if "_ways.json" in x]
+        region_names = sorted(x[:-len("_nodes.json")] for x in os.listdir(folder_path) if x.endswith("_nodes.json"))
+        job_ledger.run_regions("load_to_db", region_names, lambda x: load_region_files(folder_path, x),
+                               inputs=lambda x: region_inputs(x, folder_name=folder_name))
 
-        nodes_to_db = get_file_data(folder_path, node_files)
-        insert_to_collection('localhost', 27017, nodes_to_db, 'nodes')
-        ways_to_db = get_file_data(folder_path, way_files)
-        insert_to_collection('localhost', 27017, ways_to_db, 'ways')
+def region_files(folder_path: p.Path, region_name: str):
+    return [folder_path.joinpath(f"{region_name}_nodes.json"), folder_path.joinpath(f"{region_name}_ways.json")]
 
+def region_inputs(region_name: str, ledger=None, folder_name: str = REGION_FOLDER):
+    """Input hash of one region, the signatures of its files"""
+    folder_path: p.Path = p.Path.cwd().joinpath(folder_name)
+    return job_ledger.input_hash(job_ledger.file_signature(region_files(folder_path, region_name)))
+
+def file_inputs(file_name: str, ledger=None, folder_name: str = UPDATE_FOLDER):
+    """Input hash of one file applied by update_files, its signature"""
+    folder_path: p.Path = p.Path.cwd().joinpath(folder_name)
+    return job_ledger.input_hash(job_ledger.file_signature([folder_path.joinpath(file_name)]))
+
+job_ledger.register_inputs("load_to_db", region_inputs)
+job_ledger.register_inputs("load_to_db.update", file_inputs)
+
+def load_region_files(folder_path: p.Path, region_name: str):
+    """
+    Inserts the nodes and ways files of one region, documents of the region left by an interrupted attempt are
+    removed first
+    :return: number of inserted documents
+    """
+    docs = 0
+    for file_path, collection in zip(region_files(folder_path, region_name), ["nodes", "ways"]):
+        documents = get_file_data(folder_path, [file_path.name]) if file_path.exists() else []
+        region_ids = sorted({x["region_id"] for x in documents})
+        if len(region_ids) != 0:
+            db_connection.get_collection(collection, "bulk").delete_many({"region_id": {"$in": region_ids}})
+            insert_to_collection(documents, collection)
+        docs = docs + len(documents)
+    return docs
+
+@metrics.timed("load_to_db.read_files")
 def get_file_data(folder_path: p.Path, file_list: list):
     all_nodal_data = []
-    start = time.time()
     log.info(f"Reading file data")
     for element in file_list:
         file_path: p.Path = folder_path.joinpath(element)
@@ -61,38 +85,37 @@ def get_file_data(folder_path: p.Path, file_list: list):
             all_nodal_data = all_nodal_data + data
             #log.info(f"Length after inserting: {len(all_nodal_data)}")
     log.info(f"Data from files read successfully ")
-    time.sleep(1)
-    end = time.time()
-    log.info(f"Process of reading data took {end - start} seconds")
+    metrics.count("docs_read", len(all_nodal_data))
     return all_nodal_data
 
-def update_collection(host: str, port: int, file:list, collection: str):
-    start = time.time()
-    log.info(f"Connecting to the database")
-    connection = MongoClient(host, port)
-    try:
-        connection.server_info()
-        log.info(f"Connected successfully")
-    except OperationFailure:
-        log.error(f"Could not connect to db")
-
-    with connection:
+def update_collection(file:list, collection: str):
+    with metrics.stage("load_to_db.update", collection=collection):
         log.info(f"Inserting data to {collection} collection")
-        db = connection.Poland_spatial_data
-        current_collection = db[collection]
+        current_collection = db_connection.get_collection(collection, "bulk")
         #current_collection.delete_many({})
-        for element in file:
-            log.info(f"Way_id: {element['id']}")
-            current_collection.update({"id": element["id"]},
-                                          {"$set": {"landuse": element["landuse"],
-                                                    "way_id": element["way_id"]}},
-                                          upsert=False
-                                          )
+        requests = [UpdateOne({"id": element["id"]},
+                              {"$set": {"landuse": element["landuse"],
+                                        "landuse_code": landuse.tag_code(element["landuse"]),
+                                        "way_id": element["way_id"]}},
+                              upsert=False)
+                    for element in file]
+        if len(requests) != 0:
+            current_collection.bulk_write(requests, ordered=False)
 
+        metrics.count("docs_written", len(file))
         log.info(f"Data updated successfully")
-        time.sleep(1)
-        end = time.time()
-        log.info(f"Process of inserting data took {end - start} seconds")
+
+def update_files(folder_name: str, collection: str = "testing_col"):
+    """
+    Updates the collection from every JSON file of the folder, e.g. filtered_output_200_250.json, skipping files
+    already applied according to the job ledger unless they changed
+    """
+    folder_path: p.Path = p.Path.cwd().joinpath(folder_name)
+    file_names = sorted(x for x in os.listdir(folder_path) if x.endswith(".json"))
+    landuse.ensure_codes(db_connection.get_collection(collection))
+    job_ledger.run_regions("load_to_db.update", file_names,
+                           lambda x: update_collection(read_json(str(folder_path.joinpath(x))), collection),
+                           inputs=lambda x: file_inputs(x, folder_name=folder_name))
 
 def read_json(f_name: str):
     with open(f_name) as json_read:
@@ -101,6 +124,6 @@ def read_json(f_name: str):
     return data
 
 if __name__ == "__main__":
-    #get_files("region_data")
-    data_update = read_json("C:/Users/Mongo/PycharmProjects/MGR_scripts/MGR/files_to_insert/filtered_output_200_250.json")
-    update_collection("localhost", 27017, data_update, "testing_col")
\ No newline at end of file
+    #get_files(REGION_FOLDER)
+    update_files(UPDATE_FOLDER)
+    metrics.write_report("load_to_db")
\ No newline at end of file
@@ -6,6 +6,7 @@ from typing import List, TypedDict
 import math
 import glob
 import errno
+import landuse
 
 log.getLogger().setLevel(log.INFO)
 log.basicConfig(format="%(asctime)s - [%(levelname)s]: %(message)s", datefmt="%H:%M:%S")
@@ -233,10 +234,10 @@ def add_usage_tag(data_nodes: List[Node]):
     :return data_nodes:
     """
 
-    restrictions = get_filtered_nodes(data_nodes, ['residential', 'nature_reserve'], 'landuse')
+    restrictions = get_filtered_nodes(data_nodes, landuse.RESTRICTING_LANDUSE, 'landuse')
 
     for Node in data_nodes:
-        if Node['landuse'] in ['residential', 'nature_reserve']:
+        if landuse.is_class(Node['landuse'], landuse.RESTRICTING):
             Node['filter_tag'] = 0
         else:
             #look for the nearest node that constraints the windfarm, meaning that the distance is below 1.56 km
@@ -0,0 +1,207 @@
+import hashlib
+import logging as log
+import math
+import os
+import pathlib as p
+import shutil
+import struct
+import threading
+import zlib
+
+import numpy as np
+
+import dash_data_processing as extra
+import landuse
+
+log.getLogger().setLevel(log.INFO)
+log.basicConfig(format="%(asctime)s - [%(levelname)s]: %(message)s", datefmt="%H:%M:%S")
+
+TILE_SIZE = 256 # px
+MAX_ZOOM = 18
+TILE_FOLDER = os.environ.get("MGR_TILE_DIR", "tile_cache")
+SETBACK = min(landuse.DEFAULT_SETBACKS.values()) # km, nodes closer to a restriction are not buildable
+# layer -> (function selecting the nodes from their distance to the closest restriction, RGBA colour)
+LAYERS = {
+    "buildable": (lambda distances: distances >= SETBACK, (34, 139, 34, 220)),
+    # still buildable under a 1 km setback, see power_results_cache.SETBACKS
+    "buildable_1km": (lambda distances: distances >= 1., (20, 80, 160, 220)),
+    "restricted": (lambda distances: distances < SETBACK, (200, 40, 40, 220)),
+}
+
+
+def tile_bounds(z: int, x: int, y: int):
+    """
+    :return: [min_lon, min_lat, max_lon, max_lat] of a web mercator tile
+    """
+    tiles = 2 ** z
+
+    def tile_lat(row):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row / tiles))))
+
+    return [x / tiles * 360. - 180., tile_lat(y + 1), (x + 1) / tiles * 360. - 180., tile_lat(y)]
+
+
+def tile_pixels(lon, lat, z: int, x: int, y: int):
+    """
+    :return: pixel column and row of the points in the tile, outside of 0..TILE_SIZE for points beyond it
+    """
+    scale = TILE_SIZE * 2 ** z
+    lat_radians = np.radians(lat)
+    columns = (np.asarray(lon) + 180.) / 360. * scale - x * TILE_SIZE
+    rows = (1 - np.log(np.tan(lat_radians) + 1 / np.cos(lat_radians)) / math.pi) / 2 * scale - y * TILE_SIZE
+    return np.floor(columns).astype(np.int64), np.floor(rows).astype(np.int64)
+
+
+def encode_png(image: np.ndarray):
+    """
+    PNG file of an RGBA image written with zlib only
+    :param image: uint8 array of shape (height, width, 4)
+    """
+    height, width, _ = image.shape
+    # filter type 0 before every row
+    raw = np.concatenate((np.zeros((height, 1), dtype=np.uint8), image.reshape(height, width * 4)), axis=1)
+
+    def chunk(kind: bytes, data: bytes):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)) +
+            chunk(b"IDAT", zlib.compress(raw.tobytes(), 6)) + chunk(b"IEND", b""))
+
+
+def dot_radius(z: int):
+    """Radius in px of a node on the tile, nodes grow when zooming in"""
+    return 0 if z < 8 else 1 if z < 12 else 2
+
+
+class TileSource:
+    """
+    Nodes sorted by longitude, so the nodes of a tile are found with two binary searches
+
+    Attributes:
+        lon, lat, distances (np.ndarray): coordinates and distance to the closest restriction of the nodes
+        version (str): hash of the source files, tiles are cached per version
+    """
+    __slots__ = ("lon", "lat", "distances", "version")
+
+    def __init__(self, frame, version: str):
+        order = np.argsort(frame["lon"].values, kind="stable")
+        self.lon = frame["lon"].values[order]
+        self.lat = frame["lat"].values[order]
+        self.distances = frame["closest_distance_restriction"].values[order]
+        self.version = version
+
+    def within(self, bounds: list):
+        start = np.searchsorted(self.lon, bounds[0], side="left")
+        stop = np.searchsorted(self.lon, bounds[2], side="right")
+        lat = self.lat[start:stop]
+        mask = (lat >= bounds[1]) & (lat <= bounds[3])
+        return self.lon[start:stop][mask], lat[mask], self.distances[start:stop][mask]
+
+
+def render_tile(source: TileSource, layer: str, z: int, x: int, y: int):
+    """
+    :return: PNG of the layer nodes inside the tile, transparent elsewhere
+    """
+    select, colour = LAYERS[layer]
+    radius = dot_radius(z)
+    bounds = tile_bounds(z, x, y)
+    # nodes just outside the tile still paint their dot on its border
+    margin_lon = (radius + 1) * (bounds[2] - bounds[0]) / TILE_SIZE
+    margin_lat = (radius + 1) * (bounds[3] - bounds[1]) / TILE_SIZE
+    lon, lat, distances = source.within([bounds[0] - margin_lon, bounds[1] - margin_lat,
+                                         bounds[2] + margin_lon, bounds[3] + margin_lat])
+    selected = select(distances)
+    columns, rows = tile_pixels(lon[selected], lat[selected], z, x, y)
+
+    image = np.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8)
+    for d_row in range(-radius, radius + 1):
+        for d_column in range(-radius, radius + 1):
+            if d_row * d_row + d_column * d_column > radius * radius:
+                continue
+            dot_rows, dot_columns = rows + d_row, columns + d_column
+            inside = (dot_rows >= 0) & (dot_rows < TILE_SIZE) & (dot_columns >= 0) & (dot_columns < TILE_SIZE)
+            image[dot_rows[inside], dot_columns[inside]] = colour
+    return encode_png(image)
+
+
+def tile_path(source: TileSource, layer: str, z: int, x: int, y: int, folder: str = TILE_FOLDER):
+    return p.Path(folder).joinpath(source.version, layer, str(z), str(x), f"{y}.png")
+
+
+def get_tile(source: TileSource, layer: str, z: int, x: int, y: int, folder: str = TILE_FOLDER):
+    """
+    Tile from the disk cache, rendered and saved on the first request
+    :return: PNG bytes
+    """
+    file_path = tile_path(source, layer, z, x, y, folder)
+    if file_path.exists():
+        return file_path.read_bytes()
+    png = render_tile(source, layer, z, x, y)
+    file_path.parent.mkdir(parents=True, exist_ok=True)
+    # written under a unique name and renamed, concurrent requests of one tile never read a partial file
+    tmp_path = file_path.with_name(f"{file_path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    tmp_path.write_bytes(png)
+    tmp_path.replace(file_path)
+    return png
+
+
+_source = None
+_source_lock = threading.Lock()
+
+
+def voivodeships_source(voivodeships_dict: dict):
+    """
+    TileSource of all regions of the voivodeships, rebuilt when one of their files changes
+    """
+    global _source
+    regions = [region for regions in voivodeships_dict.values() for region in regions]
+    signature = extra.files_signature(regions)
+    version = hashlib.sha256(repr(signature).encode("utf-8")).hexdigest()[:16]
+    with _source_lock:
+        if _source is None or _source.version != version:
+            frame = extra.frame_cache.get("all voivodeships", signature, lambda: extra.build_voivodeship_frame(regions))
+            _source = TileSource(frame, version)
+            remove_old_versions(version)
+        return _source
+
+
+def remove_old_versions(version: str, folder: str = TILE_FOLDER):
+    """
+    Deletes the cached tiles of other versions of the data
+    """
+    folder_path = p.Path(folder)
+    if not folder_path.exists():
+        return
+    for version_path in folder_path.iterdir():
+        if version_path.is_dir() and version_path.name != version:
+            shutil.rmtree(version_path, ignore_errors=True)
+            log.info(f"Removed tiles of data version {version_path.name}")
+
+
+def tile_url(source: TileSource, layer: str, route: str = "/tiles"):
+    """
+    :return: URL template of the layer tiles for mapbox, with {z}, {x} and {y}. It names the data version, so
+    tiles cached by the browser are not shown once the data changed
+    """
+    return f"{route}/{source.version}/{layer}/{{z}}/{{x}}/{{y}}.png"
+
+
+def register(server, get_source, route: str = "/tiles"):
+    """
+    Adds the tile endpoint <route>/<version>/<layer>/<z>/<x>/<y>.png to a Flask server, e.g. the server of a Dash
+    app, see tile_url. Requests for another version are redirected to the current one
+    :param get_source: function returning the current TileSource
+    """
+    from flask import Response, abort, redirect
+
+    @server.route(f"{route}/<version>/<layer>/<int:z>/<int:x>/<int:y>.png")
+    def tile(version: str, layer: str, z: int, x: int, y: int):
+        if layer not in LAYERS or not 0 <= z <= MAX_ZOOM or not 0 <= x < 2 ** z or not 0 <= y < 2 ** z:
+            abort(404)
+        source = get_source()
+        if version != source.version:
+            return redirect(tile_url(source, layer, route).format(z=z, x=x, y=y))
+        png = get_tile(source, layer, z, x, y)
+        return Response(png, mimetype="image/png", headers={"Cache-Control": "public, max-age=86400"})
+
+    return tile
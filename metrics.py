@@ -0,0 +1,138 @@
+import contextlib
+import datetime
+import functools
+import json
+import logging as log
+import os
+import pathlib as p
+import re
+import threading
+import time
+
+log.getLogger().setLevel(log.INFO)
+log.basicConfig(format="%(asctime)s - [%(levelname)s]: %(message)s", datefmt="%H:%M:%S")
+
+REPORT_FOLDER = os.environ.get("MGR_METRICS_DIR", "metrics")
+PROMETHEUS_TEXTFILE = os.environ.get("MGR_PROMETHEUS_TEXTFILE")
+
+_lock = threading.Lock()
+_run_started = datetime.datetime.now()
+_stages = {}
+_stage_records = []
+_counters = {}
+
+
+@contextlib.contextmanager
+def stage(name: str, **labels):
+    """
+    Times the enclosed block and adds it to the run report
+    :param name: stage name, e.g. process_nodes.region
+    :param labels: extra values stored with this occurrence, e.g. region_id=5
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        with _lock:
+            summary = _stages.setdefault(name, {"calls": 0, "total_seconds": 0., "max_seconds": 0.})
+            summary["calls"] = summary["calls"] + 1
+            summary["total_seconds"] = summary["total_seconds"] + seconds
+            summary["max_seconds"] = max(summary["max_seconds"], seconds)
+            _stage_records.append({"stage": name, "seconds": seconds, **labels})
+        label_text = " ".join(f"{k}={v}" for k, v in labels.items())
+        log.info(f"Stage {name} {label_text} took {seconds:.2f} seconds")
+
+
+def timed(name: str = None):
+    """
+    Decorator timing every call of the function as a stage, named after the function by default
+    """
+    def decorator(function):
+        stage_name = name if name is not None else f"{function.__module__}.{function.__name__}"
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(stage_name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name: str, value: int = 1):
+    """
+    Increments a run counter, e.g. docs_read, docs_written, nodes_evaluated, distance_evaluations
+    """
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def get_counter(name: str):
+    with _lock:
+        return _counters.get(name, 0)
+
+
+def reset():
+    global _run_started
+    with _lock:
+        _run_started = datetime.datetime.now()
+        _stages.clear()
+        _stage_records.clear()
+        _counters.clear()
+
+
+def report(run_name: str):
+    with _lock:
+        return {"run": run_name,
+                "started": _run_started.isoformat(timespec="seconds"),
+                "finished": datetime.datetime.now().isoformat(timespec="seconds"),
+                "stages": {k: dict(v) for k, v in _stages.items()},
+                "counters": dict(_counters),
+                "stage_records": list(_stage_records)}
+
+
+def write_report(run_name: str, folder_name: str = None):
+    """
+    Saves the report of the run as JSON and, when MGR_PROMETHEUS_TEXTFILE is set, as a Prometheus textfile
+    :param run_name: name of the script, used in the file name
+    :param folder_name: folder for the JSON reports, MGR_METRICS_DIR or ./metrics by default
+    :return: path of the JSON report
+    """
+    run_report = report(run_name)
+    folder_path: p.Path = p.Path.cwd().joinpath(folder_name if folder_name is not None else REPORT_FOLDER)
+    if not folder_path.exists():
+        folder_path.mkdir(parents=True)
+    file_path: p.Path = folder_path.joinpath(f"{run_name}_{_run_started.strftime('%Y%m%d_%H%M%S')}.json")
+    with file_path.open(mode="w", encoding="utf-8") as written_file:
+        json.dump(run_report, written_file, indent=2)
+    log.info(f"Metrics of the run saved to {file_path}")
+
+    if PROMETHEUS_TEXTFILE:
+        write_prometheus(run_report, PROMETHEUS_TEXTFILE)
+
+    return file_path
+
+
+def write_prometheus(run_report: dict, fname: str):
+    """
+    Writes the report in the Prometheus text format, to be picked up by the node exporter textfile collector.
+    The file is replaced atomically so the collector never reads a partial file
+    """
+    run = run_report["run"]
+    lines = ["# TYPE mgr_stage_seconds summary"]
+    for name, summary in sorted(run_report["stages"].items()):
+        lines.append(f'mgr_stage_seconds_sum{{run="{run}",stage="{name}"}} {summary["total_seconds"]}')
+        lines.append(f'mgr_stage_seconds_count{{run="{run}",stage="{name}"}} {summary["calls"]}')
+    lines.append("# TYPE mgr_stage_max_seconds gauge")
+    for name, summary in sorted(run_report["stages"].items()):
+        lines.append(f'mgr_stage_max_seconds{{run="{run}",stage="{name}"}} {summary["max_seconds"]}')
+    for name, value in sorted(run_report["counters"].items()):
+        metric = "mgr_" + re.sub(r"[^a-zA-Z0-9_]", "_", name) + "_total"
+        lines.append(f"# TYPE {metric} counter")
+        lines.append(f'{metric}{{run="{run}"}} {value}')
+
+    file_path = p.Path(fname)
+    temporary_path = file_path.with_name(file_path.name + ".tmp")
+    with temporary_path.open(mode="w", encoding="utf-8") as written_file:
+        written_file.write("\n".join(lines) + "\n")
+    os.replace(temporary_path, file_path)
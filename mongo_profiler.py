@@ -0,0 +1,178 @@
+import atexit
+import bisect
+import heapq
+import json
+import logging as log
+import os
+import pathlib as p
+import threading
+import traceback
+
+import bson
+from pymongo import monitoring
+
+log.getLogger().setLevel(log.INFO)
+log.basicConfig(format="%(asctime)s - [%(levelname)s]: %(message)s", datefmt="%H:%M:%S")
+
+HISTOGRAM_BOUNDS_MS = [0.5, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+# keys of the command document holding the query, per command name
+QUERY_KEYS = {"find": "filter", "count": "query", "distinct": "query", "delete": "deletes", "update": "updates",
+              "findAndModify": "query", "aggregate": "pipeline", "insert": None, "getMore": None}
+# db_connection.stream and stream_pages issue the queries of every stage, the stage calling them is reported
+IGNORED_FRAMES = (os.sep + "pymongo" + os.sep, os.sep + "mongo_profiler.py", os.sep + "threading.py",
+                  os.sep + "db_connection.py")
+
+
+def query_shape(value):
+    """
+    Replaces every value of a query by its type name, so queries differing only by values share a shape
+    """
+    if isinstance(value, dict):
+        return {k: query_shape(v) if k.startswith("$") or isinstance(v, (dict, list)) else type(v).__name__
+                for k, v in sorted(value.items())}
+    if isinstance(value, list):
+        shapes = [query_shape(x) for x in value[:1]]
+        return shapes if len(value) <= 1 else shapes + ["..."]
+    return type(value).__name__
+
+
+def command_shape(command_name: str, command: dict):
+    query_key = QUERY_KEYS.get(command_name)
+    if query_key is None or query_key not in command:
+        return ""
+    query = command[query_key]
+    if command_name in ("update", "delete"):
+        query = [x.get("q", {}) for x in query[:1]]
+    elif command_name == "aggregate":
+        query = [list(stage)[0] if len(stage) else "" for stage in query]
+    return json.dumps(query_shape(query), sort_keys=True)
+
+
+def call_site():
+    """
+    First frame of the stack outside pymongo, db_connection and this module, e.g. process_nodes.py:75 iterate_nodes_list
+    """
+    for frame in reversed(traceback.extract_stack()):
+        if not any(x in frame.filename for x in IGNORED_FRAMES):
+            return f"{p.Path(frame.filename).name}:{frame.lineno} {frame.name}"
+    return "unknown"
+
+
+class CommandProfiler(monitoring.CommandListener):
+    """
+    Collects latency, reply size and call site of every command sent by clients created after enable()
+
+    Attributes:
+        slowest_count (int): number of slowest operations kept for the report
+        repeated_threshold (int): number of identical command shapes from one call site flagged as N+1 pattern
+    """
+
+    def __init__(self, slowest_count: int = 20, repeated_threshold: int = 100):
+        self.slowest_count = slowest_count
+        self.repeated_threshold = repeated_threshold
+        self._lock = threading.Lock()
+        self._pending = {}
+        self.commands = {}
+        self.patterns = {}
+        self.slowest = []
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        if not isinstance(collection, str):
+            collection = ""
+        key = (event.command_name, collection, command_shape(event.command_name, event.command), call_site())
+        with self._lock:
+            self._pending[(event.connection_id, event.request_id)] = key
+
+    def succeeded(self, event):
+        self._finish(event, len(bson.encode(event.reply)), failed=False)
+
+    def failed(self, event):
+        self._finish(event, 0, failed=True)
+
+    def _finish(self, event, reply_bytes: int, failed: bool):
+        duration_ms = event.duration_micros / 1000
+        with self._lock:
+            key = self._pending.pop((event.connection_id, event.request_id), None)
+            if key is None:
+                return
+            command_name, collection, shape, site = key
+
+            summary = self.commands.setdefault(command_name, {"calls": 0, "failed": 0, "total_ms": 0., "bytes": 0,
+                                                              "histogram": [0] * (len(HISTOGRAM_BOUNDS_MS) + 1)})
+            summary["calls"] = summary["calls"] + 1
+            summary["failed"] = summary["failed"] + int(failed)
+            summary["total_ms"] = summary["total_ms"] + duration_ms
+            summary["bytes"] = summary["bytes"] + reply_bytes
+            summary["histogram"][bisect.bisect_left(HISTOGRAM_BOUNDS_MS, duration_ms)] += 1
+
+            pattern = self.patterns.setdefault(key, {"calls": 0, "total_ms": 0.})
+            pattern["calls"] = pattern["calls"] + 1
+            pattern["total_ms"] = pattern["total_ms"] + duration_ms
+
+            operation = (duration_ms, command_name, collection, shape, site)
+            if len(self.slowest) < self.slowest_count:
+                heapq.heappush(self.slowest, operation)
+            else:
+                heapq.heappushpop(self.slowest, operation)
+
+    def report(self):
+        with self._lock:
+            repeated = [{"command": k[0], "collection": k[1], "shape": k[2], "call_site": k[3], **v}
+                        for k, v in self.patterns.items() if v["calls"] >= self.repeated_threshold]
+            return {"histogram_bounds_ms": HISTOGRAM_BOUNDS_MS,
+                    "commands": {k: dict(v) for k, v in self.commands.items()},
+                    "slowest": [{"duration_ms": x[0], "command": x[1], "collection": x[2], "shape": x[3],
+                                 "call_site": x[4]} for x in sorted(self.slowest, reverse=True)],
+                    "repeated": sorted(repeated, key=lambda x: x["total_ms"], reverse=True)}
+
+    def log_report(self):
+        run_report = self.report()
+        for command_name, summary in sorted(run_report["commands"].items(), key=lambda x: -x[1]["total_ms"]):
+            log.info(f"{command_name}: {summary['calls']} calls, {summary['total_ms'] / 1000:.2f} s, "
+                     f"{summary['bytes'] / 1e6:.1f} MB returned")
+        for operation in run_report["slowest"]:
+            log.info(f"Slow {operation['command']} on {operation['collection']} took {operation['duration_ms']:.1f} ms "
+                     f"at {operation['call_site']}")
+        for pattern in run_report["repeated"]:
+            log.warning(f"Possible N+1: {pattern['calls']} x {pattern['command']} on {pattern['collection']} "
+                        f"with shape {pattern['shape']} at {pattern['call_site']}, {pattern['total_ms'] / 1000:.2f} s")
+        return run_report
+
+
+_profiler = None
+
+
+def enable(slowest_count: int = 20, repeated_threshold: int = 100):
+    """
+    Registers the profiler for all MongoClients created afterwards
+    """
+    global _profiler
+    if _profiler is None:
+        _profiler = CommandProfiler(slowest_count, repeated_threshold)
+        monitoring.register(_profiler)
+    return _profiler
+
+
+def enable_from_env():
+    """
+    Enables the profiler when MGR_MONGO_PROFILE is set. The report is logged at exit and saved to the file named by
+    MGR_MONGO_PROFILE when it is not just a flag
+    """
+    setting = os.environ.get("MGR_MONGO_PROFILE")
+    if not setting:
+        return None
+    if _profiler is not None:
+        return _profiler
+    profiler = enable(int(os.environ.get("MGR_MONGO_PROFILE_SLOWEST", 20)),
+                      int(os.environ.get("MGR_MONGO_PROFILE_REPEATED", 100)))
+
+    def write_report():
+        run_report = profiler.log_report()
+        if setting.endswith(".json"):
+            with open(setting, mode="w", encoding="utf-8") as written_file:
+                json.dump(run_report, written_file, indent=2)
+            log.info(f"Mongo profile saved to {setting}")
+
+    atexit.register(write_report)
+    return profiler
@@ -0,0 +1,371 @@
+import logging as log
+import math
+import pathlib as p
+import numpy as np
+import db_connection
+import landuse as landuse_registry
+from landuse import LANDUSE_CODES, LANDUSE_NAMES
+
+log.getLogger().setLevel(log.INFO)
+log.basicConfig(format="%(asctime)s - [%(levelname)s]: %(message)s", datefmt="%H:%M:%S")
+
+EARTH_RADIUS = 6371 # km, same as process_nodes.calculate_distance
+# relative error margin of DistanceBounds, see its docstring
+APPROXIMATION_MARGIN = 1e-5
+MAX_APPROXIMATION_DEGREES = 0.2
+KM_PER_DEGREE = EARTH_RADIUS * math.pi / 180 # of latitude
+LOW_FACTOR = KM_PER_DEGREE * (1 - APPROXIMATION_MARGIN) # km per degree of the lower bound
+
+
+class DistanceBounds:
+    """
+    Cheap lower and upper bounds of the haversine distance from a local equirectangular projection, valid for
+    pairs of points inside one latitude band, e.g. a region with its search window
+
+    With S = sin^2(dlat/2) + cos(lat1)cos(lat2)sin^2(dlon/2) and distance = 2R asin(sqrt(S)), the product of
+    cosines lies between the squares of the smallest and largest cosine of the band. For angles m below
+    MAX_APPROXIMATION_DEGREES, x/2 (1 - m^2/24) <= sin(x/2) <= x/2 and y <= asin(y) <= y/sqrt(1 - y^2) give
+    R sqrt(dlat^2 + low^2 dlon^2) (1 - m^2/24) <= distance <= R sqrt(dlat^2 + high^2 dlon^2) (1 + A^2/8), and both
+    terms stay below APPROXIMATION_MARGIN. Candidates are always within the +- 0.04 degree window of the node
+    """
+    __slots__ = ("scale_low", "scale_high")
+
+    def __init__(self, min_lat: float, max_lat: float):
+        cosines = [math.cos(math.radians(min_lat)), math.cos(math.radians(max_lat))]
+        self.scale_low = min(cosines)
+        # the cosine is largest at the latitude of the band closest to the equator
+        self.scale_high = 1. if min_lat <= 0 <= max_lat else max(cosines)
+
+    @classmethod
+    def for_bbox(cls, region_bbox: list, margin: float):
+        """
+        :param region_bbox: [min_lon, min_lat, max_lon, max_lat]
+        :param margin: degrees added around the box, the search window of the candidates
+        """
+        return cls(region_bbox[1] - margin, region_bbox[3] + margin)
+
+    def lower_bound(self, coordinates1: list, coordinates2: list):
+        """Lower bound alone, cheaper when the upper one is not needed"""
+        dlat = coordinates2[1] - coordinates1[1]
+        dlon = self.scale_low * (coordinates2[0] - coordinates1[0])
+        return LOW_FACTOR * math.sqrt(dlat * dlat + dlon * dlon)
+
+    def bounds(self, coordinates1: list, coordinates2: list):
+        dlat = math.radians(coordinates2[1] - coordinates1[1])
+        dlon = math.radians(coordinates2[0] - coordinates1[0])
+        low = EARTH_RADIUS * math.sqrt(dlat * dlat + self.scale_low * self.scale_low * dlon * dlon)
+        high = EARTH_RADIUS * math.sqrt(dlat * dlat + self.scale_high * self.scale_high * dlon * dlon)
+        return low * (1 - APPROXIMATION_MARGIN), high * (1 + APPROXIMATION_MARGIN)
+
+    def store_bounds(self, store, coordinates: list):
+        """Vectorized bounds from the point to every node of the store"""
+        dlat = np.radians(store.lat - coordinates[1])
+        dlon = np.radians(store.lon - coordinates[0])
+        dlat_squared = dlat * dlat
+        dlon_squared = dlon * dlon
+        low = EARTH_RADIUS * np.sqrt(dlat_squared + self.scale_low * self.scale_low * dlon_squared)
+        high = EARTH_RADIUS * np.sqrt(dlat_squared + self.scale_high * self.scale_high * dlon_squared)
+        return low * (1 - APPROXIMATION_MARGIN), high * (1 + APPROXIMATION_MARGIN)
+
+
+class NodeView:
+    """
+    One node of a NodeStore, read like the node dictionaries used elsewhere: node["id"], node["coordinates"], ...
+    Values are created on access, the view itself only holds the store and the row number
+    """
+    __slots__ = ("store", "index")
+
+    def __init__(self, store, index: int):
+        self.store = store
+        self.index = index
+
+    def __getitem__(self, key: str):
+        store, index = self.store, self.index
+        if key == "id":
+            return int(store.ids[index])
+        if key == "coordinates":
+            return [float(store.lon[index]), float(store.lat[index])]
+        if key == "way_id":
+            return int(store.way_ids[index])
+        if key == "landuse":
+            return LANDUSE_NAMES.get(int(store.landuse[index]))
+        if key == "closest_distance_restriction":
+            return float(store.distances[index])
+        raise KeyError(key)
+
+    def get(self, key: str, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def to_dict(self):
+        return {key: self[key] for key in ("id", "coordinates", "way_id", "landuse", "closest_distance_restriction")}
+
+
+class NodeStore:
+    """
+    Nodes kept as NumPy columns, about 33 bytes per node instead of 400+ for a dictionary with a coordinates list
+
+    Attributes:
+        ids (np.ndarray): int64 node ids
+        lon, lat (np.ndarray): float64 coordinates
+        way_ids (np.ndarray): int64 way ids, 0 when unknown
+        landuse (np.ndarray): uint8 landuse codes, see landuse.REGISTRY
+        distances (np.ndarray): float64 distance to the closest restriction in km, NaN when not calculated
+    """
+    __slots__ = ("ids", "lon", "lat", "way_ids", "landuse", "distances")
+
+    def __init__(self, ids, lon, lat, way_ids=None, landuse=None, distances=None):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.lon = np.asarray(lon, dtype=np.float64)
+        self.lat = np.asarray(lat, dtype=np.float64)
+        size = len(self.ids)
+        self.way_ids = np.zeros(size, dtype=np.int64) if way_ids is None else np.asarray(way_ids, dtype=np.int64)
+        self.landuse = np.zeros(size, dtype=np.uint8) if landuse is None else np.asarray(landuse, dtype=np.uint8)
+        self.distances = np.full(size, np.nan) if distances is None else np.asarray(distances, dtype=np.float64)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        for index in range(len(self.ids)):
+            yield NodeView(self, index)
+
+    def __getitem__(self, index):
+        """
+        :param index: row number for a NodeView, slice, boolean mask or array of row numbers for a NodeStore
+        """
+        if isinstance(index, (int, np.integer)):
+            if index < 0:
+                index = index + len(self.ids)
+            if not 0 <= index < len(self.ids):
+                raise IndexError(index)
+            return NodeView(self, int(index))
+        return NodeStore(self.ids[index], self.lon[index], self.lat[index], self.way_ids[index],
+                         self.landuse[index], self.distances[index])
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, column).nbytes for column in self.__slots__)
+
+    @property
+    def coordinates(self):
+        """(n, 2) array of [lon, lat] pairs"""
+        return np.column_stack((self.lon, self.lat))
+
+    @classmethod
+    def from_documents(cls, documents: list):
+        """
+        :param documents: node dictionaries with coordinates, or lon and lat as in the region files
+        """
+        size = len(documents)
+        ids = np.empty(size, dtype=np.int64)
+        lon = np.empty(size, dtype=np.float64)
+        lat = np.empty(size, dtype=np.float64)
+        way_ids = np.zeros(size, dtype=np.int64)
+        landuse = np.zeros(size, dtype=np.uint8)
+        distances = np.full(size, np.nan)
+        for index, document in enumerate(documents):
+            ids[index] = document["id"]
+            if "coordinates" in document:
+                lon[index], lat[index] = document["coordinates"][0], document["coordinates"][1]
+            else:
+                lon[index], lat[index] = document["lon"], document["lat"]
+            way_ids[index] = document.get("way_id") or 0
+            if "landuse_code" in document:
+                landuse[index] = document["landuse_code"]
+            else:
+                landuse[index] = LANDUSE_CODES.get(document.get("landuse"), landuse_registry.UNKNOWN_CODE)
+            if document.get("closest_distance_restriction") is not None:
+                distances[index] = document["closest_distance_restriction"]
+
+        return cls(ids, lon, lat, way_ids, landuse, distances)
+
+    @classmethod
+    def concatenate(cls, stores: list):
+        if len(stores) == 0:
+            return cls([], [], [])
+        return cls(*(np.concatenate([getattr(store, column) for store in stores]) for column in cls.__slots__))
+
+    @classmethod
+    def from_batches(cls, batches):
+        """
+        :param batches: iterable of lists of node dictionaries, e.g. db_connection.stream, each batch is converted
+        and released before the next one is read
+        """
+        return cls.concatenate([cls.from_documents(batch) for batch in batches])
+
+    @classmethod
+    def from_cursor(cls, cursor, batch_size: int = 10000):
+        return cls.from_batches(db_connection.iterate_batches(cursor, batch_size))
+
+    @classmethod
+    def from_region_file(cls, fname: str, folder_name: str = "region_data_files"):
+        """
+        :param fname: name of a file created by region_data_generator, with or without .json, its region_store
+        copy is read when there is an up to date one
+        """
+        import region_store
+
+        columns = region_store.load_region(fname[:-5] if fname.endswith(".json") else fname,
+                                           str(p.Path.cwd().joinpath(folder_name)))
+        return cls(columns["id"], columns["lon"], columns["lat"], columns["way_id"], columns["landuse"],
+                   columns["closest_distance_restriction"])
+
+    def within(self, min_lon: float, min_lat: float, max_lon: float, max_lat: float):
+        """
+        Nodes inside the box, borders included
+        """
+        mask = (self.lon >= min_lon) & (self.lon <= max_lon) & (self.lat >= min_lat) & (self.lat <= max_lat)
+        return self[mask]
+
+    def with_landuse(self, landuse: list):
+        codes = [LANDUSE_CODES[x] for x in landuse]
+        return self[np.isin(self.landuse, codes)]
+
+    def with_class(self, landuse_class: int):
+        """
+        :param landuse_class: landuse.ALLOWABLE, landuse.RESTRICTING or both
+        """
+        return self[landuse_registry.class_mask(self.landuse, landuse_class)]
+
+    def simplify(self, tolerance: float):
+        """
+        Thins dense outlines by keeping one node per grid cell and landuse code, the first one in store order.
+        Cells are small enough that every dropped node is within tolerance km of the node kept for it, so the
+        distance to the closest node, overall or of one class, grows by at most tolerance km and never shrinks.
+        Kept nodes are original nodes with their ids
+        :param tolerance: error bound in km, 0 keeps every node
+        :return: simplified store and, for every node of this store, the row of the node kept for it
+        """
+        if len(self.ids) == 0 or tolerance <= 0:
+            return self, np.arange(len(self.ids))
+        # the diagonal of a cell is below tolerance, the margin covers haversine against the planar diagonal
+        cell = tolerance / math.sqrt(2) * (1 - 100 * APPROXIMATION_MARGIN) / KM_PER_DEGREE
+        # a degree of longitude is longest at the latitude closest to the equator
+        min_abs_lat = 0. if self.lat.min() <= 0 <= self.lat.max() else float(np.abs(self.lat).min())
+        lon_cell = cell / math.cos(math.radians(min_abs_lat))
+        keys = np.column_stack((np.floor(self.lon / lon_cell).astype(np.int64),
+                                np.floor(self.lat / cell).astype(np.int64), self.landuse.astype(np.int64)))
+        _, first, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+        order = np.argsort(first)
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order))
+        return self[first[order]], rank[inverse.reshape(-1)]
+
+    def distances_to(self, coordinates: list):
+        """
+        Haversine distances in km from the point to every node, same formula as process_nodes.calculate_distance
+        :param coordinates: [lon, lat]
+        """
+        return haversine(self.lon, self.lat, coordinates)
+
+    def closest_restriction(self, coordinates: list, min_allowable_distance: float, distances=None):
+        """
+        Vectorized form of the loop in process_nodes.find_closest_restriction: nodes are visited in store order,
+        the search stops at the first node closer than min_allowable_distance and ties keep the later node
+        :return: closest distance (0 when a too close node was found), id of the closest node visited before stopping,
+        number of distances the loop would have evaluated
+        """
+        if distances is None:
+            distances = self.distances_to(coordinates)
+        too_close = np.flatnonzero(distances < min_allowable_distance)
+        stop = int(too_close[0]) if len(too_close) != 0 else len(distances)
+        visited = distances[:stop]
+        if len(visited) == 0:
+            return 0, int(self.ids[0]), 1
+        # last occurrence of the minimum, as the loop replaces the closest node on equal distance
+        closest_index = len(visited) - 1 - int(np.argmin(visited[::-1]))
+        closest_distance = 0 if stop < len(distances) else float(visited[closest_index])
+
+        return closest_distance, int(self.ids[closest_index]), min(stop + 1, len(distances))
+
+    def class_distances(self, coordinates: list = None, distances=None):
+        """
+        Nearest distance to every restricting class in one pass over the nodes
+        :param distances: result of distances_to when already computed
+        :return: array ordered as landuse.RESTRICTING_LANDUSE, inf for classes without nodes in the store
+        """
+        if distances is None:
+            distances = self.distances_to(coordinates)
+        minima = np.full(len(landuse_registry.RESTRICTING_CODES), np.inf)
+        positions = landuse_registry.RESTRICTING_POSITIONS[self.landuse]
+        restricting = positions >= 0
+        np.minimum.at(minima, positions[restricting], distances[restricting])
+
+        return minima
+
+    def nearest_restrictions(self, coordinates: list, min_allowable_distance: float, bounds: DistanceBounds):
+        """
+        Same results as closest_restriction and class_distances together, with exact haversine distances only for
+        the nodes whose bounds leave them a chance to be below the threshold, the closest visited node or the
+        nearest node of their class
+        :return: closest distance, closest node id, number of evaluated distances of the loop, class minima and
+        number of nodes whose haversine distance was not needed
+        """
+        low, high = bounds.store_bounds(self, coordinates)
+        size = len(self.ids)
+        needed = low < min_allowable_distance
+        exact = np.full(size, np.inf)
+        exact[needed] = haversine(self.lon[needed], self.lat[needed], coordinates)
+
+        too_close = np.flatnonzero(exact < min_allowable_distance)
+        stop = int(too_close[0]) if len(too_close) != 0 else size
+        if stop != 0:
+            # the closest visited node is at most the smallest upper bound away
+            visited = np.zeros(size, dtype=bool)
+            visited[:stop] = True
+            needed = needed | (visited & (low <= high[:stop].min()))
+        positions = landuse_registry.RESTRICTING_POSITIONS[self.landuse]
+        class_best = np.full(len(landuse_registry.RESTRICTING_CODES), np.inf)
+        restricting = positions >= 0
+        np.minimum.at(class_best, positions[restricting], high[restricting])
+        needed[restricting] = needed[restricting] | (low[restricting] <= class_best[positions[restricting]])
+
+        missing = needed & np.isinf(exact)
+        exact[missing] = haversine(self.lon[missing], self.lat[missing], coordinates)
+        #nodes not needed keep an infinite distance, they can be neither the closest nor below the threshold
+        closest_distance, closest_id, evaluations = self.closest_restriction(coordinates, min_allowable_distance, exact)
+
+        return (closest_distance, closest_id, evaluations, self.class_distances(distances=exact),
+                size - int(needed.sum()))
+
+    def ways(self, region_id: int):
+        """
+        Groups the nodes into ways shaped like the documents of the way_buildable view, node lists sorted by distance
+        :return: generator of way dictionaries
+        """
+        known = self[~np.isnan(self.distances)]
+        order = np.lexsort((known.distances, known.way_ids))
+        known = known[order]
+        boundaries = np.flatnonzero(np.diff(known.way_ids)) + 1
+        for rows in np.split(np.arange(len(known)), boundaries):
+            if len(rows) == 0:
+                continue
+            yield {"way_id": int(known.way_ids[rows[0]]), "region_id": region_id,
+                   "buildable_nodes": known.ids[rows].tolist(),
+                   "node_coordinates": np.column_stack((known.lon[rows], known.lat[rows])),
+                   "node_distances": known.distances[rows].tolist()}
+
+
+def haversine(lon, lat, coordinates: list):
+    """
+    :param lon, lat: arrays of coordinates
+    :param coordinates: [lon, lat] of the other point
+    :return: array of distances in km
+    """
+    lat1 = coordinates[1]
+    dlat = np.radians(lat - lat1)
+    dlon = np.radians(lon - coordinates[0])
+    a = (np.sin(dlat / 2) * np.sin(dlat / 2) +
+         np.cos(np.radians(lat1)) * np.cos(np.radians(lat)) *
+         np.sin(dlon / 2) * np.sin(dlon / 2))
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+    return EARTH_RADIUS * c
+
+
+if __name__ == "__main__":
+    store = NodeStore.from_region_file("powiat starachowicki")
+    log.info(f"{len(store)} nodes held in {store.nbytes / 1e6:.2f} MB")
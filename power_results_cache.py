@@ -0,0 +1,155 @@
+from pymongo import ASCENDING, ReplaceOne
+import logging as log
+import pathlib as p
+import csv
+import numpy as np
+import db_connection
+import metrics
+
+log.getLogger().setLevel(log.INFO)
+log.basicConfig(format="%(asctime)s - [%(levelname)s]: %(message)s", datefmt="%H:%M:%S")
+
+RESULTS_COLLECTION = "way_results"
+SETBACKS = [0.5, 0.75, 1., 1.25, 1.5] # km
+# a way crossing a region border is cached once per region, as in way_buildable.VIEW_KEY
+RESULT_KEY = ["region_id", "way_id"]
+TIDY_COLUMNS = ["region_id", "min_distance", "min_allowable_power", "overall_area", "overall_power", "node_number"]
+
+
+def ensure_indexes(db):
+    """
+    Unique index on RESULT_KEY. Results of the old layout, keyed by the way id alone, are removed first,
+    get_power_areas computes them again
+    """
+    removed = db[RESULTS_COLLECTION].delete_many({"way_id": {"$exists": False}}).deleted_count
+    if removed != 0:
+        log.warning(f"Removed {removed} way results keyed by the way id alone")
+    db[RESULTS_COLLECTION].create_index([(key, ASCENDING) for key in RESULT_KEY], unique=True)
+
+
+def save_way_results(db, way_results: list, region_ids: list = None):
+    """
+    Persists area, power and number of nodes of each way at every setback. Results cached earlier for the regions
+    are removed first, ways which are no longer buildable would otherwise still count in load_cache
+    :param db: database handle
+    :param way_results: list of documents created by get_power_areas.calculate_way_results
+    :param region_ids: regions whose results are replaced, the regions of way_results by default
+    """
+    ensure_indexes(db)
+    if region_ids is None:
+        region_ids = {way["region_id"] for way in way_results}
+    if len(region_ids) != 0:
+        db[RESULTS_COLLECTION].delete_many({"region_id": {"$in": list(region_ids)}})
+    requests = [ReplaceOne({key: way[key] for key in RESULT_KEY}, way, upsert=True) for way in way_results]
+    if len(requests) != 0:
+        db[RESULTS_COLLECTION].bulk_write(requests, ordered=False)
+    log.info(f"Cached results of {len(requests)} ways")
+
+
+def build_cache(way_results):
+    """
+    Packs per-way results into arrays, one row per way and one column per setback
+    :param way_results: iterable of way result documents, all computed for the same setbacks
+    :return: dictionary of numpy arrays
+    """
+    region_ids, areas, powers, node_numbers = [], [], [], []
+    setbacks = None
+    for way in way_results:
+        if setbacks is None:
+            setbacks = way["setbacks"]
+        elif way["setbacks"] != setbacks:
+            raise ValueError(f"Way {way['way_id']} was cached for setbacks {way['setbacks']}, expected {setbacks}")
+        region_ids.append(way["region_id"])
+        areas.append(way["areas"])
+        powers.append(way["powers"])
+        node_numbers.append(way["node_numbers"])
+
+    if setbacks is None:
+        setbacks = SETBACKS
+    columns = len(setbacks)
+
+    return {"setbacks": np.array(setbacks, dtype=float),
+            "region_id": np.array(region_ids, dtype=np.int64),
+            "area": np.array(areas, dtype=float).reshape(-1, columns),
+            "power": np.array(powers, dtype=float).reshape(-1, columns),
+            "node_number": np.array(node_numbers, dtype=np.int64).reshape(-1, columns)}
+
+
+def load_cache(db, region_ids: list = None):
+    """
+    Loads cached per-way results of the given regions (all regions by default)
+    :param db: database handle
+    :param region_ids: optional list of region ids
+    """
+    query = {} if region_ids is None else {"region_id": {"$in": list(region_ids)}}
+    cursor = db[RESULTS_COLLECTION].find(query, {"_id": 0, "way_id": 1, "region_id": 1, "setbacks": 1,
+                                                  "areas": 1, "powers": 1, "node_numbers": 1})
+
+    return build_cache(cursor)
+
+
+def threshold_results(cache: dict, min_distance: float, min_allowable_power: float):
+    """
+    Overall area, power and number of nodes per region for a (setback, minimal power) pair,
+    ways below the power limit or without a hull area are left out
+    :param cache: arrays created by build_cache
+    :param min_distance: setback, km, one of the cached setbacks
+    :param min_allowable_power: minimal power limit for one area, MW
+    :return: dictionary region_id -> (overall_area, overall_power, node_number)
+    """
+    column = np.flatnonzero(np.isclose(cache["setbacks"], min_distance))
+    if len(column) == 0:
+        raise ValueError(f"Setback {min_distance} km is not cached, available: {cache['setbacks'].tolist()}")
+    column = column[0]
+
+    regions, region_index = np.unique(cache["region_id"], return_inverse=True)
+    power = cache["power"][:, column]
+    selected = (power >= min_allowable_power) & (cache["area"][:, column] != 0)
+
+    overall_area = np.bincount(region_index, weights=np.where(selected, cache["area"][:, column], 0),
+                               minlength=len(regions))
+    overall_power = np.bincount(region_index, weights=np.where(selected, power, 0), minlength=len(regions))
+    node_number = np.bincount(region_index, weights=np.where(selected, cache["node_number"][:, column], 0),
+                              minlength=len(regions))
+
+    return {int(region): (float(overall_area[i]), float(overall_power[i]), int(node_number[i]))
+            for i, region in enumerate(regions)}
+
+
+def sweep_results(cache: dict, setbacks: list, min_allowable_powers: list):
+    """
+    Evaluates every (setback, minimal power) combination on cached results
+    :return: list of rows with TIDY_COLUMNS keys, one per region and combination
+    """
+    rows = []
+    for min_distance in setbacks:
+        for min_allowable_power in min_allowable_powers:
+            results = threshold_results(cache, min_distance, min_allowable_power)
+            for region_id, (overall_area, overall_power, node_number) in sorted(results.items()):
+                rows.append({"region_id": region_id, "min_distance": min_distance,
+                             "min_allowable_power": min_allowable_power, "overall_area": overall_area,
+                             "overall_power": overall_power, "node_number": node_number})
+    return rows
+
+
+def export_tidy_table(rows: list, fname: str) -> None:
+    """
+    Saves the rows of a sweep as a csv table
+    """
+    file_path: p.Path = p.Path.cwd().joinpath(fname)
+    with file_path.open(mode="w", encoding="utf-8", newline="") as written_file:
+        writer = csv.DictWriter(written_file, fieldnames=TIDY_COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+    log.info(f"Table with {len(rows)} rows saved to {fname}")
+
+
+if __name__ == "__main__":
+    db = db_connection.get_db()
+    with metrics.stage("power_results_cache.load"):
+        cache = load_cache(db)
+    metrics.count("docs_read", len(cache["region_id"]))
+    with metrics.stage("power_results_cache.sweep"):
+        rows = sweep_results(cache, SETBACKS, [x for x in range(0, 105, 5)])
+    export_tidy_table(rows, "results_sweep.csv")
+    metrics.write_report("power_results_cache")
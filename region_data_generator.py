@@ -7,6 +7,7 @@ import random
 from typing import Any, List, TypedDict, Tuple
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
+import landuse
 
 
 log.getLogger().setLevel(log.INFO)
@@ -81,7 +82,7 @@ def get_data_for_each_region(file_name: str, folder_name: str) -> None:
     region_list_path: p.Path = p.Path.cwd().joinpath(file_name)
     json_folder_path: p.Path = p.Path.cwd().joinpath(folder_name)
 
-    raw_nodes_landuse: str = "residential|nature_reserve|farmland|meadow|brownfield|construction|orchard|grass|military"
+    raw_nodes_landuse: str = landuse.overpass_filter()
 
     if not json_folder_path.exists():
         json_folder_path.mkdir()
@@ -0,0 +1,454 @@
+import argparse
+import concurrent.futures
+import datetime
+import heapq
+import json
+import logging as log
+import multiprocessing
+import os
+import pathlib as p
+import queue
+import threading
+import time
+
+import add_ways_to_node
+import create_geo_array_nodes
+import db_connection
+import get_power_areas
+import job_ledger
+import landuse
+import load_to_db
+import metrics
+import process_nodes
+import region_data_generator
+
+log.getLogger().setLevel(log.INFO)
+log.basicConfig(format="%(asctime)s - [%(levelname)s]: %(message)s", datefmt="%H:%M:%S")
+
+OVERPASS_URL = "http://overpass-api.de/api/interpreter"
+REGION_FOLDER = "region_data" # folder of the region files, as region_data_generator.get_data_for_each_region
+IO_WORKERS = 4
+CPU_WORKERS = os.cpu_count() or 1
+MIN_POWER = 30 # minimal power limit for one area, MW
+# stage -> pool running it, stages of the same region it waits for and stages of the neighbouring regions it waits
+# for. Stages of one region run in this order, stages of different regions overlap
+STAGES = {
+    "fetch": {"pool": "io", "after": [], "neighbours_after": []},
+    "parse": {"pool": "cpu", "after": ["fetch"], "neighbours_after": []},
+    "load": {"pool": "io", "after": ["parse"], "neighbours_after": []},
+    "enrich": {"pool": "io", "after": ["load"], "neighbours_after": []},
+    # restricting nodes of the neighbours need their landuse before distances to them are computed
+    "distance": {"pool": "cpu", "after": ["enrich"], "neighbours_after": ["enrich"]},
+    "power": {"pool": "cpu", "after": ["distance"], "neighbours_after": []},
+}
+# stage -> function of the settings returning the values a stage depends on besides the stages before it, a region
+# done with other values is done again, with the stages after it
+STAGE_INPUTS = {
+    "fetch": lambda settings: landuse.overpass_filter(),
+    "enrich": lambda settings: landuse.LANDUSE_NAMES,
+    "distance": lambda settings: [landuse.DEFAULT_SETBACKS, process_nodes.SIMPLIFY_TOLERANCE],
+    "power": lambda settings: [get_power_areas.results_cache.SETBACKS, settings.get("min_allowable_power")],
+}
+
+
+def stage_hashes(settings: dict, stages: dict = STAGES):
+    """
+    :return: dictionary stage -> input hash, including the input hashes of the stages before it
+    """
+    hashes = {}
+    for stage, definition in stages.items():
+        inputs = STAGE_INPUTS.get(stage, lambda x: None)(settings)
+        hashes[stage] = job_ledger.input_hash(inputs, [hashes[x] for x in definition["after"]])
+    return hashes
+
+
+# hashes of a run with the default settings, recorded by the done command of job_ledger
+for _stage in STAGES:
+    job_ledger.register_inputs(_stage, lambda region, ledger, stage=_stage:
+                               stage_hashes({"min_allowable_power": MIN_POWER})[stage])
+
+
+def raw_path(region: dict, settings: dict):
+    return p.Path(settings["folder"]).joinpath("raw", f"{region['name']}.json")
+
+
+def region_files(region: dict, settings: dict):
+    folder_path = p.Path(settings["folder"])
+    return folder_path.joinpath(f"{region['name']}_nodes.json"), folder_path.joinpath(f"{region['name']}_ways.json")
+
+
+def fetch_region(region: dict, settings: dict):
+    """
+    Downloads the region from Overpass to a raw file, skipped when the region files already exist
+    :return: number of downloaded elements
+    """
+    if all(x.exists() for x in region_files(region, settings)):
+        log.warning(f"Files for {region['name']} already exist")
+        return 0
+    raw_data = region_data_generator.get_raw_region_data(settings["url"], region["name"], landuse.overpass_filter(), 1)
+    file_path = raw_path(region, settings)
+    file_path.parent.mkdir(parents=True, exist_ok=True)
+    with file_path.open(mode="w", encoding="utf-8") as written_file:
+        json.dump(raw_data, written_file)
+    return len(raw_data["elements"])
+
+
+def parse_region(region: dict, settings: dict):
+    """
+    Turns the raw file into the region nodes and ways files, the raw file is removed afterwards
+    :return: number of nodes and ways
+    """
+    file_path = raw_path(region, settings)
+    if not file_path.exists():
+        return 0
+    with file_path.open(mode="r", encoding="utf-8") as read_file:
+        region_data = region_data_generator.get_region_data(json.load(read_file), region["id"])
+    folder_path = p.Path(settings["folder"])
+    folder_path.mkdir(parents=True, exist_ok=True)
+    region_data_generator.save_region_file(region_data, region["name"], folder_path)
+    file_path.unlink()
+    return len(region_data["nodes"]) + len(region_data["ways"])
+
+
+def load_region(region: dict, settings: dict):
+    """
+    Inserts the region files into the nodes and ways collections, as load_to_db.get_files
+    """
+    return load_to_db.load_region_files(p.Path(settings["folder"]), region["name"])
+
+
+def enrich_region(region: dict, settings: dict):
+    """
+    Copies the region nodes with coordinates arrays to testing_col and adds the landuse of their ways, as
+    create_geo_array_nodes.connect and add_ways_to_node.get_nodes_from_way. The region is converted from scratch,
+    the stages after enrich always run again with it
+    """
+    db = db_connection.get_db()
+    docs = create_geo_array_nodes.convert_region(region["id"], db_connection.get_collection("nodes", "read"),
+                                                 db_connection.get_collection("testing_col", "bulk"), clean=True)
+    add_ways_to_node.update_nodes_with_landuse(region["id"], {"nodes": 1, "landuse": 1, "id": 1, "_id": 0}, db)
+    return docs
+
+
+def distance_region(region: dict, settings: dict):
+    """
+    process_nodes.get_nodes_from_way for the region
+    :return: number of nodes without results before the call, counted per region as counters are shared by threads
+    """
+    query = {**landuse.code_filter(landuse.ALLOWABLE_LANDUSE), "region_id": region["id"],
+             "is_buildeable": {"$exists": False}}
+    docs = db_connection.get_collection("testing_col", "read").count_documents(query)
+    process_nodes.get_nodes_from_way(region["id"], merge=settings["merge"])
+    return docs
+
+
+def power_region(region: dict, settings: dict):
+    """
+    Results of get_power_areas for the region, written to the regions collection right away
+    :return: number of results fields
+    """
+    db = db_connection.get_db()
+    region_fields = get_power_areas.get_buildable_nodes(region["id"], settings["min_allowable_power"], db)
+    get_power_areas.write_region_results(db, {region["id"]: region_fields})
+    return len(region_fields)
+
+
+STAGE_FUNCTIONS = {"fetch": fetch_region, "parse": parse_region, "load": load_region, "enrich": enrich_region,
+                   "distance": distance_region, "power": power_region}
+
+
+def run_stage(stage: str, region: dict, settings: dict, own_metrics: bool = False):
+    """
+    Runs one stage of one region, also in a worker process
+    :param own_metrics: the process runs one stage at a time, so its counters are reset and returned
+    :return: number of processed documents and the counters of the call when own_metrics
+    """
+    if own_metrics:
+        metrics.reset()
+    docs = STAGE_FUNCTIONS[stage](region, settings)
+    return docs, metrics.report("region_pipeline")["counters"] if own_metrics else {}
+
+
+class Pipeline:
+    """
+    Runs the stages of many regions concurrently: while one region downloads, the previous one is enriched and the
+    one before computes distances. Every pool has a bounded queue of tasks, ready tasks of later stages go first,
+    and at most window regions are in the stages before the first stage waiting for neighbours, which bounds the
+    raw and region files held at once. With a job ledger, stages done by earlier runs are skipped, and failed stages
+    are retried with backoff in every case
+
+    Attributes:
+        regions (dict): region id -> region document with id, name and neighbours
+        settings (dict): values passed to the stage functions
+        workers (dict): pool -> number of workers
+        done (dict): stage -> set of region ids with the stage completed
+        failed (dict): region id -> stage which failed max_attempts times
+        inputs (dict): stage -> input hash, including the input hashes of the stages before it
+        records (list): one record per task with its region, stage, documents, times and pool
+    """
+
+    def __init__(self, regions: list, settings: dict, io_workers: int = IO_WORKERS, cpu_workers: int = CPU_WORKERS,
+                 queue_size: int = None, window: int = None, cpu_processes: bool = True, stages: dict = STAGES,
+                 ledger: job_ledger.JobLedger = None, max_attempts: int = job_ledger.MAX_ATTEMPTS,
+                 backoff: float = job_ledger.BACKOFF_SECONDS):
+        """
+        :param regions: region documents in the order they should start
+        :param queue_size: tasks waiting in each pool queue, twice the workers by default
+        :param window: regions started and not yet past the window stages, 2 + the workers of both pools by default
+        :param cpu_processes: run the cpu stages in spawned processes, threads are needed for an in-process database
+        :param ledger: job ledger recording the stages, None runs every stage, e.g. on a throwaway database
+        :param max_attempts: attempts of one stage of one region
+        :param backoff: seconds before the first retry, see job_ledger.backoff_delay
+        """
+        self.regions = {region["id"]: region for region in regions}
+        self.order = {region["id"]: position for position, region in enumerate(regions)}
+        self.settings = settings
+        self.stages = stages
+        self.stage_order = {stage: position for position, stage in enumerate(stages)}
+        self.workers = {"io": io_workers, "cpu": cpu_workers}
+        self.queues = {pool: queue.Queue(maxsize=queue_size or 2 * workers) for pool, workers in self.workers.items()}
+        self.window = window or 2 + io_workers + cpu_workers
+        first_waiting = next((x for x in stages if len(stages[x]["neighbours_after"]) != 0), None)
+        self.window_stages = list(stages)[:self.stage_order[first_waiting]] if first_waiting else list(stages)
+        self.cpu_processes = cpu_processes
+        # regions waiting on each region for a stage of their neighbours
+        self.dependants = {region_id: [x for x, region in self.regions.items() if region_id in region["neighbours"]]
+                           for region_id in self.regions}
+        self.ledger = ledger
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.inputs = stage_hashes(settings, stages)
+        self.done = {stage: set() for stage in stages}
+        if ledger is not None:
+            for stage, definition in stages.items():
+                regions_done = set(self.regions) - set(ledger.pending(stage, list(self.regions), self.inputs[stage]))
+                self.done[stage] = {x for x in regions_done if all(x in self.done[y] for y in definition["after"])}
+        self.failed = {}
+        self.records = []
+        self._attempts = {}
+        self._retries = []
+        self._events = queue.Queue()
+        self._ready = {pool: [] for pool in self.workers}
+        self._ready_times = {}
+        self._scheduled = set()
+        self._pending = list(self.regions)
+        self._started = set()
+
+    def run(self):
+        """
+        :return: throughput report, see report
+        """
+        start = time.perf_counter()
+        executor = None
+        if self.cpu_processes:
+            # spawned workers open their own database connections, a client must not be shared across fork
+            executor = concurrent.futures.ProcessPoolExecutor(self.workers["cpu"],
+                                                              mp_context=multiprocessing.get_context("spawn"))
+        threads = [threading.Thread(target=self._work, args=(pool, executor), name=f"pipeline-{pool}-{number}",
+                                    daemon=True)
+                   for pool, workers in self.workers.items() for number in range(workers)]
+        for thread in threads:
+            thread.start()
+        running = 0
+        try:
+            while True:
+                self._admit()
+                self._retry_due()
+                running = running + self._dispatch()
+                if running == 0:
+                    if len(self._retries) == 0:
+                        break
+                    time.sleep(max(self._retries[0][0] - time.time(), 0))
+                    continue
+                try:
+                    event = self._events.get(timeout=max(self._retries[0][0] - time.time(), 0)
+                                             if len(self._retries) != 0 else None)
+                except queue.Empty:
+                    continue
+                self._complete(event)
+                running = running - 1
+        finally:
+            for pool, workers in self.workers.items():
+                for _ in range(workers):
+                    self.queues[pool].put(None)
+            for thread in threads:
+                thread.join()
+            if executor is not None:
+                executor.shutdown()
+        return self.report(time.perf_counter() - start)
+
+    def _admit(self):
+        in_window = [x for x in self._started
+                     if x not in self.failed and not all(x in self.done[stage] for stage in self.window_stages)]
+        while len(self._pending) != 0 and len(in_window) < self.window:
+            region_id = self._pending.pop(0)
+            self._started.add(region_id)
+            in_window.append(region_id)
+            self._make_ready(region_id)
+
+    def _make_ready(self, region_id: int):
+        """Moves every stage of the region whose dependencies are done to the ready list of its pool"""
+        if region_id in self.failed:
+            return
+        for stage, definition in self.stages.items():
+            if (stage, region_id) in self._scheduled or region_id in self.done[stage]:
+                continue
+            neighbours = [x for x in self.regions[region_id]["neighbours"] if x in self.regions]
+            if all(region_id in self.done[x] for x in definition["after"]) and \
+                    all(x in self.done[y] for x in neighbours for y in definition["neighbours_after"]):
+                self._scheduled.add((stage, region_id))
+                self._ready_times[(stage, region_id)] = time.perf_counter()
+                heapq.heappush(self._ready[definition["pool"]],
+                               (-self.stage_order[stage], self.order[region_id], stage, region_id))
+
+    def _retry_due(self):
+        """Moves the failed tasks whose backoff passed back to the ready lists"""
+        while len(self._retries) != 0 and self._retries[0][0] <= time.time():
+            _, stage, region_id = heapq.heappop(self._retries)
+            self._ready_times[(stage, region_id)] = time.perf_counter()
+            heapq.heappush(self._ready[self.stages[stage]["pool"]],
+                           (-self.stage_order[stage], self.order[region_id], stage, region_id))
+
+    def _dispatch(self):
+        """Fills the pool queues with ready tasks, the queues being bounded the others stay in the ready lists"""
+        dispatched = 0
+        for pool, ready in self._ready.items():
+            while len(ready) != 0 and not self.queues[pool].full():
+                _, _, stage, region_id = heapq.heappop(ready)
+                self.queues[pool].put_nowait((stage, region_id, self._ready_times.pop((stage, region_id))))
+                dispatched = dispatched + 1
+        return dispatched
+
+    def _work(self, pool: str, executor):
+        while True:
+            task = self.queues[pool].get()
+            if task is None:
+                return
+            stage, region_id, ready_time = task
+            region = self.regions[region_id]
+            if self.ledger is not None:
+                self.ledger.start(stage, region_id, self.inputs[stage])
+            started = time.perf_counter()
+            try:
+                with metrics.stage(f"region_pipeline.{stage}", region_id=region_id):
+                    if pool == "cpu" and executor is not None:
+                        docs, counters = executor.submit(run_stage, stage, region, self.settings, True).result()
+                        for name, value in counters.items():
+                            metrics.count(name, value)
+                    else:
+                        docs, _ = run_stage(stage, region, self.settings)
+                error = None
+            except Exception as exception:
+                log.exception(f"Stage {stage} of region {region_id} failed")
+                docs, error = 0, repr(exception)
+            self._events.put({"stage": stage, "region_id": region_id, "pool": pool, "docs": docs, "error": error,
+                              "ready": ready_time, "started": started, "finished": time.perf_counter()})
+
+    def _complete(self, record: dict):
+        self.records.append(record)
+        stage, region_id = record["stage"], record["region_id"]
+        seconds = record["finished"] - record["started"]
+        if record["error"] is not None:
+            if self.ledger is not None:
+                self.ledger.fail(stage, region_id, record["error"], seconds)
+            attempts = self._attempts.get((stage, region_id), 0) + 1
+            self._attempts[(stage, region_id)] = attempts
+            if attempts < self.max_attempts:
+                delay = job_ledger.backoff_delay(attempts, self.backoff)
+                heapq.heappush(self._retries, (time.time() + delay, stage, region_id))
+                log.warning(f"Retrying stage {stage} of region {region_id} in {delay:.0f} s")
+            else:
+                self.failed[region_id] = stage
+            return
+        if self.ledger is not None:
+            self.ledger.finish(stage, region_id, seconds)
+        self.done[stage].add(region_id)
+        for x in [region_id] + self.dependants[region_id]:
+            if x in self._started:
+                self._make_ready(x)
+
+    def report(self, wall_seconds: float):
+        """
+        Throughput of every stage and utilization of every pool. The bottleneck is the stage with the most busy
+        time per worker of its pool, the stage limiting the regions finished per hour
+        :return: dictionary
+        """
+        stages = {}
+        for stage, definition in self.stages.items():
+            records = [x for x in self.records if x["stage"] == stage]
+            busy = sum(x["finished"] - x["started"] for x in records)
+            docs = sum(x["docs"] for x in records)
+            stages[stage] = {"pool": definition["pool"], "regions": len(self.done[stage]),
+                             "failed": sum(x["error"] is not None for x in records), "docs": docs,
+                             "busy_seconds": busy, "mean_seconds": busy / len(records) if len(records) != 0 else 0,
+                             "mean_wait_seconds": sum(x["started"] - x["ready"] for x in records) / len(records)
+                             if len(records) != 0 else 0,
+                             "docs_per_sec": docs / busy if busy > 0 else 0,
+                             "load": busy / self.workers[definition["pool"]]}
+        pools = {pool: {"workers": workers,
+                        "utilization": sum(x["busy_seconds"] for x in stages.values() if x["pool"] == pool) /
+                        (workers * wall_seconds) if wall_seconds > 0 else 0}
+                 for pool, workers in self.workers.items()}
+        bottleneck = max(stages, key=lambda x: stages[x]["load"]) if len(self.records) != 0 else None
+        completed = len(self.done[list(self.stages)[-1]])
+        return {"wall_seconds": wall_seconds, "regions": len(self.regions), "completed": completed,
+                "regions_per_hour": completed / wall_seconds * 3600 if wall_seconds > 0 else 0,
+                "failed": {str(k): v for k, v in self.failed.items()},
+                "blocked": sorted(set(self.regions) - set(self.failed) - self.done[list(self.stages)[-1]]),
+                "bottleneck": bottleneck, "stages": stages, "pools": pools}
+
+
+def load_regions(db, region_ids: list = None):
+    """
+    :param region_ids: ids of the regions to run, all regions of the regions collection when not given
+    :return: region documents with id, name and neighbours, ordered by id
+    """
+    query = {} if region_ids is None else {"id": {"$in": region_ids}}
+    regions = []
+    for region in db["regions"].find(query, {"_id": 0, "id": 1, "name": 1, "neighbours": 1}).sort("id", 1):
+        neighbours = region.get("neighbours", [])
+        region["neighbours"] = neighbours if isinstance(neighbours, list) else [neighbours]
+        regions.append(region)
+    return regions
+
+
+def log_report(report: dict):
+    for stage, values in report["stages"].items():
+        log.info(f"{stage:>10} ({values['pool']}): {values['regions']:4d} regions {values['busy_seconds']:9.1f} s busy "
+                 f"{values['mean_wait_seconds']:7.2f} s waiting {values['docs_per_sec']:10.0f} docs/s")
+    for pool, values in report["pools"].items():
+        log.info(f"{pool} pool: {values['workers']} workers, {values['utilization']:.0%} busy")
+    log.info(f"{report['completed']}/{report['regions']} regions in {report['wall_seconds']:.1f} s, "
+             f"bottleneck: {report['bottleneck']}")
+
+
+def save_report(report: dict, folder_name: str = metrics.REPORT_FOLDER):
+    folder_path: p.Path = p.Path.cwd().joinpath(folder_name)
+    folder_path.mkdir(parents=True, exist_ok=True)
+    file_path = folder_path.joinpath(f"region_pipeline_throughput_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    with file_path.open(mode="w", encoding="utf-8") as written_file:
+        json.dump(report, written_file, indent=2)
+    log.info(f"Throughput report saved to {file_path}")
+    return file_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs all stages of the regions concurrently")
+    parser.add_argument("--regions", type=int, nargs="*", help="region ids, all regions of the regions collection by default")
+    parser.add_argument("--io-workers", type=int, default=IO_WORKERS)
+    parser.add_argument("--cpu-workers", type=int, default=CPU_WORKERS)
+    parser.add_argument("--queue-size", type=int, help="tasks waiting in each pool queue")
+    parser.add_argument("--window", type=int, help="regions downloading, parsing, loading or enriching at once")
+    parser.add_argument("--min-power", type=int, default=MIN_POWER, help="minimal power limit for one area, MW")
+    parser.add_argument("--folder", default=REGION_FOLDER)
+    parser.add_argument("--url", default=OVERPASS_URL)
+    args = parser.parse_args()
+
+    pipeline = Pipeline(load_regions(db_connection.get_db(), args.regions),
+                        {"url": args.url, "folder": args.folder, "min_allowable_power": args.min_power, "merge": True},
+                        args.io_workers, args.cpu_workers, args.queue_size, args.window,
+                        ledger=job_ledger.get_ledger())
+    pipeline_report = pipeline.run()
+    log_report(pipeline_report)
+    save_report(pipeline_report)
+    metrics.write_report("region_pipeline")
@@ -0,0 +1,325 @@
+import argparse
+import itertools
+import json
+import logging as log
+import os
+import pathlib as p
+import shutil
+import time
+import typing
+
+import numpy as np
+
+import landuse
+from region_data_generator import RawNode, Way, RegionNode
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+log.getLogger().setLevel(log.INFO)
+log.basicConfig(format="%(asctime)s - [%(levelname)s]: %(message)s", datefmt="%H:%M:%S")
+
+JSON_FOLDER = "region_data_files"
+STORE_FOLDER = os.environ.get("MGR_REGION_STORE", "region_store")
+STORE_FORMAT = 1 # bumped when the layout of the columnar folders changes
+MANIFEST_FILE = "manifest.json"
+DTYPES = {"int": np.int64, "float": np.float64, "landuse": np.uint8, "int_list": np.int64}
+
+
+class RegionResultNode(RegionNode):
+    """Class definition for RegionResultNode type hint, the nodes of the files in region_data_files
+
+    Attributes:
+        closest_distance_restriction (float): distance to the closest restriction in km
+    """
+
+    closest_distance_restriction: float
+
+
+RECORD_TYPES = {"raw_node": RawNode, "way": Way, "region_node": RegionNode, "region_result_node": RegionResultNode}
+
+
+def schema(record_type: str):
+    """
+    Column kind of every field of a record type: int, float, landuse (a tag stored as its landuse code) or
+    int_list (stored flat with offsets)
+    :param record_type: key of RECORD_TYPES
+    :return: dictionary field -> kind
+    """
+    kinds = {}
+    for field, hint in typing.get_type_hints(RECORD_TYPES[record_type]).items():
+        if hint is int or hint is float:
+            kinds[field] = hint.__name__
+        elif hint is str and field == "landuse":
+            kinds[field] = "landuse"
+        elif typing.get_origin(hint) is list and typing.get_args(hint) == (int,):
+            kinds[field] = "int_list"
+        else:
+            raise TypeError(f"No column kind for {field}: {hint}")
+    return kinds
+
+
+def loads(line):
+    return orjson.loads(line) if orjson is not None else json.loads(line)
+
+
+def dumps(record: dict):
+    return orjson.dumps(record) + b"\n" if orjson is not None else (json.dumps(record) + "\n").encode("utf-8")
+
+
+def encode_records(records: list, record_type: str = "region_result_node"):
+    """
+    Typed columns of a list of records, landuse tags missing from the registry become landuse.UNKNOWN_CODE
+    :return: dictionary column -> array, int_list fields add a <field>_offsets column
+    """
+    columns = {}
+    for field, kind in schema(record_type).items():
+        values = [record[field] for record in records]
+        if kind == "int_list":
+            lengths = np.fromiter(map(len, values), dtype=np.int64, count=len(values))
+            columns[f"{field}_offsets"] = np.concatenate(([0], np.cumsum(lengths)))
+            columns[field] = np.fromiter(itertools.chain.from_iterable(values), dtype=np.int64,
+                                         count=int(lengths.sum()))
+        elif kind == "landuse":
+            columns[field] = np.fromiter(map(landuse.tag_code, values), dtype=np.uint8, count=len(values))
+        else:
+            columns[field] = np.array(values, dtype=DTYPES[kind])
+    return columns
+
+
+def concatenate_columns(batches: list, record_type: str = "region_result_node"):
+    if len(batches) == 0:
+        return encode_records([], record_type)
+    columns = {}
+    for field, kind in schema(record_type).items():
+        columns[field] = np.concatenate([batch[field] for batch in batches])
+        if kind == "int_list":
+            ends = np.cumsum([batch[f"{field}_offsets"][-1] for batch in batches])
+            starts = np.concatenate(([0], ends[:-1]))
+            columns[f"{field}_offsets"] = np.concatenate(
+                [[0]] + [batch[f"{field}_offsets"][1:] + start for batch, start in zip(batches, starts)])
+    return columns
+
+
+def decode_records(columns: dict, record_type: str = "region_result_node"):
+    """
+    Records back from typed columns, e.g. for code expecting the dictionaries of the JSON files
+    :return: generator of dictionaries
+    """
+    kinds = schema(record_type)
+    lists = {}
+    for field, kind in kinds.items():
+        if kind == "int_list":
+            offsets = columns[f"{field}_offsets"]
+            values = columns[field].tolist()
+            lists[field] = [values[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+        elif kind == "landuse":
+            lists[field] = [landuse.LANDUSE_NAMES.get(code) for code in columns[field].tolist()]
+        else:
+            lists[field] = columns[field].tolist()
+    for values in zip(*lists.values()):
+        yield dict(zip(kinds, values))
+
+
+def write_ndjson(records, file_path: p.Path):
+    """
+    One record per line, so the file can be read in batches without decoding it whole
+    """
+    tmp_path = file_path.with_name(file_path.name + ".tmp")
+    with tmp_path.open(mode="wb") as written_file:
+        for record in records:
+            written_file.write(dumps(record))
+    tmp_path.replace(file_path)
+
+
+def stream_ndjson(file_path: p.Path, batch_size: int = 10000):
+    """
+    :return: generator of lists of at most batch_size records
+    """
+    with file_path.open(mode="rb") as read_file:
+        while True:
+            batch = [loads(line) for line in itertools.islice(read_file, batch_size)]
+            if len(batch) == 0:
+                return
+            yield batch
+
+
+def read_ndjson(file_path: p.Path, record_type: str = "region_result_node", batch_size: int = 10000):
+    """
+    Typed columns of a line delimited file, only one batch of records is decoded to dictionaries at a time
+    """
+    return concatenate_columns([encode_records(batch, record_type) for batch in stream_ndjson(file_path, batch_size)],
+                               record_type)
+
+
+def write_columns(columns: dict, folder_path: p.Path, record_type: str, source_mtime: float = None):
+    """
+    Saves every column as an .npy file with a manifest, written to a temporary folder first so readers never see
+    a partial region
+    :param source_mtime: modification time of the file the columns were converted from, to detect stale copies
+    """
+    tmp_path = folder_path.with_name(folder_path.name + ".tmp")
+    if tmp_path.exists():
+        shutil.rmtree(tmp_path)
+    tmp_path.mkdir(parents=True)
+    for name, values in columns.items():
+        np.save(tmp_path.joinpath(f"{name}.npy"), values)
+    manifest = {"format": STORE_FORMAT, "record_type": record_type, "source_mtime": source_mtime,
+                "count": len(next(iter(columns.values()))) if len(columns) != 0 else 0,
+                "columns": {name: str(values.dtype) for name, values in columns.items()}}
+    with tmp_path.joinpath(MANIFEST_FILE).open(mode="w", encoding="utf-8") as written_file:
+        json.dump(manifest, written_file, indent=2)
+    if folder_path.exists():
+        shutil.rmtree(folder_path)
+    tmp_path.rename(folder_path)
+
+
+def read_manifest(folder_path: p.Path):
+    """
+    :return: manifest of a columnar folder, None when it is missing or has another format
+    """
+    manifest_path = folder_path.joinpath(MANIFEST_FILE)
+    if not manifest_path.exists():
+        return None
+    with manifest_path.open(mode="r", encoding="utf-8") as read_file:
+        manifest = json.load(read_file)
+    return manifest if manifest.get("format") == STORE_FORMAT else None
+
+
+def read_columns(folder_path: p.Path, mmap: bool = True):
+    """
+    :param mmap: memory map the columns, pages are read from disk only when used
+    :return: dictionary column -> array
+    """
+    manifest = read_manifest(folder_path)
+    if manifest is None:
+        raise FileNotFoundError(f"No columnar region in {folder_path}")
+    return {name: np.load(folder_path.joinpath(f"{name}.npy"), mmap_mode="r" if mmap else None)
+            for name in manifest["columns"]}
+
+
+def read_json(file_path: p.Path, record_type: str = "region_result_node"):
+    with file_path.open(mode="r", encoding="utf-8-sig") as read_file:
+        return encode_records(json.load(read_file)["nodes"], record_type)
+
+
+def load_region(region_name: str, json_folder: str = JSON_FOLDER, store_folder: str = STORE_FOLDER,
+                mmap: bool = True):
+    """
+    Typed columns of a region from the fastest available copy: the columnar folder, then the NDJSON file, then
+    the original JSON file. Copies older than the JSON file are skipped
+    :param region_name: name of the region file without extension
+    :return: dictionary column -> array
+    """
+    json_path = p.Path(json_folder).joinpath(f"{region_name}.json")
+    store_path = p.Path(store_folder)
+    source_mtime = json_path.stat().st_mtime if json_path.exists() else None
+
+    columns_path = store_path.joinpath(region_name)
+    manifest = read_manifest(columns_path)
+    if manifest is not None and (source_mtime is None or manifest["source_mtime"] == source_mtime):
+        return read_columns(columns_path, mmap)
+    ndjson_path = store_path.joinpath(f"{region_name}.ndjson")
+    if ndjson_path.exists() and (source_mtime is None or ndjson_path.stat().st_mtime >= source_mtime):
+        return read_ndjson(ndjson_path)
+    return read_json(json_path)
+
+
+def region_frame(region_name: str, json_folder: str = JSON_FOLDER, store_folder: str = STORE_FOLDER):
+    """
+    Region nodes as a DataFrame with the columns and landuse names of the JSON files
+    """
+    import pandas as pd
+
+    columns = load_region(region_name, json_folder, store_folder)
+    frame = pd.DataFrame({name: np.asarray(values) for name, values in columns.items()})
+    frame["landuse"] = frame["landuse"].map(landuse.LANDUSE_NAMES)
+    return frame
+
+
+def convert_region(json_path: p.Path, store_folder: str = STORE_FOLDER, formats: tuple = ("columns", "ndjson")):
+    """
+    Writes the columnar and NDJSON copies of one region file
+    """
+    store_path = p.Path(store_folder)
+    store_path.mkdir(parents=True, exist_ok=True)
+    with json_path.open(mode="r", encoding="utf-8-sig") as read_file:
+        nodes = json.load(read_file)["nodes"]
+    if "columns" in formats:
+        write_columns(encode_records(nodes), store_path.joinpath(json_path.stem), "region_result_node",
+                      json_path.stat().st_mtime)
+    if "ndjson" in formats:
+        write_ndjson(nodes, store_path.joinpath(f"{json_path.stem}.ndjson"))
+
+
+def convert_folder(json_folder: str = JSON_FOLDER, store_folder: str = STORE_FOLDER,
+                   formats: tuple = ("columns", "ndjson")):
+    """
+    Converts every region file which has no up to date copy yet
+    """
+    converted = 0
+    for json_path in sorted(p.Path(json_folder).glob("*.json")):
+        manifest = read_manifest(p.Path(store_folder).joinpath(json_path.stem))
+        ndjson_path = p.Path(store_folder).joinpath(f"{json_path.stem}.ndjson")
+        columns_done = "columns" not in formats or (manifest is not None and
+                                                   manifest["source_mtime"] == json_path.stat().st_mtime)
+        ndjson_done = "ndjson" not in formats or (ndjson_path.exists() and
+                                                 ndjson_path.stat().st_mtime >= json_path.stat().st_mtime)
+        if columns_done and ndjson_done:
+            continue
+        convert_region(json_path, store_folder, formats)
+        converted = converted + 1
+    log.info(f"Converted {converted} region files to {store_folder}")
+
+
+def benchmark_loads(region_names: list, json_folder: str = JSON_FOLDER, store_folder: str = STORE_FOLDER,
+                    repeat: int = 3):
+    """
+    Best load time of every format, the columnar one with and without memory mapping. A column sum makes the
+    mapped loads read their pages
+    :return: dictionary region -> format -> seconds
+    """
+    def json_load(region_name):
+        with p.Path(json_folder).joinpath(f"{region_name}.json").open(mode="r", encoding="utf-8-sig") as read_file:
+            return json.load(read_file)["nodes"]
+
+    loaders = {
+        "json": json_load,
+        "json_columns": lambda x: read_json(p.Path(json_folder).joinpath(f"{x}.json")),
+        "ndjson_columns": lambda x: read_ndjson(p.Path(store_folder).joinpath(f"{x}.ndjson")),
+        "columns": lambda x: read_columns(p.Path(store_folder).joinpath(x), mmap=False),
+        "columns_mmap": lambda x: read_columns(p.Path(store_folder).joinpath(x), mmap=True),
+    }
+    results = {}
+    for region_name in region_names:
+        results[region_name] = {}
+        for name, loader in loaders.items():
+            timings = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                data = loader(region_name)
+                if isinstance(data, dict):
+                    float(np.sum(data["lat"]))
+                timings.append(time.perf_counter() - start)
+            results[region_name][name] = min(timings)
+        log.info(f"{region_name}: " + ", ".join(f"{name} {seconds * 1000:.1f} ms"
+                                                for name, seconds in results[region_name].items()))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Columnar and NDJSON copies of region_data_files")
+    parser.add_argument("command", choices=["convert", "benchmark"])
+    parser.add_argument("--regions", nargs="*", default=["powiat starachowicki", "powiat kutnowski",
+                                                         "powiat wąbrzeski"])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.command == "convert":
+        convert_folder()
+    else:
+        for region in args.regions:
+            convert_region(p.Path(JSON_FOLDER).joinpath(f"{region}.json"))
+        benchmark_loads(args.regions, repeat=args.repeat)
@@ -0,0 +1,159 @@
+import json
+import logging as log
+import pathlib as p
+import re
+
+import pandas as pd
+import requests
+import shapely
+from shapely.ops import linemerge, polygonize
+
+import db_connection
+
+log.getLogger().setLevel(log.INFO)
+log.basicConfig(format="%(asctime)s - [%(levelname)s]: %(message)s", datefmt="%H:%M:%S")
+
+OVERPASS_URL = "http://overpass-api.de/api/interpreter"
+BOUNDARIES_FILE = "powiat_boundaries.geojson"
+SIMPLIFY_TOLERANCE = 0.005 # degrees, about 500 m, enough for a national map
+COORDINATE_PRECISION = 1e-4 # degrees, rounding of the saved boundaries
+# results fields written by get_power_areas.result_fields, e.g. results_500m_min30MW
+RESULTS_FIELD = re.compile(r"^results_(\d+)m_min(\d+)MW$")
+SUMMARY_COLUMNS = ["region_id", "name", "min_distance", "min_allowable_power", "overall_area", "overall_power",
+                   "node_number"]
+
+
+def summary_rows(region_id: int, name: str, fields: dict):
+    """
+    :param fields: results fields of one region, field name -> overall_area, overall_power, node_number
+    :return: one row with SUMMARY_COLUMNS keys per results field, the setback in km
+    """
+    rows = []
+    for field, values in fields.items():
+        match = RESULTS_FIELD.match(field)
+        if match is None:
+            continue
+        rows.append({"region_id": region_id, "name": name, "min_distance": int(match.group(1)) / 1e3,
+                     "min_allowable_power": int(match.group(2)), "overall_area": values["overall_area"],
+                     "overall_power": values["overall_power"], "node_number": values["node_number"]})
+    return rows
+
+
+def load_region_summaries(db):
+    """
+    Results of every region from the regions collection, without any node data
+    :return: DataFrame with SUMMARY_COLUMNS
+    """
+    rows = []
+    for region in db["regions"].find({}, {"_id": 0, "ways": 0, "neighbours": 0}):
+        rows.extend(summary_rows(region["id"], region.get("name"), region))
+    log.info(f"Loaded {len(rows)} results of {len({row['region_id'] for row in rows})} regions")
+    return pd.DataFrame(rows, columns=SUMMARY_COLUMNS)
+
+
+def load_results_file(fname: str, region_names: dict = None):
+    """
+    Results saved by get_power_areas.save_region_results instead of the database
+    :param fname: .json or .parquet file
+    :param region_names: optional dictionary region_id -> name
+    """
+    region_names = region_names or {}
+    file_path: p.Path = p.Path.cwd().joinpath(fname)
+    if file_path.suffix == ".parquet":
+        frame = pd.read_parquet(file_path)
+        rows = []
+        for region_id, group in frame.groupby("region_id"):
+            fields = {row["result"]: row for row in group.to_dict("records")}
+            rows.extend(summary_rows(int(region_id), region_names.get(int(region_id)), fields))
+    else:
+        with file_path.open(mode="r", encoding="utf-8") as read_file:
+            results = json.load(read_file)
+        rows = [row for region_id, fields in results.items()
+                for row in summary_rows(int(region_id), region_names.get(int(region_id)), fields)]
+    return pd.DataFrame(rows, columns=SUMMARY_COLUMNS)
+
+
+def fetch_boundaries(url: str = OVERPASS_URL):
+    """
+    Administrative boundaries of all powiats (admin_level 6) of Poland with their member way geometries
+    :return: list of Overpass relation elements
+    """
+    query = """
+    [out:json][timeout:600];
+    area["ISO3166-1"="PL"][admin_level=2]->.poland;
+    relation["boundary"="administrative"]["admin_level"="6"](area.poland);
+    out geom;
+    """
+    response = requests.get(url, params={"data": query}, timeout=900)
+    log.info(f"The response from the server: {response.status_code}")
+    response.raise_for_status()
+    return [element for element in response.json()["elements"] if element["type"] == "relation"]
+
+
+def relation_polygon(relation: dict):
+    """
+    Polygon of a boundary relation, outer rings minus inner rings, e.g. a city powiat inside a land powiat
+    """
+    rings = {"outer": [], "inner": []}
+    for member in relation["members"]:
+        if member["type"] == "way" and member.get("role") in rings and len(member.get("geometry", [])) >= 2:
+            rings[member["role"]].append(shapely.linestrings([[x["lon"], x["lat"]] for x in member["geometry"]]))
+
+    def area(lines):
+        if len(lines) == 0:
+            return shapely.Polygon()
+        return shapely.union_all(list(polygonize(linemerge(lines))))
+
+    return shapely.difference(area(rings["outer"]), area(rings["inner"]))
+
+
+def build_boundaries(relations: list, region_ids: dict, tolerance: float = SIMPLIFY_TOLERANCE):
+    """
+    :param region_ids: dictionary name -> region id of the regions collection, relations of other names are skipped
+    :return: GeoJSON FeatureCollection with simplified geometries and id and name properties
+    """
+    features = []
+    for relation in relations:
+        name = relation.get("tags", {}).get("name")
+        if name not in region_ids:
+            continue
+        polygon = shapely.simplify(relation_polygon(relation), tolerance, preserve_topology=True)
+        polygon = shapely.set_precision(polygon, COORDINATE_PRECISION)
+        if polygon.is_empty:
+            log.warning(f"No boundary geometry for {name}")
+            continue
+        features.append({"type": "Feature", "properties": {"id": region_ids[name], "name": name},
+                         "geometry": json.loads(shapely.to_geojson(polygon))})
+    missing = set(region_ids) - {feature["properties"]["name"] for feature in features}
+    if len(missing) != 0:
+        log.warning(f"No boundary for {len(missing)} regions: {sorted(missing)[:10]}")
+    return {"type": "FeatureCollection", "features": features}
+
+
+def save_boundaries(db, fname: str = BOUNDARIES_FILE):
+    """
+    Downloads, simplifies and saves the powiat boundaries, matched to the regions collection by name
+    """
+    region_ids = {region["name"]: region["id"] for region in db["regions"].find({}, {"_id": 0, "id": 1, "name": 1})}
+    boundaries = build_boundaries(fetch_boundaries(), region_ids)
+    file_path: p.Path = p.Path.cwd().joinpath(fname)
+    with file_path.open(mode="w", encoding="utf-8") as written_file:
+        json.dump(boundaries, written_file, separators=(",", ":"))
+    log.info(f"Boundaries of {len(boundaries['features'])} regions saved to {fname}, "
+             f"{file_path.stat().st_size / 1e6:.1f} MB")
+
+
+def load_boundaries(fname: str = BOUNDARIES_FILE):
+    """
+    :return: GeoJSON FeatureCollection saved by save_boundaries, None when the file was not created yet
+    """
+    file_path: p.Path = p.Path.cwd().joinpath(fname)
+    if not file_path.exists():
+        log.warning(f"No boundaries file {fname}, run region_summaries.py to create it")
+        return None
+    with file_path.open(mode="r", encoding="utf-8") as read_file:
+        return json.load(read_file)
+
+
+if __name__ == "__main__":
+    save_boundaries(db_connection.get_db())
@@ -0,0 +1,393 @@
+import datetime
+import hashlib
+import json
+import logging as log
+import math
+import multiprocessing
+import os
+import pathlib as p
+import shutil
+import time
+import numpy as np
+from multiprocessing import shared_memory
+from node_store import NodeStore
+from way_buildable import refresh_way_buildable
+from landuse import ALLOWABLE_LANDUSE, RESTRICTING_LANDUSE
+import db_connection
+import job_ledger
+import landuse
+import metrics
+import process_nodes
+
+log.getLogger().setLevel(log.INFO)
+log.basicConfig(format="%(asctime)s - [%(levelname)s]: %(message)s", datefmt="%H:%M:%S")
+
+CELL_SIZE = process_nodes.LIMIT_COORDINATES # degrees, a node subset of get_subset_restricting_nodes spans 3x3 cells
+KEY_STRIDE = 1 << 32 # cell key = column * KEY_STRIDE + row
+INDEX_FOLDER = os.environ.get("MGR_INDEX_DIR", "restriction_index")
+INDEX_FORMAT = 2 # bump when the layout of the saved arrays changes, saved indexes are then rebuilt
+# prime below 2**25, every product of the node hashes stays exact in doubles and longs of the database
+HASH_MODULUS = 33554393
+HASH_MULTIPLIERS = [16777619, 1000003]
+LEDGER_STAGE = process_nodes.LEDGER_STAGE
+# name and dtype of the arrays kept in the shared block, in this order
+COLUMNS = [("ids", np.int64), ("lon", np.float64), ("lat", np.float64), ("region_ids", np.int32),
+           ("cell_keys", np.int64), ("cell_starts", np.int64), ("cell_rows", np.int64), ("landuse", np.uint8)]
+
+
+class RestrictionIndex:
+    """
+    Restricting nodes of the whole country with a grid index. The arrays are either kept in one shared memory block,
+    owned by the process which built the index, or memory-mapped from a saved index folder. Worker processes attach
+    by descriptor without copying, in both cases the operating system holds one copy of the arrays
+
+    Attributes:
+        descriptor (dict): everything a worker needs to attach: block name or index folder, array lengths and grid
+    """
+
+    def __init__(self, arrays: dict, descriptor: dict, block=None, owner: bool = False):
+        self.block = block
+        self.descriptor = descriptor
+        self.owner = owner
+        for name, _ in COLUMNS:
+            setattr(self, name, arrays[name])
+
+    @classmethod
+    def create(cls, store: NodeStore, region_ids):
+        """
+        Builds the grid over the nodes and copies everything into a new shared memory block
+        :param store: restricting nodes
+        :param region_ids: region id of every node of the store
+        """
+        arrays, grid = build_arrays(store, region_ids)
+        lengths = {name: len(arrays[name]) for name, _ in COLUMNS}
+        nbytes = sum(lengths[name] * np.dtype(dtype).itemsize for name, dtype in COLUMNS)
+        block = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+        descriptor = {"name": block.name, "lengths": lengths, **grid}
+        shared_arrays = block_arrays(block, lengths)
+        for name, _ in COLUMNS:
+            shared_arrays[name][:] = arrays[name]
+        log.info(f"Restriction index of {len(store)} nodes in {lengths['cell_keys']} cells, {nbytes / 1e6:.1f} MB shared")
+
+        return cls(shared_arrays, descriptor, block, owner=True)
+
+    @classmethod
+    def attach(cls, descriptor: dict):
+        if "path" in descriptor:
+            return cls.load(descriptor["path"])
+        block = shared_memory.SharedMemory(name=descriptor["name"])
+        return cls(block_arrays(block, descriptor["lengths"]), descriptor, block)
+
+    @classmethod
+    def load(cls, folder_name: str):
+        """
+        Memory-maps a saved index, only the pages touched by queries are read from disk
+        :param folder_name: folder written by save
+        """
+        folder_path: p.Path = p.Path(folder_name)
+        with folder_path.joinpath("manifest.json").open(mode="r", encoding="utf-8") as read_file:
+            manifest = json.load(read_file)
+        arrays = {name: np.load(folder_path.joinpath(f"{name}.npy"), mmap_mode="r") for name, _ in COLUMNS}
+        descriptor = {"path": str(folder_path), "lengths": manifest["lengths"], "origin": manifest["origin"],
+                      "columns": manifest["columns"], "source_hash": manifest["source_hash"]}
+
+        return cls(arrays, descriptor)
+
+    def save(self, folder_name: str, source_hash: str):
+        """
+        Writes the arrays as .npy files with a manifest. The folder is written under a temporary name and renamed,
+        so a reader never sees a partial index
+        :param source_hash: fingerprint of the restricting nodes the index was built from, see source_fingerprint
+        """
+        folder_path: p.Path = p.Path(folder_name)
+        temporary_path = folder_path.with_name(folder_path.name + ".tmp")
+        if temporary_path.exists():
+            shutil.rmtree(temporary_path)
+        temporary_path.mkdir(parents=True)
+        for name, _ in COLUMNS:
+            np.save(temporary_path.joinpath(f"{name}.npy"), np.asarray(getattr(self, name)))
+        manifest = {"source_hash": source_hash, "format": INDEX_FORMAT, "cell_size": CELL_SIZE,
+                    "created": datetime.datetime.now().isoformat(timespec="seconds"),
+                    "lengths": self.descriptor["lengths"], "origin": self.descriptor["origin"],
+                    "columns": self.descriptor["columns"]}
+        with temporary_path.joinpath("manifest.json").open(mode="w", encoding="utf-8") as written_file:
+            json.dump(manifest, written_file, indent=2)
+        if folder_path.exists():
+            shutil.rmtree(folder_path)
+        os.replace(temporary_path, folder_path)
+        log.info(f"Restriction index saved to {folder_path}")
+
+    def close(self):
+        """Detaches the arrays, the owner of a shared block also frees it"""
+        for name, _ in COLUMNS:
+            setattr(self, name, None)
+        if self.block is not None:
+            self.block.close()
+            if self.owner:
+                self.block.unlink()
+
+    def rows_within(self, min_lon: float, min_lat: float, max_lon: float, max_lat: float):
+        """
+        :return: sorted row numbers of the nodes in the box, borders included, in the order they were loaded
+        """
+        origin, columns = self.descriptor["origin"], self.descriptor["columns"]
+        first_column = max(int(math.floor((min_lon - origin[0]) / CELL_SIZE)), 0)
+        last_column = min(int(math.floor((max_lon - origin[0]) / CELL_SIZE)), columns - 1)
+        first_row = max(int(math.floor((min_lat - origin[1]) / CELL_SIZE)), 0)
+        last_row = int(math.floor((max_lat - origin[1]) / CELL_SIZE))
+        if first_column > last_column or last_row < first_row:
+            return np.empty(0, dtype=np.int64)
+
+        parts = []
+        #cells of one grid column have consecutive keys, so each column is one slice of cell_rows
+        for column in range(first_column, last_column + 1):
+            start = np.searchsorted(self.cell_keys, column * KEY_STRIDE + first_row, side="left")
+            stop = np.searchsorted(self.cell_keys, column * KEY_STRIDE + last_row, side="right")
+            if start < stop:
+                parts.append(self.cell_rows[self.cell_starts[start]:self.cell_starts[stop]])
+        if len(parts) == 0:
+            return np.empty(0, dtype=np.int64)
+        rows = np.sort(np.concatenate(parts))
+        mask = ((self.lon[rows] >= min_lon) & (self.lon[rows] <= max_lon) &
+                (self.lat[rows] >= min_lat) & (self.lat[rows] <= max_lat))
+
+        return rows[mask]
+
+    def region_nodes(self, region_bbox: list, region_ids: list):
+        """
+        Restricting nodes of the given regions closer than LIMIT_COORDINATES to the box, the same nodes
+        process_nodes.get_restricting_nodes reads from the collection
+        :param region_bbox: [min_lon, min_lat, max_lon, max_lat]
+        :param region_ids: list of region ids
+        :return: NodeStore, a copy of the selected rows only
+        """
+        limit = process_nodes.LIMIT_COORDINATES
+        rows = self.rows_within(region_bbox[0] - limit, region_bbox[1] - limit,
+                                region_bbox[2] + limit, region_bbox[3] + limit)
+        rows = rows[np.isin(self.region_ids[rows], region_ids)]
+
+        return NodeStore(self.ids[rows], self.lon[rows], self.lat[rows], landuse=self.landuse[rows])
+
+
+def build_arrays(store: NodeStore, region_ids):
+    """
+    Sorts the rows of the store by grid cell
+    :return: dictionary of COLUMNS arrays and grid origin and number of columns
+    """
+    origin = [float(store.lon.min()), float(store.lat.min())] if len(store) != 0 else [0., 0.]
+    columns = int(math.floor((float(store.lon.max()) - origin[0]) / CELL_SIZE)) + 1 if len(store) != 0 else 1
+    keys = cell_keys(store.lon, store.lat, origin, columns)
+    cell_rows = np.argsort(keys, kind="stable")
+    unique_keys, cell_starts = np.unique(keys[cell_rows], return_index=True)
+    arrays = {"ids": store.ids, "lon": store.lon, "lat": store.lat, "landuse": store.landuse,
+              "region_ids": np.asarray(region_ids, dtype=np.int32), "cell_keys": unique_keys,
+              "cell_starts": np.append(cell_starts, len(keys)).astype(np.int64), "cell_rows": cell_rows.astype(np.int64)}
+
+    return arrays, {"origin": origin, "columns": columns}
+
+
+def block_arrays(block, lengths: dict):
+    """Arrays laid out one after another in the shared memory block"""
+    arrays = {}
+    offset = 0
+    for name, dtype in COLUMNS:
+        arrays[name] = np.ndarray((lengths[name],), dtype=dtype, buffer=block.buf, offset=offset)
+        offset = offset + lengths[name] * np.dtype(dtype).itemsize
+    return arrays
+
+
+def cell_keys(lon, lat, origin: list, columns: int):
+    cell_columns = np.floor((lon - origin[0]) / CELL_SIZE).astype(np.int64)
+    cell_rows = np.floor((lat - origin[1]) / CELL_SIZE).astype(np.int64)
+    return np.clip(cell_columns, 0, columns - 1) * KEY_STRIDE + cell_rows
+
+
+def load_restrictions(collection):
+    """
+    Reads all restricting nodes of the country once, batch by batch
+    :return: NodeStore and region id of every node
+    """
+    stores, region_ids = [], []
+    for batch in db_connection.stream(collection, landuse.code_filter(RESTRICTING_LANDUSE),
+                                      {"id": 1, "coordinates": 1, "landuse_code": 1, "region_id": 1, "_id": 0},
+                                      process_nodes.NODE_BYTES, allow_disk_use=True):
+        stores.append(NodeStore.from_documents(batch))
+        region_ids.append(np.array([x["region_id"] for x in batch], dtype=np.int32))
+    metrics.count("docs_read", sum(len(x) for x in stores))
+
+    return NodeStore.concatenate(stores), np.concatenate(region_ids) if len(region_ids) != 0 else np.empty(0, np.int32)
+
+
+def node_hash(multiplier: int):
+    """
+    Aggregation expression hashing one restricting node: id, coordinates to 1e-7 degree, landuse code and region id
+    folded into a polynomial modulo HASH_MODULUS, then squared so a value moved from one node to another changes
+    the sum of the hashes
+    """
+    values = ["$id", {"$toLong": {"$multiply": ["$lon", 1e7]}}, {"$toLong": {"$multiply": ["$lat", 1e7]}},
+              "$landuse_code", "$region_id"]
+    value_hash = 0
+    for value in values:
+        value = {"$mod": [{"$ifNull": [value, 0]}, HASH_MODULUS]}
+        value_hash = {"$mod": [{"$add": [{"$multiply": [value_hash, multiplier]}, value]}, HASH_MODULUS]}
+    return {"$mod": [{"$multiply": [value_hash, value_hash]}, HASH_MODULUS]}
+
+
+def source_fingerprint(collection):
+    """
+    Fingerprint of the restricting nodes computed by the database: their count and sums of node hashes, see
+    node_hash, which do not depend on the order of the nodes. Only one document is sent back, and it does not change
+    when process_nodes writes results to allowable nodes
+    :return: hex digest, also covering the index format and cell size
+    """
+    sums = {f"hash_{number}": {"$sum": node_hash(multiplier)} for number, multiplier in enumerate(HASH_MULTIPLIERS)}
+    cursor = collection.aggregate([{"$match": landuse.code_filter(RESTRICTING_LANDUSE)},
+                                   {"$project": {"id": 1, "region_id": 1, "landuse_code": 1,
+                                                 "lon": {"$arrayElemAt": ["$coordinates", 0]},
+                                                 "lat": {"$arrayElemAt": ["$coordinates", 1]}}},
+                                   {"$group": {"_id": None, "count": {"$sum": 1}, **sums}}],
+                                  allowDiskUse=True)
+    summary = {k: int(v) for k, v in next(iter(cursor), {}).items() if k != "_id"}
+    summary.update({"format": INDEX_FORMAT, "cell_size": CELL_SIZE, "landuse": RESTRICTING_LANDUSE})
+
+    return hashlib.sha256(json.dumps(summary, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def get_index(collection, folder_name: str = INDEX_FOLDER):
+    """
+    Memory-maps the saved index matching the current restricting nodes, building and saving it first when the
+    fingerprint changed. Older versions are removed
+    :param folder_name: folder holding one subfolder per version, named by fingerprint
+    """
+    source_hash = source_fingerprint(collection)
+    folder_path: p.Path = p.Path.cwd().joinpath(folder_name)
+    version_path = folder_path.joinpath(source_hash[:16])
+    if version_path.joinpath("manifest.json").exists():
+        log.info(f"Using saved restriction index {version_path.name}")
+        return RestrictionIndex.load(version_path)
+
+    with metrics.stage("restriction_index.build"):
+        store, node_region_ids = load_restrictions(collection)
+        arrays, grid = build_arrays(store, node_region_ids)
+        index = RestrictionIndex(arrays, {"lengths": {name: len(arrays[name]) for name, _ in COLUMNS}, **grid})
+        index.save(version_path, source_hash)
+    for old_path in folder_path.iterdir():
+        if old_path != version_path and old_path.joinpath("manifest.json").exists():
+            shutil.rmtree(old_path)
+            log.info(f"Removed outdated restriction index {old_path.name}")
+
+    return RestrictionIndex.load(version_path)
+
+
+_index = None
+
+
+def attach_worker(descriptor: dict):
+    """Pool initializer, every worker attaches to the shared block once"""
+    global _index
+    _index = RestrictionIndex.attach(descriptor)
+
+
+def process_region(region_id: int):
+    """
+    process_nodes.get_nodes_from_way for one region, with the restricting nodes taken from the shared index
+    :return: region id, the counters of this call, the error if it failed and its seconds
+    """
+    metrics.reset()
+    start = time.perf_counter()
+    try:
+        region_distances(region_id)
+    except Exception as error:
+        log.exception(f"Region {region_id} failed")
+        return region_id, metrics.report("process_nodes")["counters"], repr(error), time.perf_counter() - start
+
+    return region_id, metrics.report("process_nodes")["counters"], None, time.perf_counter() - start
+
+
+def region_distances(region_id: int):
+    db = db_connection.get_db()
+    collection = db_connection.get_collection("testing_col", "bulk")
+    with metrics.stage("process_nodes.region", region_id=region_id):
+        region_bbox = process_nodes.get_region_bbox(ALLOWABLE_LANDUSE, collection, region_id)
+        if region_bbox is not None:
+            region_neighbours = process_nodes.get_region_ids(region_id, db["regions"])
+            neighbour_ids = region_neighbours if type(region_neighbours) != int else [region_neighbours]
+            restricting_nodes = _index.region_nodes(region_bbox, [region_id])
+            neighbour_nodes = _index.region_nodes(region_bbox, neighbour_ids)
+            node_batches = process_nodes.stream_nodes_from_way(ALLOWABLE_LANDUSE, collection, region_id)
+            changed_ways = process_nodes.iterate_nodes_list(node_batches, restricting_nodes, collection,
+                                                            region_neighbours, region_bbox, neighbour_nodes)
+            refresh_way_buildable(db, region_id, changed_ways)
+
+
+def distance_inputs(region_id: int, ledger: job_ledger.JobLedger = None):
+    """
+    Input hash of one region, distances depend on the setbacks, the simplification of restricting nodes and the
+    landuse copied to the nodes by add_ways_to_node
+    """
+    return job_ledger.chained_inputs(LEDGER_STAGE, region_id, [landuse.DEFAULT_SETBACKS,
+                                                               process_nodes.SIMPLIFY_TOLERANCE], ledger)
+
+
+job_ledger.register_inputs(LEDGER_STAGE, distance_inputs)
+
+
+def process_regions(region_ids: list, workers: int = None, saved_index: bool = True,
+                    ledger: job_ledger.JobLedger = None):
+    """
+    Calculates distances to restrictions for many regions in parallel. The restricting nodes are read once and shared
+    by all workers, so memory stays near one copy whatever the number of workers
+    :param region_ids: list of region ids, regions done according to the job ledger are skipped
+    :param workers: number of processes, all CPUs by default
+    :param saved_index: memory-map the index saved on disk (rebuilt only when the restricting nodes changed),
+    otherwise the index is built in shared memory for this run only
+    :param ledger: job ledger, the ledger of job_ledger.LEDGER_FILE by default
+    """
+    ledger = ledger or job_ledger.get_ledger()
+    inputs = {x: distance_inputs(x, ledger) for x in region_ids}
+    region_ids = ledger.pending(LEDGER_STAGE, region_ids, inputs.get)
+    if len(region_ids) == 0:
+        log.info("All regions already done")
+        return
+    collection = db_connection.get_collection("testing_col", "read")
+    landuse.ensure_codes(db_connection.get_collection("testing_col"), ledger)
+    if saved_index:
+        index = get_index(collection)
+    else:
+        store, node_region_ids = load_restrictions(collection)
+        index = RestrictionIndex.create(store, node_region_ids)
+        del store, node_region_ids
+    # spawned workers open their own database connections, a client must not be shared across fork
+    context = multiprocessing.get_context("spawn")
+    try:
+        with context.Pool(workers or os.cpu_count(), initializer=attach_worker, initargs=(index.descriptor,)) as pool:
+            attempts = 0
+            # failed regions are retried together, after a backoff growing with every pass
+            while len(region_ids) != 0 and attempts < job_ledger.MAX_ATTEMPTS:
+                if attempts != 0:
+                    delay = job_ledger.backoff_delay(attempts)
+                    log.warning(f"Retrying {len(region_ids)} regions in {delay:.0f} s")
+                    time.sleep(delay)
+                attempts = attempts + 1
+                for region_id in region_ids:
+                    ledger.start(LEDGER_STAGE, region_id, inputs[region_id])
+                failed = []
+                for region_id, counters, error, seconds in pool.imap_unordered(process_region, region_ids):
+                    for name, value in counters.items():
+                        metrics.count(name, value)
+                    if error is None:
+                        ledger.finish(LEDGER_STAGE, region_id, seconds)
+                        log.info(f"Region {region_id} done")
+                    else:
+                        ledger.fail(LEDGER_STAGE, region_id, error, seconds)
+                        failed.append(region_id)
+                region_ids = failed
+            if len(region_ids) != 0:
+                log.error(f"{len(region_ids)} regions failed: {region_ids}")
+    finally:
+        index.close()
+
+
+if __name__ == "__main__":
+    process_regions([x for x in range(1, 381)])
+    metrics.write_report("restriction_index")
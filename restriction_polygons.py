@@ -0,0 +1,211 @@
+import logging as log
+import numpy as np
+import shapely
+from pyproj import Transformer
+import db_connection
+import landuse
+import metrics
+import process_nodes
+from node_store import NodeStore, EARTH_RADIUS
+from way_buildable import refresh_way_buildable
+
+log.getLogger().setLevel(log.INFO)
+log.basicConfig(format="%(asctime)s - [%(levelname)s]: %(message)s", datefmt="%H:%M:%S")
+
+WAY_BYTES = 2048 # approximate size of a decoded way document with its node ids
+NODE_IDS_PER_QUERY = 50000 # node ids of the ways looked up by one $in query
+# km, restrictions farther away are not searched, same as the distance stored when none is found
+SEARCH_DISTANCE = landuse.NO_RESTRICTION_DISTANCE
+
+
+def local_transformer(center: list):
+    """
+    Azimuthal equidistant projection in km around the center, on the sphere used by the haversine distances.
+    Over a region of tens of km planar distances differ from haversine ones by less than 1e-5 relative
+    :param center: [lon, lat]
+    """
+    projection = f"+proj=aeqd +lon_0={center[0]} +lat_0={center[1]} +R={EARTH_RADIUS * 1000} +units=km +no_defs"
+    return Transformer.from_crs("EPSG:4326", projection, always_xy=True)
+
+
+class PolygonIndex:
+    """
+    Restricting ways as projected polygons, or lines when the way is not closed or some of its nodes are missing,
+    with one STRtree per restricting class. Distances are to the polygon edges, 0 inside a polygon
+
+    Attributes:
+        transformer: local projection of the coordinates, see local_transformer
+        way_ids (np.ndarray): way id of every geometry
+        codes (np.ndarray): landuse code of every geometry
+        geometries (np.ndarray): shapely geometries in km
+        trees (dict): position in RESTRICTING_LANDUSE -> (STRtree, rows of the geometries in it)
+    """
+    __slots__ = ("transformer", "way_ids", "codes", "geometries", "trees")
+
+    def __init__(self, transformer, way_ids, codes, geometries):
+        self.transformer = transformer
+        self.way_ids = np.asarray(way_ids, dtype=np.int64)
+        self.codes = np.asarray(codes, dtype=np.uint8)
+        self.geometries = np.asarray(geometries, dtype=object)
+        self.trees = {}
+        positions = landuse.RESTRICTING_POSITIONS[self.codes]
+        for position in np.unique(positions[positions >= 0]):
+            rows = np.flatnonzero(positions == position)
+            self.trees[int(position)] = (shapely.STRtree(self.geometries[rows]), rows)
+
+    def __len__(self):
+        return len(self.way_ids)
+
+    @classmethod
+    def from_ways(cls, ways, store: NodeStore, center: list):
+        """
+        :param ways: iterable of way documents with id, nodes and landuse
+        :param store: nodes of the ways with coordinates, see get_way_nodes, nodes missing from it are left out
+        of the geometries
+        :param center: [lon, lat] of the projection, usually the center of the region
+        """
+        transformer = local_transformer(center)
+        order = np.argsort(store.ids, kind="stable")
+        sorted_ids = store.ids[order]
+        x, y = transformer.transform(store.lon, store.lat)
+
+        way_ids, codes, geometries = [], [], []
+        for way in ways:
+            node_ids = np.asarray(way["nodes"], dtype=np.int64)
+            positions = np.minimum(np.searchsorted(sorted_ids, node_ids), max(len(sorted_ids) - 1, 0))
+            found = (sorted_ids[positions] == node_ids) if len(sorted_ids) != 0 else np.zeros(len(node_ids), dtype=bool)
+            rows = order[positions[found]]
+            if len(rows) == 0:
+                continue
+            coordinates = np.column_stack((x[rows], y[rows]))
+            if found.all() and len(node_ids) >= 4 and node_ids[0] == node_ids[-1]:
+                geometry = shapely.polygons(coordinates)
+            elif len(rows) >= 2:
+                geometry = shapely.linestrings(coordinates)
+            else:
+                geometry = shapely.points(coordinates[0])
+            way_ids.append(way["id"])
+            codes.append(landuse.tag_code(way["landuse"]))
+            geometries.append(geometry)
+
+        geometries = np.asarray(geometries, dtype=object)
+        invalid = ~shapely.is_valid(geometries) if len(geometries) != 0 else np.zeros(0, dtype=bool)
+        # self intersecting outlines, a valid polygon keeps the points inside them at distance 0
+        geometries[invalid] = shapely.make_valid(geometries[invalid])
+        return cls(transformer, way_ids, codes, geometries)
+
+    def class_distances(self, lon, lat, search_distance: float = SEARCH_DISTANCE):
+        """
+        Vectorized nearest edge distance from every point to every restricting class
+        :param lon, lat: arrays of coordinates
+        :return: distances in km of shape (points, len(RESTRICTING_LANDUSE)), inf when nothing is within
+        search_distance, and the id of the nearest way of each class, 0 when none
+        """
+        x, y = self.transformer.transform(np.asarray(lon, dtype=np.float64), np.asarray(lat, dtype=np.float64))
+        points = shapely.points(x, y)
+        distances = np.full((len(points), len(landuse.RESTRICTING_LANDUSE)), np.inf)
+        way_ids = np.zeros(distances.shape, dtype=np.int64)
+        for position, (tree, rows) in self.trees.items():
+            (point_rows, tree_rows), found = tree.query_nearest(points, max_distance=search_distance,
+                                                                return_distance=True, all_matches=False)
+            distances[point_rows, position] = found
+            way_ids[point_rows, position] = self.way_ids[rows[tree_rows]]
+        return distances, way_ids
+
+    def nearest(self, lon, lat, search_distance: float = SEARCH_DISTANCE):
+        """
+        :return: distance in km to the nearest restriction of any class, inf when none, its way id and the
+        distances per class, see class_distances
+        """
+        distances, way_ids = self.class_distances(lon, lat, search_distance)
+        if distances.shape[1] == 0:
+            return np.full(len(distances), np.inf), np.zeros(len(distances), dtype=np.int64), distances
+        columns = distances.argmin(axis=1)
+        points = np.arange(len(distances))
+        return distances[points, columns], way_ids[points, columns], distances
+
+
+def stream_restricting_ways(region_ids: list, db):
+    """
+    Restricting ways of the regions, read in batches sized by the memory budget
+    :return: generator of way documents
+    """
+    query = {"region_id": {"$in": region_ids}, "landuse": {"$in": landuse.RESTRICTING_LANDUSE}}
+    for batch in db_connection.stream(db["ways"], query, {"id": 1, "nodes": 1, "landuse": 1, "_id": 0}, WAY_BYTES,
+                                      allow_disk_use=True):
+        metrics.count("docs_read", len(batch))
+        yield from batch
+
+
+def get_way_nodes(ways: list, collection, region_bbox: list = None):
+    """
+    Nodes of the ways looked up by id whatever their landuse code. A vertex shared with another way may carry the
+    code of that way, and filtering by restricting codes would turn closed outlines into lines
+    :param region_bbox: bounding box of the processed region, only nodes closer than LIMIT_COORDINATES to it are read
+    :return: NodeStore
+    """
+    node_ids = np.unique(np.concatenate([np.asarray(way["nodes"], dtype=np.int64) for way in ways] or
+                                        [np.empty(0, dtype=np.int64)]))
+    bbox_query = {}
+    if region_bbox is not None:
+        limit = process_nodes.LIMIT_COORDINATES
+        bbox_query["coordinates.0"] = {"$gte": region_bbox[0] - limit, "$lte": region_bbox[2] + limit}
+        bbox_query["coordinates.1"] = {"$gte": region_bbox[1] - limit, "$lte": region_bbox[3] + limit}
+    projection = {"id": 1, "coordinates": 1, "landuse_code": 1, "_id": 0}
+    queries = [{"id": {"$in": node_ids[start:start + NODE_IDS_PER_QUERY].tolist()}, **bbox_query}
+               for start in range(0, len(node_ids), NODE_IDS_PER_QUERY)]
+    store = NodeStore.from_batches(batch for query in queries
+                                   for batch in db_connection.stream(collection, query, projection,
+                                                                     process_nodes.NODE_BYTES))
+    metrics.count("docs_read", len(store))
+    return store
+
+
+def node_results(nodes: list, index: PolygonIndex):
+    """
+    Adds the results of process_nodes to the nodes of one batch, with restricting_way_id in place of the node id
+    """
+    lon = np.array([node["coordinates"][0] for node in nodes])
+    lat = np.array([node["coordinates"][1] for node in nodes])
+    distances, way_ids, class_distances = index.nearest(lon, lat)
+    for node, distance, way_id, minima in zip(nodes, distances, way_ids, class_distances):
+        node["class_distances"] = minima
+        node["closest_distance_restriction"] = float(min(distance, landuse.NO_RESTRICTION_DISTANCE))
+        node["restricting_way_id"] = int(way_id)
+        node["is_buildeable"] = landuse.is_buildable(landuse.class_distances_document(minima))
+    return nodes
+
+
+def process_region(region_id: int):
+    """
+    Same stage as process_nodes.get_nodes_from_way with distances to restricting polygons of the region and its
+    neighbours instead of distances to their nodes
+    """
+    db = db_connection.get_db()
+    collection = db_connection.get_collection("testing_col", "bulk")
+
+    with metrics.stage("restriction_polygons.region", region_id=region_id):
+        region_bbox = process_nodes.get_region_bbox(landuse.ALLOWABLE_LANDUSE, collection, region_id)
+        if region_bbox is None:
+            log.info(f"No allowable nodes in region {region_id}")
+            return
+        neighbours = process_nodes.get_region_ids(region_id, db["regions"])
+        region_ids = [region_id] + (neighbours if isinstance(neighbours, list) else [])
+        ways = list(stream_restricting_ways(region_ids, db))
+        store = get_way_nodes(ways, collection, region_bbox)
+        center = [(region_bbox[0] + region_bbox[2]) / 2, (region_bbox[1] + region_bbox[3]) / 2]
+        index = PolygonIndex.from_ways(ways, store, center)
+        log.info(f"Indexed {len(index)} restricting ways from {len(store)} nodes")
+
+        changed_ways = set()
+        for batch in process_nodes.stream_nodes_from_way(landuse.ALLOWABLE_LANDUSE, collection, region_id):
+            metrics.count("nodes_evaluated", len(batch))
+            node_results(batch, index)
+            changed_ways.update(node["way_id"] for node in batch if node["is_buildeable"])
+            process_nodes.insert_to_collection(batch, collection)
+        refresh_way_buildable(db, region_id, changed_ways)
+
+
+if __name__ == "__main__":
+    process_region(140)
+    metrics.write_report("restriction_polygons")
@@ -0,0 +1,27 @@
+import pathlib as p
+import sys
+
+import mongomock
+import pytest
+
+# the modules of the repository are imported by name, as the scripts run from its root
+sys.path.insert(0, str(p.Path(__file__).resolve().parents[1]))
+
+import db_connection
+import job_ledger
+
+
+@pytest.fixture
+def ledger(tmp_path, monkeypatch):
+    ledger = job_ledger.JobLedger(str(tmp_path.joinpath("ledger.sqlite")))
+    monkeypatch.setattr(job_ledger, "_ledger", ledger)
+    yield ledger
+    ledger.close()
+
+
+@pytest.fixture
+def db():
+    db = mongomock.MongoClient().db
+    db_connection.use_database(db)
+    yield db
+    db_connection.use_database(None)
@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+import get_power_areas as power
+from buildability_service import BuildabilityIndex
+from node_store import NodeStore
+
+# way 10 crosses the border of regions 0 and 1, its nodes 3 and 4 are listed in both region files
+COORDINATES = {1: [19.00, 52.00], 2: [19.00, 52.04], 3: [19.03, 52.01], 4: [19.03, 52.03], 5: [19.06, 52.04],
+               6: [19.06, 52.00]}
+REGION_NODES = [[1, 2, 3, 4], [3, 4, 5, 6]]
+
+
+def region_store(node_ids: list):
+    return NodeStore(node_ids, [COORDINATES[x][0] for x in node_ids], [COORDINATES[x][1] for x in node_ids],
+                     [10] * len(node_ids), None, [1.] * len(node_ids))
+
+
+@pytest.fixture
+def index():
+    store = NodeStore.concatenate([region_store(x) for x in REGION_NODES])
+    numbers = np.concatenate([np.full(len(x), number, dtype=np.int32) for number, x in enumerate(REGION_NODES)])
+    return BuildabilityIndex(store, numbers, ["first", "second"])
+
+
+@pytest.mark.parametrize("bbox, node_ids", [([18.9, 51.9, 19.2, 52.1], [1, 2, 3, 4, 5, 6]),
+                                            ([19.02, 51.9, 19.2, 52.1], [3, 4, 5, 6])])
+def test_border_nodes_count_once(index, bbox, node_ids):
+    answer = index.query(bbox=bbox, setback=0.5)
+
+    assert answer["nodes_in_area"] == len(node_ids)
+    assert answer["buildable_nodes"] == len(node_ids)
+    assert answer["node_number"] == len(node_ids)
+    assert answer["ways"] == 1
+    assert answer["overall_area"] == pytest.approx(power.calculate_hull_area([COORDINATES[x] for x in node_ids]))
+
+
+def test_way_size_counts_unique_nodes(index):
+    assert index.way_sizes.tolist() == [6]
+    assert len(index.store) == len(index.grid.rows_within(18.9, 51.9, 19.2, 52.1))
@@ -0,0 +1,28 @@
+import create_geo_array_nodes
+
+
+def node(node_id: int, region_id: int):
+    return {"id": node_id, "region_id": region_id, "lon": 19. + node_id / 100, "lat": 52.}
+
+
+def test_node_of_two_regions_is_kept_in_both(ledger, db):
+    db["nodes"].insert_many([node(1, 1), node(2, 1), node(2, 2), node(3, 2)])
+
+    create_geo_array_nodes.connect([1, 2])
+
+    assert sorted((x["region_id"], x["id"]) for x in db["testing_col"].find()) == [(1, 1), (1, 2), (2, 2), (2, 3)]
+    assert db["testing_col"].find_one({"id": 2, "region_id": 1})["coordinates"] == [19.02, 52.]
+
+
+def test_converting_again_keeps_both_copies_and_later_fields(ledger, db):
+    db["nodes"].insert_many([node(1, 1), node(2, 1), node(2, 2)])
+    create_geo_array_nodes.connect([1, 2])
+    db["testing_col"].update_many({"id": 2}, {"$set": {"landuse": "forest"}})
+
+    ledger.mark_done(create_geo_array_nodes.LEDGER_STAGE, [1, 2], "old")
+    create_geo_array_nodes.connect([1, 2])
+
+    shared = list(db["testing_col"].find({"id": 2}))
+    assert sorted(x["region_id"] for x in shared) == [1, 2]
+    assert all(x["landuse"] == "forest" for x in shared)
+    assert db["testing_col"].count_documents({}) == 3
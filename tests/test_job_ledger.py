@@ -0,0 +1,116 @@
+import os
+import pathlib as p
+import subprocess
+import sys
+
+import add_ways_to_node
+import get_power_areas
+import job_ledger
+
+REPOSITORY = p.Path(__file__).resolve().parents[1]
+
+
+def test_done_command_skips_regions_of_add_ways_to_node(ledger, db):
+    db["ways"].insert_many([{"id": 100 + x, "region_id": x, "nodes": [x], "landuse": "forest"} for x in (1, 2)])
+    db["testing_col"].insert_many([{"id": x, "region_id": x} for x in (1, 2)])
+
+    subprocess.run([sys.executable, "job_ledger.py", "done", "--stage", "add_ways_to_node", "--regions", "1"],
+                   cwd=REPOSITORY, env={**os.environ, "MGR_JOB_LEDGER": str(ledger.path)}, check=True)
+    add_ways_to_node.get_nodes_from_way(1, 3)
+
+    assert "landuse" not in db["testing_col"].find_one({"id": 1})
+    assert db["testing_col"].find_one({"id": 2})["way_id"] == 102
+    assert ledger.pending(add_ways_to_node.LEDGER_STAGE, [1, 2], add_ways_to_node.landuse_inputs) == []
+
+
+def test_upstream_run_makes_region_pending(ledger):
+    ledger.mark_done("create_geo_array_nodes", [1, 2])
+    ledger.mark_done("add_ways_to_node", [1, 2])
+    assert ledger.pending("add_ways_to_node", [1, 2], lambda x: job_ledger.stage_inputs("add_ways_to_node", x)) == []
+
+    ledger.mark_done("create_geo_array_nodes", [2])
+    assert ledger.pending("add_ways_to_node", [1, 2], lambda x: job_ledger.stage_inputs("add_ways_to_node", x)) == [2]
+
+
+def test_run_regions_resumes_after_done_regions(ledger):
+    calls = []
+    job_ledger.run_regions("stage", [1, 2], calls.append, ledger, inputs="a")
+    job_ledger.run_regions("stage", [1, 2, 3], calls.append, ledger, inputs="a")
+
+    assert calls == [1, 2, 3]
+    assert ledger.is_done("stage", 3, "a")
+
+
+def test_other_inputs_run_regions_again(ledger):
+    calls = []
+    job_ledger.run_regions("stage", [1, 2], calls.append, ledger, inputs="a")
+    job_ledger.run_regions("stage", [1, 2], calls.append, ledger, inputs=lambda x: "b" if x == 2 else "a")
+
+    assert calls == [1, 2, 2]
+    assert ledger.pending("stage", [1, 2], "b") == [1]
+
+
+def test_failed_region_is_retried(ledger):
+    attempts = []
+
+    def flaky(region):
+        attempts.append(region)
+        if region == 1 and attempts.count(1) == 1:
+            raise ConnectionError("timed out")
+
+    given_up = job_ledger.run_regions("stage", [1, 2], flaky, ledger, backoff=0)
+
+    assert given_up == []
+    assert attempts == [1, 2, 1]
+    assert ledger.job("stage", 1)["attempts"] == 2
+    assert ledger.is_done("stage", 1)
+
+
+def test_region_failing_every_attempt_is_given_up(ledger):
+    def broken(region):
+        raise ValueError(f"bad region {region}")
+
+    given_up = job_ledger.run_regions("stage", [1], broken, ledger, max_attempts=3, backoff=0)
+
+    assert given_up == [1]
+    assert ledger.failed("stage") == [("1", 3, "ValueError('bad region 1')")]
+    assert ledger.pending("stage", [1]) == [1]
+
+
+def test_regions_are_done_once_flushed(ledger):
+    kept, written, flushes = [], [], []
+
+    def flush():
+        flushes.append(list(kept))
+        if len(flushes) == 1:
+            kept.clear()
+            raise ConnectionError("write failed")
+        written.extend(kept)
+        kept.clear()
+
+    given_up = job_ledger.run_regions("stage", [1, 2, 3], kept.append, ledger, backoff=0, flush=flush, flush_every=2)
+
+    assert given_up == []
+    assert flushes == [[1, 2], [3], [1, 2]]
+    assert sorted(written) == [1, 2, 3]
+    assert ledger.job("stage", 1)["attempts"] == 2
+    assert ledger.job("stage", 3)["attempts"] == 1
+    assert ledger.pending("stage", [1, 2, 3]) == []
+
+
+def test_power_stage_runs_through_the_ledger(ledger, db):
+    db["regions"].insert_many([{"id": 1}, {"id": 2}])
+    db["way_buildable"].insert_one({"region_id": 1, "way_id": 10, "buildable_nodes": [1, 2, 3],
+                                    "node_coordinates": [[19., 52.], [19., 52.04], [19.06, 52.04]],
+                                    "node_distances": [1., 1., 1.]})
+    ledger.mark_done("process_nodes", [1, 2], "distances")
+
+    inputs = lambda x: get_power_areas.power_inputs(x, ledger, 0)
+
+    assert get_power_areas.get_power_areas([1, 2], 0) == []
+    assert "results_500m_min0MW" in db["regions"].find_one({"id": 1})
+    assert ledger.pending(get_power_areas.LEDGER_STAGE, [1, 2], inputs) == []
+    assert ledger.pending(get_power_areas.LEDGER_STAGE, [1, 2], get_power_areas.power_inputs) == [1, 2]
+
+    ledger.mark_done("process_nodes", [2], "distances")
+    assert ledger.pending(get_power_areas.LEDGER_STAGE, [1, 2], inputs) == [2]
@@ -0,0 +1,91 @@
+import random
+
+import numpy as np
+import pytest
+
+import landuse
+import process_nodes
+from node_store import DistanceBounds, NodeStore
+
+REGION_BBOX = [19., 52., 19.2, 52.1]
+RESTRICTING_CODES = [landuse.tag_code(tag) for tag in landuse.RESTRICTING_LANDUSE]
+
+
+@pytest.fixture
+def restricting_nodes():
+    rng = random.Random(7)
+    return [{"id": 1000 + x, "landuse_code": rng.choice(RESTRICTING_CODES),
+             "coordinates": [rng.uniform(REGION_BBOX[0], REGION_BBOX[2]), rng.uniform(REGION_BBOX[1], REGION_BBOX[3])]}
+            for x in range(400)]
+
+
+def allowable_nodes(number: int = 200):
+    rng = random.Random(11)
+    return [{"id": x, "way_id": 1, "coordinates": [rng.uniform(REGION_BBOX[0], REGION_BBOX[2]),
+                                                   rng.uniform(REGION_BBOX[1], REGION_BBOX[3])]}
+            for x in range(number)]
+
+
+def search(node: dict, restricting_nodes, bounds: DistanceBounds = None):
+    return process_nodes.find_closest_restriction(dict(node), restricting_nodes, "curr_region", bounds)
+
+
+def assert_same_result(result: dict, expected: dict):
+    assert result["is_buildeable"] == expected["is_buildeable"]
+    assert result["restricting_node_id"] == expected["restricting_node_id"]
+    assert result["closest_distance_restriction"] == pytest.approx(expected["closest_distance_restriction"], abs=1e-9)
+
+
+def test_closest_restriction_matches_list_loop(restricting_nodes):
+    store = NodeStore.from_documents(restricting_nodes)
+    results = [(search(node, store), search(node, restricting_nodes)) for node in allowable_nodes()]
+
+    for result, expected in results:
+        assert_same_result(result, expected)
+    # both outcomes of the search are covered
+    assert {expected["is_buildeable"] for _, expected in results} == {True, False}
+
+
+def test_two_tier_results_are_exact(restricting_nodes):
+    store = NodeStore.from_documents(restricting_nodes)
+    bounds = DistanceBounds.for_bbox(REGION_BBOX, process_nodes.LIMIT_COORDINATES)
+    for node in allowable_nodes():
+        expected = search(node, store)
+        for result in (search(node, store, bounds), search(node, restricting_nodes, bounds)):
+            assert_same_result(result, expected)
+        assert np.allclose(search(node, store, bounds)["class_distances"], expected["class_distances"])
+
+
+def test_distance_bounds_contain_haversine():
+    rng = random.Random(3)
+    bounds = DistanceBounds.for_bbox(REGION_BBOX, process_nodes.LIMIT_COORDINATES)
+    for _ in range(1000):
+        node = [rng.uniform(REGION_BBOX[0], REGION_BBOX[2]), rng.uniform(REGION_BBOX[1], REGION_BBOX[3])]
+        other = [node[0] + rng.uniform(-0.04, 0.04), node[1] + rng.uniform(-0.04, 0.04)]
+        distance = process_nodes.calculate_distance(node, other)
+        low, high = bounds.bounds(node, other)
+        assert bounds.lower_bound(node, other) <= distance
+        assert low <= distance <= high
+
+
+def test_node_list_needs_region_bbox(restricting_nodes):
+    with pytest.raises(ValueError):
+        process_nodes.iterate_nodes_list([allowable_nodes(1)], restricting_nodes, None, [], None)
+
+
+@pytest.mark.parametrize("distance_mode", ["exact", "two_tier"])
+def test_neighbour_restrictions_are_read_around_the_region(db, monkeypatch, distance_mode):
+    monkeypatch.setattr(process_nodes, "DISTANCE_MODE", distance_mode)
+    meadow, forest = landuse.tag_code("meadow"), landuse.tag_code(landuse.RESTRICTING_LANDUSE[0])
+    db["regions"].insert_one({"id": 1, "neighbours": [2]})
+    db["testing_col"].insert_many([
+        {"id": 1, "region_id": 1, "way_id": 10, "landuse": "meadow", "landuse_code": meadow, "coordinates": [19.1, 52.05]},
+        {"id": 2, "region_id": 1, "landuse_code": forest, "coordinates": [19.1, 52.09]},
+        {"id": 3, "region_id": 2, "landuse_code": forest, "coordinates": [19.1, 52.056]}])
+
+    process_nodes.get_nodes_from_way(1, merge=False)
+
+    node = db["testing_col"].find_one({"id": 1})
+    expected = process_nodes.calculate_distance([19.1, 52.05], [19.1, 52.056])
+    assert node["closest_distance_restriction"] == pytest.approx(expected)
+    assert node["restricting_node_id"] == 3
@@ -0,0 +1,75 @@
+import random
+
+import pytest
+
+import get_power_areas as power
+import power_results_cache as results_cache
+
+
+def random_ways(number: int = 40):
+    rng = random.Random(5)
+    ways = []
+    for way_id in range(number):
+        lon, lat = rng.uniform(19., 20.), rng.uniform(50., 51.)
+        size = rng.randint(1, 30)
+        distances = sorted(rng.choice([0.5, 0.6, 0.75, 1., 1.3, 1.5, 2.]) for _ in range(size))
+        ways.append({"way_id": way_id, "region_id": 1 + way_id % 3, "buildable_nodes": list(range(size)),
+                     "node_coordinates": [[lon + rng.uniform(0, 0.05), lat + rng.uniform(0, 0.05)] for _ in range(size)],
+                     "node_distances": distances})
+    return ways
+
+
+def expected_results(ways: list, min_distance: float, min_allowable_power: float):
+    """Totals per region computed way by way, without the cache"""
+    results = {}
+    for way in ways:
+        coordinates = [x for x, distance in zip(way["node_coordinates"], way["node_distances"]) if distance >= min_distance]
+        area = power.calculate_hull_area(coordinates) if len(coordinates) > 2 else 0
+        way_power = area * power.AVG_POWER_COEFFICIENT
+        totals = results.setdefault(way["region_id"], [0., 0., 0])
+        if area != 0 and way_power >= min_allowable_power:
+            totals[0], totals[1], totals[2] = totals[0] + area, totals[1] + way_power, totals[2] + len(coordinates)
+    return results
+
+
+@pytest.mark.parametrize("min_allowable_power", [0, 30, 100])
+def test_threshold_results_match_way_results(min_allowable_power):
+    ways = random_ways()
+    cache = results_cache.build_cache([power.calculate_way_results(way, results_cache.SETBACKS) for way in ways])
+    for min_distance in results_cache.SETBACKS:
+        results = results_cache.threshold_results(cache, min_distance, min_allowable_power)
+        expected = expected_results(ways, min_distance, min_allowable_power)
+        assert set(results) == set(expected)
+        for region_id, (area, region_power, node_number) in expected.items():
+            assert results[region_id][0] == pytest.approx(area)
+            assert results[region_id][1] == pytest.approx(region_power)
+            assert results[region_id][2] == node_number
+
+
+def test_uncached_setback_is_rejected():
+    cache = results_cache.build_cache([power.calculate_way_results(way, results_cache.SETBACKS) for way in random_ways()])
+    with pytest.raises(ValueError):
+        results_cache.threshold_results(cache, 0.6, 0)
+
+
+def test_way_of_two_regions_is_cached_for_both(db):
+    way_1, way_2 = [power.calculate_way_results({**way, "way_id": 10}, results_cache.SETBACKS)
+                    for way in random_ways(2)]
+    results_cache.save_way_results(db, [way_1])
+    results_cache.save_way_results(db, [way_2])
+    assert results_cache.load_cache(db)["region_id"].tolist() == [1, 2]
+
+    results_cache.save_way_results(db, [], [1])
+    assert results_cache.load_cache(db)["region_id"].tolist() == [2]
+
+
+def test_region_without_buildable_ways_gets_zero_totals(ledger, db):
+    db["regions"].insert_one({"id": 1, "results_500m_min30MW": {"overall_area": 2., "overall_power": 39.6,
+                                                                "node_number": 12}})
+
+    power.get_power_areas([1], 30)
+
+    region = db["regions"].find_one({"id": 1})
+    for setback in results_cache.SETBACKS:
+        assert region[f"results_{int(setback * 1e3)}m_min30MW"] == {"overall_area": 0, "overall_power": 0,
+                                                                   "node_number": 0}
@@ -0,0 +1,37 @@
+import numpy as np
+
+import region_store
+
+NODES = [{"id": 1, "lat": 52.1, "lon": 19.2, "way_id": 10, "landuse": "farmland", "closest_distance_restriction": 0.},
+         {"id": 2, "lat": 52.2, "lon": 19.3, "way_id": 10, "landuse": "meadow", "closest_distance_restriction": 1.25},
+         {"id": 3, "lat": 50.5, "lon": 21.7, "way_id": 11, "landuse": "residential", "closest_distance_restriction": 4.}]
+WAYS = [{"id": 10, "nodes": [1, 2, 1], "landuse": "farmland"}, {"id": 11, "nodes": [], "landuse": "residential"},
+        {"id": 12, "nodes": [3, 4, 5, 3], "landuse": "military"}]
+
+
+def test_records_round_trip():
+    assert list(region_store.decode_records(region_store.encode_records(NODES))) == NODES
+    assert list(region_store.decode_records(region_store.encode_records(WAYS, "way"), "way")) == WAYS
+
+
+def test_unknown_landuse_is_decoded_as_none():
+    node = dict(NODES[0], landuse="quarry")
+    assert list(region_store.decode_records(region_store.encode_records([node])))[0]["landuse"] is None
+
+
+def test_concatenated_batches_round_trip():
+    columns = region_store.concatenate_columns([region_store.encode_records(WAYS[:1], "way"),
+                                                region_store.encode_records(WAYS[1:], "way")], "way")
+    assert list(region_store.decode_records(columns, "way")) == WAYS
+
+
+def test_files_round_trip(tmp_path):
+    ndjson_path = tmp_path.joinpath("region.ndjson")
+    region_store.write_ndjson(NODES, ndjson_path)
+    assert list(region_store.decode_records(region_store.read_ndjson(ndjson_path, batch_size=2))) == NODES
+
+    columns = region_store.encode_records(WAYS, "way")
+    region_store.write_columns(columns, tmp_path.joinpath("region"), "way")
+    read = region_store.read_columns(tmp_path.joinpath("region"))
+    assert all(np.array_equal(read[name], values) for name, values in columns.items())
+    assert list(region_store.decode_records(read, "way")) == WAYS
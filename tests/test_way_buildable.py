@@ -0,0 +1,33 @@
+import landuse
+import way_buildable
+
+
+def node(node_id: int, region_id: int, way_id: int, distance: float):
+    return {"id": node_id, "region_id": region_id, "way_id": way_id, "coordinates": [19. + node_id / 100, 52.],
+            "landuse": "meadow", "landuse_code": landuse.tag_code("meadow"), "is_buildeable": True,
+            "closest_distance_restriction": distance}
+
+
+def test_way_of_two_regions_keeps_a_document_per_region(db):
+    db["testing_col"].insert_many([node(1, 1, 10, 0.9), node(2, 1, 10, 0.6), node(3, 2, 10, 0.7), node(4, 2, 11, 1.)])
+    way_buildable.ensure_indexes(db)
+
+    for region_id in (1, 2, 1):
+        way_buildable.refresh_way_buildable(db, region_id, merge=False)
+
+    ways = {(x["region_id"], x["way_id"]): x for x in db[way_buildable.VIEW_COLLECTION].find()}
+    assert sorted(ways) == [(1, 10), (2, 10), (2, 11)]
+    assert ways[(1, 10)]["buildable_nodes"] == [2, 1]
+    assert ways[(1, 10)]["node_distances"] == [0.6, 0.9]
+    assert ways[(2, 10)]["buildable_nodes"] == [3]
+
+
+def test_refreshing_ways_of_a_region_leaves_the_other_region(db):
+    db["testing_col"].insert_many([node(1, 1, 10, 0.9), node(3, 2, 10, 0.7)])
+    way_buildable.refresh_way_buildable(db, 1, merge=False)
+    way_buildable.refresh_way_buildable(db, 2, merge=False)
+
+    db["testing_col"].update_one({"id": 1}, {"$set": {"is_buildeable": False}})
+    way_buildable.refresh_way_buildable(db, 1, [10], merge=False)
+
+    assert [(x["region_id"], x["way_id"]) for x in db[way_buildable.VIEW_COLLECTION].find()] == [(2, 10)]
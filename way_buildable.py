@@ -0,0 +1,159 @@
+from pymongo import ASCENDING, ReplaceOne
+import logging as log
+import datetime
+import db_connection
+import landuse
+
+log.getLogger().setLevel(log.INFO)
+log.basicConfig(format="%(asctime)s - [%(levelname)s]: %(message)s", datefmt="%H:%M:%S")
+
+VIEW_COLLECTION = "way_buildable"
+ALLOWABLE_LANDUSE = landuse.ALLOWABLE_LANDUSE
+# a way crossing a region border has nodes in both regions and one document per region
+VIEW_KEY = ['region_id', 'way_id']
+
+
+def ensure_indexes(db, nodes_collection: str = "testing_col"):
+    """
+    Creates the indexes used to build and read the per-way view
+    :param db: database handle
+    :param nodes_collection: name of the collection with processed nodes
+    """
+    db[nodes_collection].create_index([("region_id", ASCENDING), ("way_id", ASCENDING)])
+    landuse.ensure_indexes(db[nodes_collection])
+    removed = db[VIEW_COLLECTION].delete_many({'way_id': {'$exists': False}}).deleted_count
+    if removed != 0:
+        log.warning(f"Removed {removed} view documents keyed by the way id alone, build_view writes them again")
+    ensure_view_key(db)
+
+
+def ensure_view_key(db):
+    """
+    Unique index on VIEW_KEY, the view documents are matched on it when written
+    """
+    db[VIEW_COLLECTION].create_index([(key, ASCENDING) for key in VIEW_KEY], unique=True)
+
+
+def view_pipeline(region_id: int, way_ids: list = None, setbacks: dict = None):
+    """
+    Aggregation grouping buildable nodes of a region per way. Nodes are sorted by the distance to the closest
+    restriction before grouping, so the three arrays of each way stay aligned and node_distances is ascending
+    :param region_id:
+    :param way_ids: optional list of ways to rebuild, all ways of the region are rebuilt when not given
+    :param setbacks: optional policy tag -> minimal distance in km applied to the class distances of the nodes,
+    the buildability stored by process_nodes (landuse.DEFAULT_SETBACKS) is used when not given. node_distances
+    are then the distances to the closest restriction of the policy classes, closest_distance_restriction stops
+    at the default setbacks
+    :return: aggregation pipeline without the output stage
+    """
+    match = {
+        'region_id': region_id,
+        **landuse.code_filter(ALLOWABLE_LANDUSE),
+    }
+    distance = '$closest_distance_restriction'
+    if setbacks is None:
+        match['is_buildeable'] = True
+    else:
+        match.update(landuse.policy_filter(setbacks))
+        distance = landuse.policy_distance(setbacks)
+    if way_ids is not None:
+        match['way_id'] = {'$in': list(way_ids)}
+
+    return [
+        {'$match': match},
+        {'$addFields': {'node_distance': distance}},
+        {'$sort': {'way_id': 1, 'node_distance': 1}},
+        {
+            '$group': {
+                '_id': {'region_id': '$region_id', 'way_id': '$way_id'},
+                'buildable_nodes': {'$push': '$id'},
+                'node_coordinates': {'$push': '$coordinates'},
+                'node_distances': {'$push': '$node_distance'}
+            }
+        },
+        {
+            '$project': {
+                '_id': 0,
+                'region_id': '$_id.region_id',
+                'way_id': '$_id.way_id',
+                'buildable_nodes': 1,
+                'node_coordinates': 1,
+                'node_distances': 1
+            }
+        }
+    ]
+
+
+def refresh_way_buildable(db, region_id: int, way_ids: list = None, nodes_collection: str = "testing_col",
+                          merge: bool = True, setbacks: dict = None):
+    """
+    Rebuilds the way_buildable documents of a region, or only of the given ways when node buildability of these
+    ways changed. Ways which no longer have any buildable node are removed from the view
+    :param db: database handle
+    :param region_id:
+    :param way_ids: ways whose nodes changed, None rebuilds the whole region
+    :param nodes_collection: name of the collection with processed nodes
+    :param merge: write with a server side $merge stage, False writes the grouped documents from the client
+    :param setbacks: optional per-class setback policy, see view_pipeline. Changing the policy needs a rebuild of
+    whole regions, without way_ids
+    """
+    if way_ids is not None and len(way_ids) == 0:
+        return
+
+    ensure_view_key(db)
+    refreshed_at = datetime.datetime.utcnow()
+    pipeline = view_pipeline(region_id, way_ids, setbacks)
+    pipeline.append({'$addFields': {'refreshed_at': refreshed_at}})
+
+    if merge:
+        pipeline.append({'$merge': {'into': VIEW_COLLECTION, 'on': VIEW_KEY,
+                                    'whenMatched': 'replace', 'whenNotMatched': 'insert'}})
+        db[nodes_collection].aggregate(pipeline, allowDiskUse=True)
+    else:
+        requests = [ReplaceOne({key: way[key] for key in VIEW_KEY}, way, upsert=True)
+                    for way in db[nodes_collection].aggregate(pipeline, allowDiskUse=True)]
+        if len(requests) != 0:
+            db[VIEW_COLLECTION].bulk_write(requests, ordered=False)
+
+    stale = {'region_id': region_id, 'refreshed_at': {'$lt': refreshed_at}}
+    if way_ids is not None:
+        stale['way_id'] = {'$in': list(way_ids)}
+    db[VIEW_COLLECTION].delete_many(stale)
+
+    log.info(f"View {VIEW_COLLECTION} refreshed for region {region_id}")
+
+
+def read_way_buildable(db, region_id: int):
+    """
+    Reads the per-way buildable nodes of a region from the materialized view
+    :param db: database handle
+    :param region_id:
+    :return: list of ways with buildable_nodes, node_coordinates and node_distances sorted by distance
+    """
+    cursor = db[VIEW_COLLECTION].find({'region_id': region_id}, {'refreshed_at': 0})
+
+    return list(cursor)
+
+
+def stream_way_buildable(db, region_id: int, way_bytes: int = 16384):
+    """
+    Same as read_way_buildable, in batches of ways sized by the memory budget
+    :param way_bytes: approximate size of one decoded way with its node lists
+    :return: generator of lists of ways
+    """
+    return db_connection.stream(db[VIEW_COLLECTION], {'region_id': region_id}, {'refreshed_at': 0}, way_bytes)
+
+
+def build_view(db, region_ids: list):
+    """
+    Builds the whole view for the given regions, used once for nodes processed before the view existed
+    :param db: database handle
+    :param region_ids: list of region ids
+    """
+    ensure_indexes(db)
+    for region_id in region_ids:
+        refresh_way_buildable(db, region_id)
+
+
+if __name__ == "__main__":
+    build_view(db_connection.get_db(), range(1, 381))